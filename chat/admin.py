@@ -1,29 +1,99 @@
 from django.contrib import admin
-from .models import Room, Message, Feedback, LoginLog
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils.functional import cached_property
+from django.utils.html import format_html
+from .models import Room, RoomBan, Message, Feedback, LoginLog, RoomHourlyActivity
+
+# Above this many rows the admin shows approximate totals instead of COUNT(*)
+APPROX_COUNT_LIMIT = 10000
+
+
+class ApproximateCountPaginator(Paginator):
+    """Paginator that never runs COUNT(*) over a whole large table.
+
+    Unfiltered lists on Postgres use the planner's row estimate; everything else
+    counts at most APPROX_COUNT_LIMIT rows, so the last pages of a huge filtered
+    list are simply not linked.
+    """
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        connection = connections[queryset.db]
+        if not queryset.query.where and connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT reltuples FROM pg_class WHERE relname = %s', [queryset.model._meta.db_table])
+                row = cursor.fetchone()
+            if row and row[0] >= APPROX_COUNT_LIMIT:
+                return int(row[0])
+        return queryset.order_by()[:APPROX_COUNT_LIMIT].count()
+
+
+class LargeTableAdmin(admin.ModelAdmin):
+    """Changelist settings for tables that grow without bound"""
+    paginator = ApproximateCountPaginator
+    show_full_result_count = False
+
 
 @admin.register(Room)
 class RoomAdmin(admin.ModelAdmin):
-    list_display = ('id', 'name', 'key', 'creator', 'created_at')
-    filter_horizontal = ('members',)
+    list_display = ('id', 'name', 'key', 'creator', 'created_at', 'deleted_at')
+    list_select_related = ('creator',)
+    list_filter = ('deleted_at',)
+    search_fields = ('name', 'key')
+    # Large rooms have thousands of members; don't render them all in a select widget
+    raw_id_fields = ('creator', 'members')
+
+    def get_queryset(self, request):
+        # Rooms waiting for their purge stay visible to staff
+        return Room.all_objects.all()
+
+
+@admin.register(RoomBan)
+class RoomBanAdmin(admin.ModelAdmin):
+    list_display = ('room', 'user', 'banned_by', 'created_at')
+    list_select_related = ('room', 'user', 'banned_by')
+    search_fields = ('room__name', 'user__username')
+    raw_id_fields = ('room', 'user', 'banned_by')
 
 
 @admin.register(Message)
-class MessageAdmin(admin.ModelAdmin):
+class MessageAdmin(LargeTableAdmin):
     list_display = ('id', 'user_name', 'user', 'room', 'created_at')
+    list_select_related = ('user', 'room')
+    date_hierarchy = 'created_at'
+    autocomplete_fields = ('room', 'user')
+
+
+@admin.register(RoomHourlyActivity)
+class RoomHourlyActivityAdmin(LargeTableAdmin):
+    list_display = ('hour', 'room', 'message_count', 'chart')
+    list_select_related = ('room',)
+    date_hierarchy = 'hour'
+    search_fields = ('room__name',)
+    readonly_fields = ('room', 'hour', 'message_count')
+
+    @admin.display(description='Activity')
+    def chart(self, obj):
+        # One pixel per message, capped so busy hours stay on screen
+        return format_html('<div style="background:#79aec8;height:10px;width:{}px"></div>', min(obj.message_count, 400))
 
 
 @admin.register(Feedback)
 class FeedbackAdmin(admin.ModelAdmin):
     list_display = ('id', 'user', 'user_name', 'user_email', 'content', 'created_at')
+    list_select_related = ('user',)
     list_filter = ('created_at',)
     search_fields = ('user__username', 'user_name', 'user_email', 'content')
 
 
 @admin.register(LoginLog)
-class LoginLogAdmin(admin.ModelAdmin):
+class LoginLogAdmin(LargeTableAdmin):
     list_display = ('id', 'user', 'ip_address', 'device_id', 'user_agent', 'logged_at')
-    list_filter = ('logged_at', 'user')
+    list_select_related = ('user',)
+    # Filtering by user is done through search; a user sidebar would list every account
+    list_filter = ('logged_at',)
+    date_hierarchy = 'logged_at'
     search_fields = ('user__username', 'ip_address', 'device_id')
     readonly_fields = ('user', 'ip_address', 'device_id', 'user_agent', 'logged_at')
-
-
@@ -0,0 +1,50 @@
+import asyncio
+import logging
+
+from asgiref.sync import SyncToAsync
+from django.conf import settings
+
+from .dbpool import db_pool
+from .loopmonitor import loop_monitor
+
+logger = logging.getLogger('chat')
+
+# WebSocket close code for refused connects (4000-4999 are application defined);
+# the client is told how long to wait in an 'overloaded' frame sent just before
+OVERLOADED_CLOSE_CODE = 4503
+
+
+class AdmissionController:
+    """Tracks how saturated this process is: event-loop lag, open sockets and threadpool backlog"""
+
+    def __init__(self):
+        self.open_sockets = 0
+
+    def threadpool_queue_depth(self):
+        """Number of sync_to_async and DB pool calls waiting for a worker thread"""
+        executors = [SyncToAsync.single_thread_executor]
+        try:
+            executors.append(getattr(asyncio.get_running_loop(), '_default_executor', None))
+        except RuntimeError:
+            pass
+        depth = db_pool.queue_depth()
+        for executor in executors:
+            queue = getattr(executor, '_work_queue', None)
+            if queue is not None:
+                depth += queue.qsize()
+        return depth
+
+    def overload_reason(self, include_sockets=True):
+        """Return why new work should be refused, or None when there is headroom"""
+        if not settings.ADMISSION_ENABLED:
+            return None
+        if include_sockets and self.open_sockets >= settings.ADMISSION_MAX_SOCKETS:
+            return 'sockets'
+        if loop_monitor.loop_lag >= settings.ADMISSION_MAX_LOOP_LAG:
+            return 'loop_lag'
+        if self.threadpool_queue_depth() >= settings.ADMISSION_MAX_THREADPOOL_QUEUE:
+            return 'threadpool'
+        return None
+
+
+admission = AdmissionController()
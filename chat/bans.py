@@ -0,0 +1,92 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from .models import RoomBan
+
+logger = logging.getLogger('chat')
+
+# Close code for sockets of a member who was kicked or banned
+MEMBER_REMOVED_CLOSE_CODE = 4403
+
+
+def member_group(room_id, user_id):
+    """Channel group holding one user's sockets in one room"""
+    return f'room_{room_id}_user_{user_id}'
+
+
+class RoomBanCache:
+    """Per-room sets of banned user ids, so checks on join/connect/receive are a set lookup.
+
+    Each set is loaded with one query on first use and kept for ROOM_BAN_CACHE_TTL
+    seconds. Ban changes drop the set in this process at once; other workers see
+    them within the TTL, and live sockets are evicted through the channel layer
+    regardless.
+    """
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self._rooms = OrderedDict()
+        self._lock = threading.Lock()
+
+    def cached(self, room_id):
+        """The banned ids of a room if they are in memory, else None"""
+        key = str(room_id)
+        with self._lock:
+            entry = self._rooms.get(key)
+            if entry is None:
+                return None
+            expires, banned = entry
+            if expires <= time.monotonic():
+                del self._rooms[key]
+                return None
+            self._rooms.move_to_end(key)
+            return banned
+
+    def load(self, room_id):
+        """The banned ids of a room, reading them from the database on a miss"""
+        banned = self.cached(room_id)
+        if banned is not None:
+            return banned
+        banned = frozenset(str(user_id) for user_id in RoomBan.objects.filter(room_id=room_id).values_list('user_id', flat=True))
+        with self._lock:
+            self._rooms[str(room_id)] = (time.monotonic() + self.ttl, banned)
+            self._rooms.move_to_end(str(room_id))
+            while len(self._rooms) > self.size:
+                self._rooms.popitem(last=False)
+        return banned
+
+    def invalidate(self, room_id):
+        with self._lock:
+            self._rooms.pop(str(room_id), None)
+
+
+_room_bans = None
+
+
+def room_bans():
+    global _room_bans
+    if _room_bans is None:
+        _room_bans = RoomBanCache(settings.ROOM_BAN_CACHE_SIZE, settings.ROOM_BAN_CACHE_TTL)
+    return _room_bans
+
+
+def is_banned(room_id, user_id):
+    return str(user_id) in room_bans().load(room_id)
+
+
+def evict_member(room_id, user_id, reason):
+    """Close the user's open sockets in the room, on whichever worker holds them"""
+    try:
+        async_to_sync(get_channel_layer().group_send)(
+            member_group(room_id, user_id),
+            {'type': 'member.removed', 'room_id': room_id, 'reason': reason},
+        )
+    except Exception as e:
+        logger.error(f"Evicting user {user_id} from room_{room_id} failed: {e}")
@@ -0,0 +1,208 @@
+import contextlib
+import random
+import statistics
+import time
+from datetime import timedelta
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.db import connection, transaction
+from django.db.models import Count
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import URLPattern, reverse
+from django.utils import timezone
+
+from .models import LoginLog, Message, Room
+from .rollups import rebuild_rollups
+from .signals import refresh_members
+
+BENCH_PREFIX = 'bench_'
+BENCH_PASSWORD = 'benchmark'
+
+WORDS = ('hey', 'anyone', 'around', 'lunch', 'deploy', 'is', 'the', 'build', 'green', 'ok', 'thanks', 'see', 'you',
+         'tomorrow', 'meeting', 'moved', 'to', '3pm', 'lol', 'nice', 'ship', 'it', 'back', 'in', '5')
+
+
+@contextlib.contextmanager
+def explicit_timestamps(*fields):
+    """Let bulk_create keep timestamps set on the objects instead of auto_now_add's 'now'"""
+    previous = [field.auto_now_add for field in fields]
+    for field in fields:
+        field.auto_now_add = False
+    try:
+        yield
+    finally:
+        for field, value in zip(fields, previous):
+            field.auto_now_add = value
+
+
+def dataset_for(messages):
+    """Users, rooms and logins that go with a message count, so every table grows together"""
+    return {
+        'users': max(20, messages // 200),
+        'rooms': max(5, messages // 2000),
+        'messages': messages,
+        'logins': max(20, messages // 50),
+    }
+
+
+def seed(users=0, rooms=0, messages=0, logins=0, members_per_room=20, days=30, batch_size=10000, rng=None):
+    """Add benchmark rows on top of what is already there.
+
+    Message traffic is skewed (room n gets ~1/n of it) and spread over the last
+    `days` days. Signals don't run for bulk inserts, so the activity rollups for
+    that window are rebuilt at the end.
+    """
+    rng = rng or random.Random(0)
+    User = get_user_model()
+    now = timezone.now()
+    since = now - timedelta(days=days)
+
+    def spread():
+        return since + timedelta(seconds=rng.uniform(0, days * 86400))
+
+    start = User.objects.filter(username__startswith=BENCH_PREFIX).count()
+    password = make_password(BENCH_PASSWORD)
+    User.objects.bulk_create(
+        (User(username=f'{BENCH_PREFIX}{n}', email=f'{BENCH_PREFIX}{n}@example.com', password=password,
+              first_name='Bench', last_name=str(n)) for n in range(start, start + users)),
+        batch_size=batch_size,
+    )
+    user_ids = list(User.objects.filter(username__startswith=BENCH_PREFIX).order_by('id').values_list('id', flat=True))
+
+    start = Room.objects.filter(name__startswith=BENCH_PREFIX).count()
+    new_rooms = Room.objects.bulk_create(
+        (Room(name=f'{BENCH_PREFIX}{n}', key=f'B{n:07d}', creator_id=rng.choice(user_ids)) for n in range(start, start + rooms)),
+        batch_size=batch_size,
+    )
+    Membership = Room.members.through
+    Membership.objects.bulk_create(
+        (Membership(room_id=room.id, user_id=user_id)
+         for room in new_rooms
+         for user_id in {room.creator_id, *rng.sample(user_ids, min(members_per_room, len(user_ids)))}),
+        batch_size=batch_size,
+    )
+    # bulk_create skips m2m_changed, so the cached counts are refreshed here
+    refresh_members([room.id for room in new_rooms])
+    room_ids = list(Room.objects.filter(name__startswith=BENCH_PREFIX).order_by('id').values_list('id', flat=True))
+    weights = [1 / rank for rank in range(1, len(room_ids) + 1)]
+
+    created_at = Message._meta.get_field('created_at')
+    logged_at = LoginLog._meta.get_field('logged_at')
+    with explicit_timestamps(created_at, logged_at):
+        for offset in range(0, messages, batch_size):
+            count = min(batch_size, messages - offset)
+            senders = rng.choices(user_ids, k=count)
+            Message.objects.bulk_create(
+                Message(room_id=room_id, user_id=sender, user_name=f'{BENCH_PREFIX}{sender}',
+                        content=' '.join(rng.choices(WORDS, k=rng.randint(2, 20))), created_at=spread())
+                for room_id, sender in zip(rng.choices(room_ids, weights=weights, k=count), senders)
+            )
+        LoginLog.objects.bulk_create(
+            (LoginLog(user_id=rng.choice(user_ids), ip_address=f'10.0.{rng.randint(0, 255)}.{rng.randint(1, 254)}',
+                      user_agent='Mozilla/5.0 (benchmark)', device_id=f'device-{rng.randint(0, 9999)}', logged_at=spread())
+             for _ in range(logins)),
+            batch_size=batch_size,
+        )
+    if messages:
+        rebuild_rollups(since.replace(hour=0, minute=0, second=0, microsecond=0), now + timedelta(days=1))
+    return {'users': users, 'rooms': rooms, 'messages': messages, 'logins': logins}
+
+
+def benchmark_context():
+    """The busiest benchmark room, its creator, another member and a staff user"""
+    User = get_user_model()
+    room = (
+        Room.objects.filter(name__startswith=BENCH_PREFIX)
+        .annotate(n=Count('messages')).order_by('-n').first()
+    )
+    member = room.members.exclude(id=room.creator_id).order_by('id').first()
+    staff, _ = User.objects.get_or_create(username=f'{BENCH_PREFIX}staff', defaults={'is_staff': True})
+    return {'room': room, 'user': room.creator, 'member': member, 'staff': staff}
+
+
+def route_requests(ctx):
+    """One representative request per URL name: (method, url kwargs, data, needs staff)"""
+    room, user, member = ctx['room'], ctx['user'], ctx['member']
+    r = {'room_id': room.id}
+    return {
+        'bootstrap': ('get', {}, {'user_id': user.id}, False),
+        'rooms-list': ('get', {}, {'user_id': user.id}, False),
+        'rooms-join': ('post', {}, {'room_key': room.key, 'user_id': member.id}, False),
+        'rooms-stats': ('get', {}, {'user_id': user.id}, False),
+        'room-detail': ('get', r, {}, False),
+        'room-members': ('get', r, {'search': BENCH_PREFIX}, False),
+        'room-messages': ('get', r, {}, False),
+        'room-stats': ('get', r, {'days': 30}, False),
+        'room-leave': ('post', r, {'user_id': member.id}, False),
+        'room-delete': ('delete', r, {'user_id': user.id}, False),
+        'room-rename': ('post', r, {'name': 'Renamed', 'user_id': user.id}, False),
+        'room-kick': ('post', r, {'target_user_id': member.id, 'performer_id': user.id}, False),
+        'room-ban': ('post', r, {'target_user_id': member.id, 'performer_id': user.id}, False),
+        'auth-register': ('post', {}, {'username': f'{BENCH_PREFIX}new', 'password': BENCH_PASSWORD,
+                                       'email': f'{BENCH_PREFIX}new@example.com'}, False),
+        'auth-login': ('post', {}, {'username': user.username, 'password': BENCH_PASSWORD}, False),
+        'auth-profile': ('put', {}, {'user_id': user.id, 'first_name': 'Renamed'}, False),
+        'feedback-create': ('post', {}, {'user_id': user.id, 'content': 'benchmark feedback'}, False),
+        'debug-loop': ('get', {}, {}, True),
+        'debug-metrics': ('get', {}, {}, True),
+    }
+
+
+def chat_route_names():
+    from . import urls
+    return [pattern.name for pattern in urls.urlpatterns if isinstance(pattern, URLPattern)]
+
+
+def run_routes(ctx, repeat=10):
+    """Time every chat route; each request runs in a transaction that is rolled back"""
+    requests = route_requests(ctx)
+    missing = sorted(set(chat_route_names()) - set(requests))
+    if missing:
+        raise ValueError(f'No benchmark request for routes: {", ".join(missing)}')
+
+    anonymous, staff = Client(), Client()
+    staff.force_login(ctx['staff'])
+    results = {}
+    for name, (method, kwargs, data, needs_staff) in requests.items():
+        client = staff if needs_staff else anonymous
+        url = reverse(name, kwargs=kwargs)
+        timings = []
+        # The first round warms caches and is not counted
+        for _ in range(repeat + 1):
+            with transaction.atomic():
+                with CaptureQueriesContext(connection) as queries:
+                    started = time.perf_counter()
+                    if method == 'get':
+                        response = client.get(url, data)
+                    else:
+                        response = getattr(client, method)(url, data, content_type='application/json')
+                    timings.append(time.perf_counter() - started)
+                transaction.set_rollback(True)
+        timings = sorted(timings[1:])
+        results[name] = {
+            'status': response.status_code,
+            'median_ms': round(statistics.median(timings) * 1000, 3),
+            'p95_ms': round(timings[min(len(timings) - 1, int(len(timings) * 0.95))] * 1000, 3),
+            'queries': len(queries),
+        }
+    return results
+
+
+def compare_to_baseline(results, baseline, tolerance=0.5, slack_ms=5.0):
+    """Regressions of results against a saved baseline: more queries, or a slower median
+    beyond `tolerance` (relative) plus `slack_ms` (absolute, absorbs timer noise)"""
+    failures = []
+    for key, result in sorted(results.items()):
+        base = baseline.get(key)
+        if base is None:
+            continue
+        if result['status'] != base['status']:
+            failures.append(f'{key}: status {base["status"]} -> {result["status"]}')
+        if result['queries'] > base['queries']:
+            failures.append(f'{key}: {base["queries"]} -> {result["queries"]} queries')
+        limit = base['median_ms'] * (1 + tolerance) + slack_ms
+        if result['median_ms'] > limit:
+            failures.append(f'{key}: median {base["median_ms"]}ms -> {result["median_ms"]}ms (limit {limit:.1f}ms)')
+    return failures
@@ -0,0 +1,69 @@
+from django.conf import settings
+from django.db.models import F, OuterRef, Q, Subquery, Window
+from django.db.models.functions import RowNumber
+
+from .models import Message, Room
+from .presence import get_presence_store
+from .serializers import MessageSerializer
+
+
+def user_rooms(user_id):
+    """Rooms the user created or joined, most recently active first"""
+    membership = Room.members.through.objects.filter(user_id=user_id).values('room_id')
+    last_message = Message.objects.filter(room_id=OuterRef('pk')).order_by('-created_at', '-id').values('created_at')[:1]
+    # Membership is matched with a subquery so no join can duplicate rooms
+    return (
+        Room.objects.filter(Q(creator_id=user_id) | Q(pk__in=membership))
+        .annotate(last_message_at=Subquery(last_message))
+        .order_by(F('last_message_at').desc(nulls_last=True), '-created_at')
+    )
+
+
+def recent_since(per_room):
+    """Annotation for a room: created_at of its per_room-th newest message (None if it has fewer)"""
+    newest = Message.objects.filter(room_id=OuterRef('pk')).order_by('-created_at', '-id').values('created_at')
+    return Subquery(newest[per_room - 1:per_room])
+
+
+def recent_messages(room_ids, per_room, since):
+    """The latest per_room messages of each room, oldest first, in one windowed query.
+
+    `since` maps each room to its recent_since() value, so the window only
+    numbers each room's last few rows instead of its whole history.
+    """
+    rooms = Q()
+    for room_id in room_ids:
+        rooms |= Q(room_id=room_id, created_at__gte=since[room_id]) if since.get(room_id) else Q(room_id=room_id)
+    rows = (
+        Message.objects.filter(rooms)
+        .annotate(position=Window(RowNumber(), partition_by=F('room_id'), order_by=[F('created_at').desc(), F('id').desc()]))
+        .filter(position__lte=per_room)
+        .order_by('room_id', 'created_at', 'id')
+    )
+    by_room = {room_id: [] for room_id in room_ids}
+    for message in rows:
+        by_room[message.room_id].append(message)
+    return {room_id: MessageSerializer(messages, many=True).data for room_id, messages in by_room.items()}
+
+
+def build_bootstrap(user_id, max_rooms):
+    """Everything the client needs at launch, in two queries plus presence lookups"""
+    per_room = settings.BOOTSTRAP_RECENT_MESSAGES
+    rooms = list(
+        user_rooms(user_id).annotate(recent_since=recent_since(per_room))
+        .values('id', 'name', 'key', 'creator_id', 'created_at', 'member_count', 'last_message_at', 'recent_since')
+    )
+    since = {room['id']: room.pop('recent_since') for room in rooms}
+    top_ids = [room['id'] for room in rooms[:settings.BOOTSTRAP_TOP_ROOMS]]
+    created = sum(1 for room in rooms if room['creator_id'] == user_id)
+    return {
+        'user_id': user_id,
+        'rooms': rooms,
+        'recent_messages': recent_messages(top_ids, per_room, since) if top_ids else {},
+        'presence': get_presence_store().online_user_ids(top_ids) if top_ids else {},
+        'limits': {
+            'created_rooms_count': created,
+            'max_rooms': max_rooms,
+            'can_create': created < max_rooms,
+        },
+    }
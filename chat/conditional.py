@@ -0,0 +1,63 @@
+from django.db.models import OuterRef, Subquery
+from django.utils.decorators import method_decorator
+from django.views.decorators.http import condition
+
+from .models import Message, Room
+
+
+def room_state(request, room_id):
+    """Version, last message id and last-change time of a live room, in one query.
+
+    Memoized on the request because condition() asks for the ETag and the
+    Last-Modified date separately. None if the room doesn't exist.
+    """
+    cache = request.__dict__.setdefault('_room_state', {})
+    if room_id not in cache:
+        last_message = Message.objects.filter(room_id=OuterRef('pk')).order_by('-created_at', '-id')
+        cache[room_id] = (
+            Room.objects.filter(pk=room_id)
+            .annotate(
+                last_message_id=Subquery(last_message.values('id')[:1]),
+                last_message_at=Subquery(last_message.values('created_at')[:1]),
+            )
+            .values('updated_at', 'last_message_id', 'last_message_at')
+            .first()
+        )
+    return cache[room_id]
+
+
+def _last_modified(state, include_room):
+    times = [state['last_message_at']]
+    if include_room:
+        times.append(state['updated_at'])
+    times = [t for t in times if t is not None]
+    return max(times) if times else None
+
+
+def room_etag(request, room_id, *args, **kwargs):
+    state = room_state(request, room_id)
+    if state is None:
+        return None
+    return f'W/"room-{room_id}-{state["updated_at"].timestamp():.6f}-{state["last_message_id"] or 0}"'
+
+
+def room_last_modified(request, room_id, *args, **kwargs):
+    state = room_state(request, room_id)
+    return state and _last_modified(state, include_room=True)
+
+
+def messages_etag(request, room_id, *args, **kwargs):
+    state = room_state(request, room_id)
+    if state is None:
+        return None
+    return f'W/"messages-{room_id}-{state["last_message_id"] or 0}"'
+
+
+def messages_last_modified(request, room_id, *args, **kwargs):
+    state = room_state(request, room_id)
+    return state and _last_modified(state, include_room=False)
+
+
+# Apply to a view's get(): unchanged resources are answered with 304 before any serialization
+conditional_room = method_decorator(condition(etag_func=room_etag, last_modified_func=room_last_modified), name='get')
+conditional_messages = method_decorator(condition(etag_func=messages_etag, last_modified_func=messages_last_modified), name='get')
@@ -1,107 +1,180 @@
 import json
 import logging
 import asyncio
+import time
 from channels.generic.websocket import AsyncWebsocketConsumer
-from asgiref.sync import sync_to_async
-from .models import Room, Message
+from .models import Room
+from .idempotency import clean_client_msg_id, create_message_once, find_resent
+from .admission import admission, OVERLOADED_CLOSE_CODE
+from .bans import MEMBER_REMOVED_CLOSE_CODE, member_group, room_bans
+from .dbpool import db_sync_to_async
+from .drain import drainer, send_reconnect
+from .loopmonitor import loop_monitor
+from .metrics import RateMeter
+from .outbound import QueuedSendMixin
+from .workers import metrics_publisher
+from .presence import get_presence_store
+from .routers import new_routing_state
+from .tracing import continue_trace, span, start_trace
+from django.conf import settings
 from django.core.cache import cache
 from datetime import datetime, timedelta
+from urllib.parse import parse_qs
 
 logger = logging.getLogger('chat')
 
-# In-memory storage for online users per room (room_id -> set of user_ids)
-# For production with multiple servers, use Redis instead
-ONLINE_USERS = {}
+# Each room gets one local flush task that broadcasts a single aggregated
+# "who is typing" frame per interval instead of one frame per keystroke
+TYPING_FLUSH_TASKS = {}
 
+# Close code sent when the room is deleted while sockets are still open
+ROOM_DELETED_CLOSE_CODE = 4410
 
-class ChatConsumer(AsyncWebsocketConsumer):
-    async def connect(self):
-        self.room_id = self.scope['url_route']['kwargs']['room_id']
-        self.group_name = f'room_{self.room_id}' 
-        self.presence_group = f'presence_{self.room_id}'
+# Close code for a room socket whose room id is not a number
+INVALID_ROOM_CLOSE_CODE = 4404
+
+
+def room_is_deleted(room_id):
+    return Room.all_objects.filter(id=room_id, deleted_at__isnull=False).exists()
+
+
+def get_live_room(room_id):
+    """Fetch (or create) the room a message is posted to; None if it was deleted"""
+    room = Room.all_objects.filter(id=room_id).first()
+    if room is None:
+        room, _ = Room.objects.get_or_create(id=room_id, defaults={'name': f'Room {room_id}'})
+    return None if room.deleted_at else room
+
+
+async def flush_typing(channel_layer, room_id, group_name):
+    """Broadcast the aggregated typing state of a room once per interval while it changes"""
+    store = get_presence_store()
+    interval = settings.TYPING_BROADCAST_INTERVAL
+    last_sent = []
+    try:
+        while True:
+            await asyncio.sleep(interval)
+            users = await store.typing_users(room_id)
+            # With several workers only the one holding this interval's claim broadcasts
+            if users != last_sent and await store.claim_typing_flush(room_id, interval):
+                await channel_layer.group_send(
+                    group_name,
+                    {
+                        'type': 'typing.update',
+                        'room_id': room_id,
+                        'data': {
+                            'type': 'typing',
+                            'users': users,
+                            'timestamp': datetime.now().isoformat()
+                        }
+                    }
+                )
+                last_sent = users
+            if not users:
+                break
+    finally:
+        TYPING_FLUSH_TASKS.pop(room_id, None)
+
+
+class RoomSession:
+    """One connection's state in one room: groups, identity, presence and typing.
+
+    ChatConsumer has a single session; UserConsumer keeps one per subscribed room.
+    """
+
+    def __init__(self, consumer, room_id):
+        self.consumer = consumer
+        self.room_id = room_id
+        self.group_name = f'room_{room_id}'
+        self.presence_group = f'presence_{room_id}'
         self.user_id = None
         self.user_name = None
-        
-        await self.channel_layer.group_add(self.group_name, self.channel_name)
-        await self.channel_layer.group_add(self.presence_group, self.channel_name)
-        await self.accept()
-        
-        # log origin header if present to diagnose origin issues
-        origin = None
-        try:
-            for (k, v) in self.scope.get('headers', []):
-                if k == b'origin':
-                    origin = v.decode()
-                    break
-        except Exception:
-            origin = None
-        logger.info(f"WebSocket connected: {self.channel_name} room={self.room_id} origin={origin}")
+        self.last_typing_at = 0.0
+        self.member_group = None
 
-    async def disconnect(self, close_code):
-        # Remove user from online users when they disconnect
+    @property
+    def channel_layer(self):
+        return self.consumer.channel_layer
+
+    async def join(self):
+        await self.channel_layer.group_add(self.group_name, self.consumer.channel_name)
+        await self.channel_layer.group_add(self.presence_group, self.consumer.channel_name)
+
+    async def leave(self):
+        """Go offline in the room and drop every group of this room"""
         if self.user_id:
+            await self.set_typing(False)
             await self.remove_user_from_presence()
-        
-        await self.channel_layer.group_discard(self.group_name, self.channel_name)
-        await self.channel_layer.group_discard(self.presence_group, self.channel_name)
-        logger.info(f"WebSocket disconnected: {self.channel_name} room={self.room_id} code={close_code}")
+        await self.channel_layer.group_discard(self.group_name, self.consumer.channel_name)
+        await self.channel_layer.group_discard(self.presence_group, self.consumer.channel_name)
+        if self.member_group:
+            await self.channel_layer.group_discard(self.member_group, self.consumer.channel_name)
 
-    async def receive(self, text_data=None, bytes_data=None):
-        try:
-            data = json.loads(text_data)
-        except Exception:
-            return
-        
-        message_type = data.get('type')
-        
-        # Handle ping/pong for keepalive
-        if message_type == 'ping':
-            await self.send(text_data=json.dumps({'type': 'pong'}))
-            return
-        
-        # Handle user presence announcement (when user first connects)
-        if message_type == 'user_connected':
-            user_id = data.get('user_id')
-            user_name = data.get('user_name') or data.get('user') or 'Anonymous'
-            if user_id:
-                self.user_id = str(user_id)
-                self.user_name = user_name
-                await self.add_user_to_presence()
-            return
-        
-        # Handle heartbeat to keep user online
-        if message_type == 'heartbeat':
-            if self.user_id:
-                await self.update_user_heartbeat()
-            return
-            
+    async def is_banned(self, user_id):
+        # Only the first check per room (and TTL) touches the database
+        banned = room_bans().cached(self.room_id)
+        if banned is None:
+            banned = await db_sync_to_async(room_bans().load)(self.room_id)
+        return str(user_id) in banned
+
+    async def identify(self, user_id, user_name):
+        """Attach a user to this room; returns False if they are banned from it"""
+        if await self.is_banned(user_id):
+            return False
+        self.user_id = str(user_id)
+        self.user_name = user_name
+        # Kicks and bans reach this user's sockets through their own group
+        if self.user_id.isdigit():
+            self.member_group = member_group(self.room_id, self.user_id)
+            await self.channel_layer.group_add(self.member_group, self.consumer.channel_name)
+        await self.add_user_to_presence()
+        return True
+
+    async def post(self, data, trace):
+        """Store and broadcast a chat message frame.
+
+        Returns (outcome, message), outcome being 'created', 'duplicate',
+        'banned' or 'deleted'.
+        """
         user = data.get('user') or data.get('user_name') or 'anonymous'
         user_id = data.get('user_id') or data.get('userId')
         content = data.get('content') or data.get('text') or ''
-        
+        client_msg_id = clean_client_msg_id(data.get('client_msg_id'))
+
         # If this is the first message from this user, track their presence
         if user_id and not self.user_id:
-            self.user_id = str(user_id)
-            self.user_name = user
-            await self.add_user_to_presence()
+            if not await self.identify(user_id, user):
+                return 'banned', None
+        elif user_id and await self.is_banned(user_id):
+            return 'banned', None
+
+        # Sending a message ends the typing state
+        if self.user_id:
+            await self.set_typing(False)
+
+        # A resend of a message we just stored is only acknowledged again
+        resent = find_resent(self.room_id, user_id, user, client_msg_id)
+        if resent is not None:
+            return 'duplicate', resent
 
         # Save to DB: ensure we fetch/create room, then create message with room instance
-        room_obj_tuple = await sync_to_async(Room.objects.get_or_create)(id=self.room_id, defaults={'name': f'Room {self.room_id}'})
-        room_obj = room_obj_tuple[0]
+        with span(trace, 'room_lookup'):
+            room_obj = await db_sync_to_async(get_live_room)(self.room_id)
+        if room_obj is None:
+            return 'deleted', None
         user_obj = None
         if user_id:
             from django.contrib.auth import get_user_model
             User = get_user_model()
             try:
-                user_obj = await sync_to_async(User.objects.get)(id=user_id)
+                with span(trace, 'user_lookup'):
+                    user_obj = await db_sync_to_async(User.objects.get)(id=user_id)
             except Exception:
                 user_obj = None
-        message = await sync_to_async(Message.objects.create)(
-            room=room_obj,
-            user_name=user,
-            user=user_obj,
-            content=content,
-        )
+        with span(trace, 'insert'):
+            message, created = await db_sync_to_async(create_message_once)(room_obj, user_obj, user, content, client_msg_id, user_id)
+        if not created:
+            return 'duplicate', message
 
         # Broadcast message
         payload = {
@@ -111,46 +184,55 @@ class ChatConsumer(AsyncWebsocketConsumer):
             'user_id': message.user.id if message.user else None,
             'content': message.content,
             'created_at': message.created_at.isoformat(),
+            'client_msg_id': message.client_msg_id,
         }
 
-        await self.channel_layer.group_send(
-            self.group_name,
-            {'type': 'chat.message', 'message': payload},
-        )
+        event = {'type': 'chat.message', 'room_id': self.room_id, 'message': payload}
+        if trace:
+            event['trace'] = trace.context()
+        with span(trace, 'group_send'):
+            await self.channel_layer.group_send(self.group_name, event)
+        if trace:
+            trace.finish(message_id=message.id)
+        return 'created', message
+
+    async def set_typing(self, is_typing):
+        """Record typing state for this user; repeats within the interval are ignored"""
+        store = get_presence_store()
+        if not is_typing:
+            if self.last_typing_at:
+                self.last_typing_at = 0.0
+                await store.clear_typing(self.room_id, self.user_id)
+            return
+
+        now = time.monotonic()
+        if now - self.last_typing_at < settings.TYPING_BROADCAST_INTERVAL:
+            return
+        self.last_typing_at = now
+
+        await store.set_typing(self.room_id, self.user_id, self.user_name, settings.TYPING_TIMEOUT)
+        if self.room_id not in TYPING_FLUSH_TASKS:
+            TYPING_FLUSH_TASKS[self.room_id] = asyncio.ensure_future(
+                flush_typing(self.channel_layer, self.room_id, self.presence_group)
+            )
 
-    async def chat_message(self, event):
-        """Handle incoming chat messages"""
-        message = event['message']
-        await self.send(text_data=json.dumps(message))
-    
-    async def presence_update(self, event):
-        """Handle presence update events"""
-        await self.send(text_data=json.dumps(event['data']))
-    
     async def add_user_to_presence(self):
         """Add user to online users list and broadcast join event"""
         if not self.user_id:
             return
             
         # Add to online users set
-        if self.room_id not in ONLINE_USERS:
-            ONLINE_USERS[self.room_id] = {}
-        
-        ONLINE_USERS[self.room_id][self.user_id] = {
-            'user_name': self.user_name,
-            'last_seen': datetime.now().isoformat()
-        }
+        online_user_ids = await get_presence_store().join(self.room_id, self.user_id, self.user_name)
         
-        # Get current online user IDs
-        online_user_ids = list(ONLINE_USERS[self.room_id].keys())
-        
-        logger.info(f"User {self.user_id} ({self.user_name}) joined room {self.room_id}. Online: {online_user_ids}")
+        # Log the count only: the id list is O(room size) to format on every join
+        logger.info('User joined room', extra={'event': 'presence.join', 'room': self.room_id, 'user': self.user_id, 'online': len(online_user_ids)})
         
         # Broadcast presence update to all users in the room
         await self.channel_layer.group_send(
             self.presence_group,
             {
                 'type': 'presence.update',
+                'room_id': self.room_id,
                 'data': {
                     'type': 'presence_update',
                     'event': 'user_joined',
@@ -164,27 +246,20 @@ class ChatConsumer(AsyncWebsocketConsumer):
     
     async def remove_user_from_presence(self):
         """Remove user from online users list and broadcast leave event"""
-        if not self.user_id or self.room_id not in ONLINE_USERS:
+        if not self.user_id:
             return
         
-        # Remove from online users
-        if self.user_id in ONLINE_USERS[self.room_id]:
-            del ONLINE_USERS[self.room_id][self.user_id]
-        
-        # Clean up empty room
-        if not ONLINE_USERS[self.room_id]:
-            del ONLINE_USERS[self.room_id]
+        # Remove from online users and get the remaining online user IDs
+        online_user_ids = await get_presence_store().leave(self.room_id, self.user_id)
         
-        # Get remaining online user IDs
-        online_user_ids = list(ONLINE_USERS.get(self.room_id, {}).keys())
-        
-        logger.info(f"User {self.user_id} ({self.user_name}) left room {self.room_id}. Online: {online_user_ids}")
+        logger.info('User left room', extra={'event': 'presence.leave', 'room': self.room_id, 'user': self.user_id, 'online': len(online_user_ids)})
         
         # Broadcast presence update
         await self.channel_layer.group_send(
             self.presence_group,
             {
                 'type': 'presence.update',
+                'room_id': self.room_id,
                 'data': {
                     'type': 'presence_update',
                     'event': 'user_left',
@@ -198,8 +273,408 @@ class ChatConsumer(AsyncWebsocketConsumer):
     
     async def update_user_heartbeat(self):
         """Update user's last seen timestamp"""
-        if not self.user_id or self.room_id not in ONLINE_USERS:
+        if not self.user_id:
+            return
+        
+        await get_presence_store().heartbeat(self.room_id, self.user_id)
+
+
+def ack_frame(message, duplicate=False):
+    """Confirms to the sender that a message with a client_msg_id is stored"""
+    return {
+        'type': 'ack',
+        'client_msg_id': message.client_msg_id,
+        'id': message.id,
+        'created_at': message.created_at.isoformat(),
+        'duplicate': duplicate,
+    }
+
+
+def request_origin(scope):
+    for (k, v) in scope.get('headers', []):
+        if k == b'origin':
+            return v.decode(errors='replace')
+    return None
+
+
+def client_capabilities(scope):
+    """Capabilities a client announced with ?capabilities=a,b"""
+    query = parse_qs(scope.get('query_string', b'').decode())
+    return {c for value in query.get('capabilities', []) for c in value.split(',')}
+
+
+class MessageBatcher:
+    """Outgoing messages of one room for one socket.
+
+    Quiet rooms (and clients without the 'batch' capability) get one frame per
+    message. Past BATCH_RATE_THRESHOLD messages per second, messages are held
+    for up to BATCH_WINDOW seconds or BATCH_MAX_MESSAGES and sent as one
+    {type: 'batch', messages} frame. `tags` are added to every frame sent.
+    Delivery traces end once the socket's writer has written their frame.
+    """
+
+    def __init__(self, consumer, enabled, **tags):
+        self.consumer = consumer
+        self.enabled = enabled
+        self.tags = tags
+        self.rate = RateMeter()
+        self.messages = []
+        self.traces = []
+        self._flush_task = None
+
+    async def send(self, data, traces, **span_attributes):
+        await self.consumer.send(text_data=json.dumps({**data, **self.tags}), traces=traces, span_attributes=span_attributes)
+
+    async def add(self, message, trace):
+        rate = self.rate.hit(time.monotonic())
+        if not self.enabled or (rate < settings.BATCH_RATE_THRESHOLD and not self.messages):
+            await self.send(message, [trace] if trace else [], message_id=message.get('id'))
+            return
+        self.messages.append(message)
+        if trace:
+            self.traces.append(trace)
+        if len(self.messages) >= settings.BATCH_MAX_MESSAGES:
+            await self.flush()
+        elif self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(settings.BATCH_WINDOW)
+        self._flush_task = None
+        await self.flush()
+
+    async def flush(self):
+        """Send held messages as a single frame"""
+        self.cancel()
+        messages, self.messages = self.messages, []
+        traces, self.traces = self.traces, []
+        if len(messages) == 1:
+            await self.send(messages[0], traces, batch_size=1)
+        elif messages:
+            await self.send({'type': 'batch', 'messages': messages}, traces, batch_size=len(messages))
+
+    def cancel(self):
+        if self._flush_task:
+            self._flush_task.cancel()
+            self._flush_task = None
+
+
+class ChatConsumer(QueuedSendMixin, AsyncWebsocketConsumer):
+    async def connect(self):
+        self.start_outbound()
+        self.room_id = self.scope['url_route']['kwargs']['room_id']
+        self.session = RoomSession(self, self.room_id)
+        self.admitted = False
+        self.outbox = MessageBatcher(self, 'batch' in client_capabilities(self.scope))
+
+        # Shed load before joining any groups; tell the client when to retry
+        loop_monitor.start()
+        metrics_publisher.start()
+        drainer.install()
+        if drainer.draining:
+            await self.accept()
+            await send_reconnect(self)
+            return
+        reason = admission.overload_reason()
+        if reason:
+            await self.accept()
+            await self.send(text_data=json.dumps({'type': 'overloaded', 'retry_after': settings.ADMISSION_RETRY_AFTER}))
+            await self.close(code=OVERLOADED_CLOSE_CODE)
+            logger.warning(f"WebSocket refused: room={self.room_id} reason={reason}")
+            return
+        if not str(self.room_id).isdigit():
+            await self.accept()
+            await self.send(text_data=json.dumps({'type': 'error', 'room_id': self.room_id, 'detail': 'Invalid room_id'}))
+            await self.close(code=INVALID_ROOM_CLOSE_CODE)
+            return
+        if await db_sync_to_async(room_is_deleted)(self.room_id):
+            await self.accept()
+            await self.send(text_data=json.dumps({'type': 'room_deleted', 'room_id': self.room_id}))
+            await self.close(code=ROOM_DELETED_CLOSE_CODE)
+            return
+        scope_user = self.scope.get('user')
+        if scope_user is not None and scope_user.is_authenticated and await self.session.is_banned(scope_user.id):
+            await self.accept()
+            await self.member_removed({'room_id': self.room_id, 'reason': 'banned'})
+            return
+        self.admitted = True
+        admission.open_sockets += 1
+        drainer.register(self)
+        # Reads made by this connection go to the replica unless it wrote recently
+        new_routing_state()
+        
+        await self.session.join()
+        await self.accept()
+        
+        # log origin header if present to diagnose origin issues
+        logger.info('WebSocket connected', extra={'event': 'ws.connect', 'room': self.room_id, 'channel': self.channel_name, 'origin': request_origin(self.scope)})
+
+    async def disconnect(self, close_code):
+        self.stop_outbound()
+        if not self.admitted:
+            return
+        admission.open_sockets -= 1
+        drainer.unregister(self)
+        self.outbox.cancel()
+
+        # Remove user from online users when they disconnect
+        await self.session.leave()
+        logger.info('WebSocket disconnected', extra={'event': 'ws.disconnect', 'room': self.room_id, 'channel': self.channel_name, 'code': close_code})
+
+    async def receive(self, text_data=None, bytes_data=None):
+        if not self.admitted:
+            return
+        # Sampled messages get a trace; it is only exported if the frame turns out to be a chat message
+        trace = start_trace('chat.receive', room=self.room_id)
+        try:
+            with span(trace, 'parse'):
+                data = json.loads(text_data)
+        except Exception:
+            return
+        
+        message_type = data.get('type')
+        
+        # Handle ping/pong for keepalive
+        if message_type == 'ping':
+            await self.send(text_data=json.dumps({'type': 'pong'}))
+            return
+        
+        # Handle user presence announcement (when user first connects)
+        if message_type == 'user_connected':
+            user_id = data.get('user_id')
+            user_name = data.get('user_name') or data.get('user') or 'Anonymous'
+            if user_id and not await self.session.identify(user_id, user_name):
+                await self.member_removed({'room_id': self.room_id, 'reason': 'banned'})
             return
         
-        if self.user_id in ONLINE_USERS[self.room_id]:
-            ONLINE_USERS[self.room_id][self.user_id]['last_seen'] = datetime.now().isoformat()
+        # Handle heartbeat to keep user online
+        if message_type == 'heartbeat':
+            await self.session.update_user_heartbeat()
+            return
+
+        # Handle typing indicator (ephemeral, never persisted)
+        if message_type == 'typing':
+            if self.session.user_id:
+                await self.session.set_typing(data.get('is_typing', True))
+            return
+
+        outcome, message = await self.session.post(data, trace)
+        if outcome == 'banned':
+            await self.member_removed({'room_id': self.room_id, 'reason': 'banned'})
+        elif outcome == 'deleted':
+            await self.room_deleted({'room_id': self.room_id})
+        elif outcome == 'duplicate':
+            await self.send(text_data=json.dumps(ack_frame(message, duplicate=True)))
+        elif message.client_msg_id:
+            await self.send(text_data=json.dumps(ack_frame(message)))
+
+    async def chat_message(self, event):
+        """Handle incoming chat messages"""
+        trace = continue_trace(event.get('trace'), 'chat.deliver', room=self.room_id, channel=self.channel_name)
+        await self.outbox.add(event['message'], trace)
+    
+    async def presence_update(self, event):
+        """Handle presence update events"""
+        # A queued presence or typing frame is superseded by the next one (policy 'coalesce')
+        await self.send(text_data=json.dumps(event['data']), coalesce_key='presence')
+    
+    async def typing_update(self, event):
+        """Handle aggregated typing events"""
+        await self.send(text_data=json.dumps(event['data']), coalesce_key='typing')
+
+    async def room_deleted(self, event):
+        """Tell the client its room is gone and drop the connection"""
+        await self.send(text_data=json.dumps({'type': 'room_deleted', 'room_id': event['room_id']}))
+        await self.close(code=ROOM_DELETED_CLOSE_CODE)
+
+    async def drain(self, delay):
+        """Worker shutdown: deliver held messages, then send the client away"""
+        await self.outbox.flush()
+        await send_reconnect(self, delay)
+
+    async def member_removed(self, event):
+        """The user was kicked or banned: say why and drop the connection"""
+        await self.send(text_data=json.dumps({'type': 'removed', 'room_id': event['room_id'], 'reason': event['reason']}))
+        await self.close(code=MEMBER_REMOVED_CLOSE_CODE)
+
+
+class UserConsumer(QueuedSendMixin, AsyncWebsocketConsumer):
+    """One socket per user for all of their rooms (ws/user/).
+
+    The client sends {type: 'subscribe'|'unsubscribe', room_id}; every frame in
+    either direction that concerns a room carries its room_id. Being kicked,
+    banned or having a room deleted only ends that room's subscription.
+    """
+
+    async def connect(self):
+        self.start_outbound()
+        self.sessions = {}
+        self.outboxes = {}
+        self.batching = 'batch' in client_capabilities(self.scope)
+        self.admitted = False
+        self.user_id = None
+        self.user_name = None
+
+        loop_monitor.start()
+        metrics_publisher.start()
+        drainer.install()
+        if drainer.draining:
+            await self.accept()
+            await send_reconnect(self)
+            return
+        reason = admission.overload_reason()
+        if reason:
+            await self.accept()
+            await self.send(text_data=json.dumps({'type': 'overloaded', 'retry_after': settings.ADMISSION_RETRY_AFTER}))
+            await self.close(code=OVERLOADED_CLOSE_CODE)
+            logger.warning(f"User WebSocket refused: reason={reason}")
+            return
+        scope_user = self.scope.get('user')
+        if scope_user is not None and scope_user.is_authenticated:
+            self.user_id = str(scope_user.id)
+            self.user_name = scope_user.get_full_name() or scope_user.username
+        self.admitted = True
+        admission.open_sockets += 1
+        drainer.register(self)
+        new_routing_state()
+        await self.accept()
+        logger.info('User WebSocket connected', extra={'event': 'ws.connect', 'channel': self.channel_name, 'origin': request_origin(self.scope)})
+
+    async def disconnect(self, close_code):
+        self.stop_outbound()
+        if not self.admitted:
+            return
+        admission.open_sockets -= 1
+        drainer.unregister(self)
+        for outbox in self.outboxes.values():
+            outbox.cancel()
+        self.outboxes.clear()
+        for session in list(self.sessions.values()):
+            await session.leave()
+        self.sessions.clear()
+        logger.info('User WebSocket disconnected', extra={'event': 'ws.disconnect', 'channel': self.channel_name, 'code': close_code})
+
+    async def send_json(self, data):
+        await self.send(text_data=json.dumps(data))
+
+    async def receive(self, text_data=None, bytes_data=None):
+        if not self.admitted:
+            return
+        trace = start_trace('chat.receive')
+        try:
+            with span(trace, 'parse'):
+                data = json.loads(text_data)
+        except Exception:
+            return
+
+        message_type = data.get('type')
+        if message_type == 'ping':
+            await self.send_json({'type': 'pong'})
+            return
+        if message_type == 'user_connected':
+            # Anonymous sockets name themselves once; rooms already followed are joined as them too
+            if not self.user_id and data.get('user_id'):
+                self.user_id = str(data['user_id'])
+                self.user_name = data.get('user_name') or data.get('user') or 'Anonymous'
+                for room_id, session in list(self.sessions.items()):
+                    if not await session.identify(self.user_id, self.user_name):
+                        await self.member_removed({'room_id': room_id, 'reason': 'banned'})
+            return
+        if message_type == 'heartbeat':
+            for session in self.sessions.values():
+                await session.update_user_heartbeat()
+            return
+
+        room_id = str(data.get('room_id') or '')
+        if message_type == 'subscribe':
+            await self.subscribe(room_id)
+            return
+        if message_type == 'unsubscribe':
+            await self.drop_room(room_id)
+            await self.send_json({'type': 'unsubscribed', 'room_id': room_id})
+            return
+
+        session = self.sessions.get(room_id)
+        if session is None:
+            await self.send_json({'type': 'error', 'room_id': room_id, 'detail': 'Not subscribed to this room'})
+            return
+        if message_type == 'typing':
+            if session.user_id:
+                await session.set_typing(data.get('is_typing', True))
+            return
+
+        if self.user_id:
+            # The socket's identity wins over whatever the frame claims
+            data = {**data, 'user_id': self.user_id, 'user_name': self.user_name}
+        outcome, message = await session.post(data, trace)
+        if outcome == 'banned':
+            await self.member_removed({'room_id': room_id, 'reason': 'banned'})
+        elif outcome == 'deleted':
+            await self.room_deleted({'room_id': room_id})
+        elif outcome == 'duplicate':
+            await self.send_json({**ack_frame(message, duplicate=True), 'room_id': room_id})
+        elif message.client_msg_id:
+            await self.send_json({**ack_frame(message), 'room_id': room_id})
+
+    async def subscribe(self, room_id):
+        if not room_id.isdigit():
+            await self.send_json({'type': 'error', 'room_id': room_id, 'detail': 'Invalid room_id'})
+            return
+        if room_id in self.sessions:
+            await self.send_json({'type': 'subscribed', 'room_id': room_id})
+            return
+        if len(self.sessions) >= settings.USER_SOCKET_MAX_ROOMS:
+            await self.send_json({'type': 'error', 'room_id': room_id, 'detail': 'Too many rooms on this socket'})
+            return
+        if await db_sync_to_async(room_is_deleted)(room_id):
+            await self.send_json({'type': 'room_deleted', 'room_id': room_id})
+            return
+        session = RoomSession(self, room_id)
+        await session.join()
+        if self.user_id and not await session.identify(self.user_id, self.user_name):
+            await session.leave()
+            await self.send_json({'type': 'removed', 'room_id': room_id, 'reason': 'banned'})
+            return
+        self.sessions[room_id] = session
+        self.outboxes[room_id] = MessageBatcher(self, self.batching, room_id=room_id)
+        await self.send_json({'type': 'subscribed', 'room_id': room_id})
+
+    async def drop_room(self, room_id):
+        outbox = self.outboxes.pop(str(room_id), None)
+        if outbox:
+            outbox.cancel()
+        session = self.sessions.pop(str(room_id), None)
+        if session:
+            await session.leave()
+
+    async def chat_message(self, event):
+        """Forward a room's message, tagged with the room; each room batches on its own"""
+        outbox = self.outboxes.get(event.get('room_id'))
+        if outbox is None:
+            return
+        trace = continue_trace(event.get('trace'), 'chat.deliver', room=event['room_id'], channel=self.channel_name)
+        await outbox.add(event['message'], trace)
+
+    async def presence_update(self, event):
+        if event.get('room_id') in self.sessions:
+            data = {**event['data'], 'room_id': event['room_id']}
+            await self.send(text_data=json.dumps(data), coalesce_key=('presence', event['room_id']))
+
+    async def typing_update(self, event):
+        if event.get('room_id') in self.sessions:
+            data = {**event['data'], 'room_id': event['room_id']}
+            await self.send(text_data=json.dumps(data), coalesce_key=('typing', event['room_id']))
+
+    async def room_deleted(self, event):
+        """Only this room's subscription ends; the socket stays open"""
+        await self.drop_room(event['room_id'])
+        await self.send_json({'type': 'room_deleted', 'room_id': str(event['room_id'])})
+
+    async def drain(self, delay):
+        for outbox in self.outboxes.values():
+            await outbox.flush()
+        await send_reconnect(self, delay)
+
+    async def member_removed(self, event):
+        await self.drop_room(event['room_id'])
+        await self.send_json({'type': 'removed', 'room_id': str(event['room_id']), 'reason': event['reason']})
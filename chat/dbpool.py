@@ -0,0 +1,80 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from channels.db import DatabaseSyncToAsync
+from django.conf import settings
+
+from .metrics import LatencyHistogram
+
+
+class DatabasePool:
+    """Bounded thread pool for consumer database work.
+
+    sync_to_async's default thread_sensitive=True funnels every query of every
+    socket through one thread. This pool runs them on DB_POOL_SIZE threads
+    instead; each thread keeps its own persistent connection (CONN_MAX_AGE),
+    recycled by close_old_connections around every call.
+    """
+
+    def __init__(self):
+        self._executor = None
+        self.in_flight = 0
+        self.wait_histogram = LatencyHistogram()
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=settings.DB_POOL_SIZE, thread_name_prefix='chat-db')
+        return self._executor
+
+    def queue_depth(self):
+        """Calls waiting for a free pool thread"""
+        if self._executor is None:
+            return 0
+        return self._executor._work_queue.qsize()
+
+    def snapshot(self):
+        return {
+            'size': settings.DB_POOL_SIZE,
+            'in_flight': self.in_flight,
+            'queue_depth': self.queue_depth(),
+            'wait_histogram': self.wait_histogram.snapshot(),
+        }
+
+
+db_pool = DatabasePool()
+
+
+def db_sync_to_async(func):
+    """Run a blocking ORM call from async code on the DB pool.
+
+    With DB_POOL_SIZE=0 (the SQLite default, which serializes writes anyway)
+    this is channels' thread-sensitive database_sync_to_async. Either way the
+    call counts in db_pool.in_flight until it returns.
+    """
+    if not settings.DB_POOL_SIZE:
+        run = DatabaseSyncToAsync(func)
+
+        async def run_in_thread(*args, **kwargs):
+            db_pool.in_flight += 1
+            try:
+                return await run(*args, **kwargs)
+            finally:
+                db_pool.in_flight -= 1
+
+        return run_in_thread
+
+    async def run_on_pool(*args, **kwargs):
+        queued_at = time.monotonic()
+
+        def call():
+            db_pool.wait_histogram.observe(time.monotonic() - queued_at)
+            return func(*args, **kwargs)
+
+        db_pool.in_flight += 1
+        try:
+            return await DatabaseSyncToAsync(call, thread_sensitive=False, executor=db_pool.executor)()
+        finally:
+            db_pool.in_flight -= 1
+
+    return run_on_pool
@@ -0,0 +1,100 @@
+import asyncio
+import json
+import logging
+import os
+import random
+import signal
+import weakref
+
+from django.conf import settings
+
+from .dbpool import db_pool
+
+logger = logging.getLogger('chat')
+
+# Standard WebSocket close code for "service restart": the client should reconnect
+RECONNECT_CLOSE_CODE = 1012
+
+
+def reconnect_delay():
+    """A delay hint spread over DRAIN_RECONNECT_WINDOW so clients come back as a ramp"""
+    return round(random.uniform(0, settings.DRAIN_RECONNECT_WINDOW), 3)
+
+
+async def send_reconnect(consumer, delay=None):
+    """Tell the client to come back after `delay` seconds and close its socket"""
+    delay = reconnect_delay() if delay is None else delay
+    await consumer.send(text_data=json.dumps({'type': 'reconnect', 'delay': delay}))
+    await consumer.close(code=RECONNECT_CLOSE_CODE)
+
+
+class Drainer:
+    """Graceful shutdown of this worker's sockets on SIGTERM.
+
+    SIGTERM puts the worker in drain mode: new sockets are turned away, every
+    open consumer flushes what it holds and is sent {type: 'reconnect', delay}
+    before being closed. Once the consumers are gone and the database pool has
+    finished their queries (or DRAIN_TIMEOUT passes) the signal is handed back to
+    the server's own handler, which exits.
+    """
+
+    def __init__(self):
+        self.draining = False
+        self.consumers = weakref.WeakSet()
+        self._loop = None
+        self._previous_handler = None
+        self._task = None
+
+    def install(self):
+        """Take over SIGTERM on the running loop (safe to call repeatedly)"""
+        loop = asyncio.get_running_loop()
+        if self._loop is loop:
+            return
+        previous = signal.getsignal(signal.SIGTERM)
+        try:
+            loop.add_signal_handler(signal.SIGTERM, self._on_sigterm)
+        except (NotImplementedError, RuntimeError, ValueError):
+            # Not the main thread (or no signal support): the server's default applies
+            return
+        self._loop = loop
+        self._previous_handler = previous
+
+    def register(self, consumer):
+        self.consumers.add(consumer)
+
+    def unregister(self, consumer):
+        self.consumers.discard(consumer)
+
+    def _on_sigterm(self):
+        if self.draining:
+            return
+        self.draining = True
+        self._task = asyncio.ensure_future(self._drain_and_exit())
+
+    async def drain(self):
+        """Ask every open consumer to reconnect elsewhere; wait for them to close and their queries to finish"""
+        self.draining = True
+        consumers = list(self.consumers)
+        logger.warning(f"Draining {len(consumers)} sockets before shutdown")
+        results = await asyncio.gather(*(consumer.drain(reconnect_delay()) for consumer in consumers), return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                logger.warning(f"Draining a socket failed: {result!r}")
+        deadline = self._now() + settings.DRAIN_TIMEOUT
+        while (self.consumers or db_pool.in_flight) and self._now() < deadline:
+            await asyncio.sleep(0.05)
+
+    async def _drain_and_exit(self):
+        try:
+            await self.drain()
+        finally:
+            # Hand SIGTERM back to the server (daphne stops its reactor) and re-deliver it
+            self._loop.remove_signal_handler(signal.SIGTERM)
+            signal.signal(signal.SIGTERM, self._previous_handler or signal.SIG_DFL)
+            os.kill(os.getpid(), signal.SIGTERM)
+
+    def _now(self):
+        return asyncio.get_running_loop().time()
+
+
+drainer = Drainer()
@@ -0,0 +1,107 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+
+from .models import Message
+from .rollups import sender_key
+
+# Longest client_msg_id accepted (the column's max_length)
+CLIENT_MSG_ID_MAX_LENGTH = 64
+
+
+class RecentMessages:
+    """Bounded LRU of recently stored messages by (room, sender, client_msg_id).
+
+    Resends that arrive while the original is still remembered are answered
+    from memory; older ones fall through to the unique constraint.
+    """
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, message = entry
+            if expires <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return message
+
+    def add(self, key, message):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, message)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+
+_recent_messages = None
+
+
+def recent_messages():
+    global _recent_messages
+    if _recent_messages is None:
+        _recent_messages = RecentMessages(settings.RECENT_CLIENT_IDS_SIZE, settings.RECENT_CLIENT_IDS_TTL)
+    return _recent_messages
+
+
+def clean_client_msg_id(value):
+    """The client_msg_id to store, or None when absent or unusable"""
+    if value is None:
+        return None
+    value = str(value).strip()
+    if not value or len(value) > CLIENT_MSG_ID_MAX_LENGTH:
+        return None
+    return value
+
+
+def client_key(room_id, user_id, user_name, client_msg_id):
+    return (str(room_id), sender_key(user_id, user_name), client_msg_id)
+
+
+def find_resent(room_id, sender_id, user_name, client_msg_id):
+    """The already stored message for a resend, if it is still remembered (no query).
+
+    sender_id is the id the client sent as, resolved to a user or not; pass the
+    same one to create_message_once so both build the same key.
+    """
+    if not client_msg_id:
+        return None
+    return recent_messages().get(client_key(room_id, sender_id, user_name, client_msg_id))
+
+
+def create_message_once(room, user, user_name, content, client_msg_id, sender_id=None):
+    """Store a message unless this sender already stored one with the same client_msg_id.
+
+    Returns (message, created).
+    """
+    if not client_msg_id:
+        return Message.objects.create(room=room, user_name=user_name, user=user, content=content), True
+    key = client_key(room.id, sender_id, user_name, client_msg_id)
+    try:
+        with transaction.atomic():
+            message = Message.objects.create(
+                room=room, user_name=user_name, user=user, content=content, client_msg_id=client_msg_id,
+            )
+        created = True
+    except IntegrityError:
+        # A resend of a message this cache no longer remembers (or one stored by another worker)
+        existing = Message.objects.filter(room=room, client_msg_id=client_msg_id)
+        existing = existing.filter(user=user) if user else existing.filter(user__isnull=True, user_name=user_name)
+        message = existing.first()
+        if message is None:
+            # Some other constraint failed (e.g. the room was purged meanwhile)
+            raise
+        created = False
+    recent_messages().add(key, message)
+    return message, created
@@ -0,0 +1,140 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from datetime import datetime, timezone
+from logging.handlers import QueueListener
+
+# Attributes every LogRecord has; anything else on a record came from extra={...}
+STANDARD_ATTRS = set(logging.makeLogRecord({}).__dict__) | {'message', 'asctime'}
+
+
+def record_fields(record):
+    return {key: value for key, value in record.__dict__.items() if key not in STANDARD_ATTRS}
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: time, level, logger, message and the record's extra fields"""
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            **record_fields(record),
+        }
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class KeyValueFormatter(logging.Formatter):
+    """The message followed by the record's extra fields as key=value (LOG_FORMAT=text)"""
+
+    def format(self, record):
+        line = super().format(record)
+        fields = record_fields(record)
+        if fields:
+            line += ' ' + ' '.join(f'{key}={value}' for key, value in fields.items())
+        return line
+
+
+class SamplingFilter(logging.Filter):
+    """Samples and rate-caps records that carry an `event` field; others always pass.
+
+    Each event name keeps LOG_SAMPLE_RATES[event] of its records and at most
+    LOG_EVENT_RATE_CAP per second, so churn in a big room costs a bounded amount
+    of logging. The next record let through reports how many were dropped as
+    `suppressed`.
+    """
+
+    def __init__(self, sample_rates=None, rate_cap=None):
+        super().__init__()
+        from django.conf import settings
+        self.sample_rates = settings.LOG_SAMPLE_RATES if sample_rates is None else sample_rates
+        self.rate_cap = settings.LOG_EVENT_RATE_CAP if rate_cap is None else rate_cap
+        # event -> [tokens, last refill, suppressed, sample counter]
+        self._events = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        event = getattr(record, 'event', None)
+        if event is None or record.levelno >= logging.WARNING:
+            return True
+        now = time.monotonic()
+        with self._lock:
+            state = self._events.get(event)
+            if state is None:
+                state = self._events[event] = [float(self.rate_cap), now, 0, 0.0]
+            # Deterministic sampling: keep every 1/rate-th record
+            state[3] += self.sample_rates.get(event, 1.0)
+            if state[3] < 1.0:
+                state[2] += 1
+                return False
+            state[3] -= 1.0
+            if self.rate_cap:
+                state[0] = min(float(self.rate_cap), state[0] + (now - state[1]) * self.rate_cap)
+                state[1] = now
+                if state[0] < 1.0:
+                    state[2] += 1
+                    return False
+                state[0] -= 1.0
+            if state[2]:
+                record.suppressed = state[2]
+                state[2] = 0
+        return True
+
+
+class QueueingStreamHandler(logging.Handler):
+    """Hands records to a background thread that formats and writes them.
+
+    The calling thread (usually the event loop) only enqueues; a full queue drops
+    the record instead of blocking. The formatter set on this handler is used by
+    the writer thread. Forked workers restart the writer thread.
+
+    A plain Handler owning its QueueListener rather than a QueueHandler subclass:
+    dictConfig on Python 3.12+ treats QueueHandler subclasses specially and
+    requires `handlers`/`listener` keys for them.
+    """
+
+    def __init__(self, stream=None, queue_size=10000):
+        super().__init__()
+        self.queue_size = queue_size
+        self.target = logging.StreamHandler(stream)
+        self.dropped = 0
+        self.queue = queue.Queue(maxsize=queue_size)
+        self._start_listener()
+        atexit.register(self.stop)
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._restart_after_fork)
+
+    def _start_listener(self):
+        self.listener = QueueListener(self.queue, self.target, respect_handler_level=False)
+        self.listener.start()
+
+    def _restart_after_fork(self):
+        # The writer thread doesn't survive fork; start a fresh one with a fresh queue
+        self.queue = queue.Queue(maxsize=self.queue_size)
+        self._start_listener()
+
+    def setFormatter(self, fmt):
+        self.target.setFormatter(fmt)
+
+    def emit(self, record):
+        # Formatting happens on the writer thread
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def stop(self):
+        if self.listener._thread is not None:
+            self.listener.stop()
+
+    def close(self):
+        self.stop()
+        super().close()
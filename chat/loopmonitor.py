@@ -0,0 +1,123 @@
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from datetime import datetime
+
+from channels.consumer import AsyncConsumer
+from django.conf import settings
+
+from .metrics import LatencyHistogram
+
+logger = logging.getLogger('chat')
+
+# Number of slow callbacks kept for the debug endpoint
+SLOW_CALLBACK_HISTORY = 100
+# Deepest frames kept per stack sample
+STACK_SAMPLE_DEPTH = 15
+
+
+def find_consumer_method(frame):
+    """Walk a stack sample outwards and name the first consumer method on it"""
+    while frame is not None:
+        owner = frame.f_locals.get('self')
+        if isinstance(owner, AsyncConsumer):
+            return f'{type(owner).__name__}.{frame.f_code.co_name}'
+        frame = frame.f_back
+    return None
+
+
+class LoopMonitor:
+    """Measures event-loop lag continuously and samples the stack of callbacks that block the loop.
+
+    A coroutine on the loop sleeps for a fixed interval and records how late it
+    wakes up. A watchdog thread notices when that wake-up is overdue by more than
+    the slow-callback threshold and grabs the loop thread's stack while the
+    offending callback is still running.
+    """
+
+    def __init__(self):
+        self.loop_lag = 0.0
+        self.lag_histogram = LatencyHistogram()
+        self.slow_callbacks = deque(maxlen=SLOW_CALLBACK_HISTORY)
+        self._task = None
+        self._watchdog = None
+        self._loop_thread_id = None
+        self._tick = None
+        self._stall = None
+
+    def start(self):
+        """Start monitoring the running loop (safe to call repeatedly)"""
+        task = self._task
+        if task is None or task.done() or task.get_loop() is not asyncio.get_running_loop():
+            self._loop_thread_id = threading.get_ident()
+            self._task = asyncio.ensure_future(self._sample_lag())
+        if settings.LOOP_MONITOR_SLOW_THRESHOLD > 0 and (self._watchdog is None or not self._watchdog.is_alive()):
+            self._watchdog = threading.Thread(target=self._watch, name='loop-monitor', daemon=True)
+            self._watchdog.start()
+
+    async def _sample_lag(self):
+        loop = asyncio.get_running_loop()
+        interval = settings.LOOP_MONITOR_INTERVAL
+        threshold = settings.LOOP_MONITOR_SLOW_THRESHOLD
+        log_interval = settings.LOOP_MONITOR_LOG_INTERVAL
+        last_log = time.monotonic()
+        while True:
+            self._tick = time.monotonic()
+            started = loop.time()
+            await asyncio.sleep(interval)
+            lag = max(0.0, loop.time() - started - interval)
+            self.lag_histogram.observe(lag)
+            # React to spikes immediately, forget them over a few samples
+            self.loop_lag = max(lag, self.loop_lag * 0.5)
+
+            stall, self._stall = self._stall, None
+            if threshold > 0 and lag >= threshold:
+                self._record_slow_callback(lag, stall)
+
+            if log_interval > 0 and time.monotonic() - last_log >= log_interval:
+                last_log = time.monotonic()
+                lag_stats = self.lag_histogram.snapshot()
+                logger.info(f"Event loop lag: current={self.loop_lag * 1000:.1f}ms max={lag_stats['max'] * 1000:.1f}ms samples={lag_stats['count']} slow_callbacks={len(self.slow_callbacks)}")
+
+    def _watch(self):
+        """Watchdog thread: sample the loop thread's stack while it is blocked"""
+        while True:
+            threshold = settings.LOOP_MONITOR_SLOW_THRESHOLD
+            time.sleep(threshold / 2)
+            tick = self._tick
+            if tick is None or (self._stall and self._stall['tick'] == tick):
+                continue
+            if time.monotonic() - tick < settings.LOOP_MONITOR_INTERVAL + threshold:
+                continue
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is None:
+                continue
+            self._stall = {
+                'tick': tick,
+                'consumer_method': find_consumer_method(frame),
+                'stack': traceback.format_stack(frame)[-STACK_SAMPLE_DEPTH:],
+            }
+
+    def _record_slow_callback(self, duration, stall):
+        record = {
+            'duration_ms': round(duration * 1000, 1),
+            'detected_at': datetime.now().isoformat(),
+            'consumer_method': stall['consumer_method'] if stall else None,
+            'stack': stall['stack'] if stall else [],
+        }
+        self.slow_callbacks.append(record)
+        logger.warning(f"Event loop blocked for {record['duration_ms']}ms in {record['consumer_method'] or 'unknown callback'}")
+
+    def snapshot(self):
+        return {
+            'loop_lag_ms': round(self.loop_lag * 1000, 1),
+            'lag_histogram': self.lag_histogram.snapshot(),
+            'slow_callbacks': list(self.slow_callbacks),
+        }
+
+
+loop_monitor = LoopMonitor()
@@ -0,0 +1,66 @@
+import json
+import logging
+import os
+import random
+
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import setup_databases, setup_test_environment, teardown_databases, teardown_test_environment
+
+from chat.benchmark import benchmark_context, compare_to_baseline, dataset_for, run_routes, seed
+
+
+class Command(BaseCommand):
+    help = 'Time every chat route against seeded datasets of growing size and compare with a saved baseline'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='1000,10000,100000', help='Comma-separated message counts')
+        parser.add_argument('--repeat', type=int, default=10, help='Timed requests per route and size')
+        parser.add_argument('--baseline', default='benchmarks/baseline.json')
+        parser.add_argument('--update-baseline', action='store_true', help='Save these results as the new baseline')
+        parser.add_argument('--tolerance', type=float, default=0.5, help='Allowed relative slowdown of the median')
+        parser.add_argument('--slack-ms', type=float, default=5.0, help='Allowed absolute slowdown of the median')
+        parser.add_argument('--keepdb', action='store_true', help='Keep the benchmark database between runs')
+
+    def handle(self, *args, **options):
+        sizes = sorted(int(size) for size in options['sizes'].split(','))
+        # Request logging would dominate the timings
+        logging.getLogger('chat').setLevel(logging.WARNING)
+        logging.getLogger('django.request').setLevel(logging.CRITICAL)
+
+        # Runs on a separate test database, grown from the smallest size to the largest
+        setup_test_environment()
+        old_config = setup_databases(verbosity=0, interactive=False, keepdb=options['keepdb'])
+        results = {}
+        try:
+            seeded = dict.fromkeys(('users', 'rooms', 'messages', 'logins'), 0)
+            rng = random.Random(0)
+            for size in sizes:
+                target = dataset_for(size)
+                seed(rng=rng, **{name: max(0, n - seeded[name]) for name, n in target.items()})
+                seeded = target
+                for name, result in run_routes(benchmark_context(), repeat=options['repeat']).items():
+                    results[f'{size}:{name}'] = result
+                    self.stdout.write(
+                        f'{size:>9} {name:<16} {result["status"]} {result["median_ms"]:>9.2f}ms '
+                        f'p95 {result["p95_ms"]:>9.2f}ms {result["queries"]:>3} queries'
+                    )
+        finally:
+            teardown_databases(old_config, verbosity=0, keepdb=options['keepdb'])
+            teardown_test_environment()
+
+        if options['update_baseline']:
+            os.makedirs(os.path.dirname(options['baseline']) or '.', exist_ok=True)
+            with open(options['baseline'], 'w') as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+            self.stdout.write(self.style.SUCCESS(f'Baseline saved to {options["baseline"]}'))
+            return
+        try:
+            with open(options['baseline']) as f:
+                baseline = json.load(f)
+        except FileNotFoundError:
+            self.stdout.write(self.style.WARNING(f'No baseline at {options["baseline"]}; run with --update-baseline'))
+            return
+        failures = compare_to_baseline(results, baseline, options['tolerance'], options['slack_ms'])
+        if failures:
+            raise CommandError('Benchmark regressions:\n' + '\n'.join(failures))
+        self.stdout.write(self.style.SUCCESS('No regressions against the baseline'))
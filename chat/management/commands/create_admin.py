@@ -3,14 +3,18 @@ from django.contrib.auth import get_user_model
 
 User = get_user_model()
 
+ADMIN_USERNAME = 'admin'
+ADMIN_EMAIL = 'admin@yapper.com'
+ADMIN_PASSWORD = 'admin123'  # Change this to something secure!
+
 
 class Command(BaseCommand):
     help = 'Create a superuser admin account'
 
     def handle(self, *args, **options):
-        username = 'admin'
-        email = 'admin@yapper.com'
-        password = 'admin123'  # Change this to something secure!
+        username = ADMIN_USERNAME
+        email = ADMIN_EMAIL
+        password = ADMIN_PASSWORD
         
         if User.objects.filter(username=username).exists():
             self.stdout.write(self.style.WARNING(f'User "{username}" already exists!'))
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from chat.models import RoomDeletion
+from chat.purge import purge_room
+
+
+class Command(BaseCommand):
+    help = 'Finish purging deleted rooms whose background purge was interrupted'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--room', type=int, help='Only purge this room')
+
+    def handle(self, *args, **options):
+        pending = RoomDeletion.objects.filter(finished_at__isnull=True).order_by('requested_at')
+        if options['room'] is not None:
+            pending = pending.filter(room_id=options['room'])
+        room_ids = list(pending.values_list('room_id', flat=True))
+        for room_id in room_ids:
+            deletion = purge_room(room_id)
+            self.stdout.write(f'Purged room {room_id}: {deletion.deleted_messages} messages')
+        self.stdout.write(self.style.SUCCESS(f'{len(room_ids)} deleted rooms purged'))
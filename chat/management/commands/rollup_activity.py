@@ -0,0 +1,21 @@
+from datetime import datetime, time, timedelta, timezone
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone as dj_timezone
+
+from chat.rollups import rebuild_rollups
+
+
+class Command(BaseCommand):
+    help = 'Rebuild room activity rollups from raw messages for the last N days'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=1, help='Days to rebuild, counting today')
+        parser.add_argument('--room', type=int, help='Only rebuild this room')
+
+    def handle(self, *args, **options):
+        today = dj_timezone.now().astimezone(timezone.utc).date()
+        since = datetime.combine(today - timedelta(days=options['days'] - 1), time.min, tzinfo=timezone.utc)
+        until = datetime.combine(today + timedelta(days=1), time.min, tzinfo=timezone.utc)
+        rows = rebuild_rollups(since, until, room_id=options['room'])
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt rollups from {since.date()} to {today}: {rows} sender-day rows'))
@@ -0,0 +1,33 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand
+
+from chat.benchmark import dataset_for, seed
+
+
+class Command(BaseCommand):
+    help = 'Bulk-insert benchmark users, rooms, memberships, messages and login logs (adds to existing bench_ rows)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=100000)
+        parser.add_argument('--users', type=int, help='Default scales with --messages')
+        parser.add_argument('--rooms', type=int, help='Default scales with --messages')
+        parser.add_argument('--logins', type=int, help='Default scales with --messages')
+        parser.add_argument('--members-per-room', type=int, default=20)
+        parser.add_argument('--days', type=int, default=30, help='Spread message and login times over this many days')
+        parser.add_argument('--batch-size', type=int, default=10000)
+        parser.add_argument('--seed', type=int, default=0, help='Random seed, for repeatable datasets')
+
+    def handle(self, *args, **options):
+        sizes = dataset_for(options['messages'])
+        for name in ('users', 'rooms', 'logins'):
+            if options[name] is not None:
+                sizes[name] = options[name]
+        started = time.monotonic()
+        seed(
+            members_per_room=options['members_per_room'], days=options['days'],
+            batch_size=options['batch_size'], rng=random.Random(options['seed']), **sizes,
+        )
+        summary = ', '.join(f'{n} {name}' for name, n in sizes.items())
+        self.stdout.write(self.style.SUCCESS(f'Seeded {summary} in {time.monotonic() - started:.1f}s'))
@@ -0,0 +1,106 @@
+import os
+import tempfile
+import time
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DatabaseError
+from django.db.migrations.loader import MigrationLoader
+from django.db.migrations.recorder import MigrationRecorder
+
+from chat.workers import PreforkSupervisor
+from .create_admin import ADMIN_USERNAME
+
+# A cache each worker process keeps to itself
+PROCESS_LOCAL_CACHE = 'django.core.cache.backends.locmem.LocMemCache'
+
+
+class Command(BaseCommand):
+    help = 'Prepare the app in one Django setup (migrations, static, admin) and start daphne in-process'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--bind', default='0.0.0.0')
+        parser.add_argument('--port', type=int, default=int(os.environ.get('PORT', '8000')))
+        parser.add_argument('--workers', type=int, default=int(os.environ.get('WEB_CONCURRENCY', '1')),
+                            help='Number of pre-forked daphne workers sharing the listening socket')
+        parser.add_argument('--max-worker-age', type=int, default=int(os.environ.get('WORKER_MAX_AGE', '0')),
+                            help='Recycle each worker after this many seconds (0 = never)')
+        parser.add_argument('--graceful-timeout', type=int, default=int(os.environ.get('WORKER_GRACEFUL_TIMEOUT', '30')),
+                            help='Seconds a retiring worker gets to finish before it is killed')
+        parser.add_argument('--no-serve', action='store_true', help='Run the startup phases and exit')
+
+    def handle(self, *args, **options):
+        if options['workers'] > 1 and not settings.REDIS_URLS:
+            raise CommandError('Multiple workers need REDIS_URL: the channel layer and presence state must be shared')
+        if options['workers'] > 1 and settings.CACHES['default']['BACKEND'] == PROCESS_LOCAL_CACHE:
+            raise CommandError('Multiple workers need a shared cache: room documents are retired in the cache of one worker only')
+
+        # Settings import, app loading and django.setup() happened before this command ran
+        from chatbackend_out import STARTED_AT
+        self.report('setup', time.monotonic() - STARTED_AT)
+
+        started = time.monotonic()
+        self.ensure_migrations()
+        self.report('migrations', time.monotonic() - started)
+
+        started = time.monotonic()
+        self.ensure_static()
+        self.report('static', time.monotonic() - started)
+
+        started = time.monotonic()
+        self.ensure_admin()
+        self.report('admin', time.monotonic() - started)
+
+        started = time.monotonic()
+        from chatbackend_out.asgi import application  # noqa: F401 - warm the import for daphne
+        self.report('asgi import', time.monotonic() - started)
+
+        if options['no_serve']:
+            return
+
+        if options['workers'] > 1:
+            if not settings.METRICS_DIR:
+                settings.METRICS_DIR = os.environ['METRICS_DIR'] = tempfile.mkdtemp(prefix='chat-metrics-')
+            PreforkSupervisor(
+                options['bind'],
+                options['port'],
+                options['workers'],
+                max_age=options['max_worker_age'],
+                graceful_timeout=options['graceful_timeout'],
+                stdout=self.stdout,
+            ).run()
+            return
+
+        from daphne.cli import CommandLineInterface
+        CommandLineInterface().run(['-b', options['bind'], '-p', str(options['port']), 'chatbackend_out.asgi:application'])
+
+    def report(self, phase, seconds):
+        self.stdout.write(f'[serve] {phase}: {seconds * 1000:.0f}ms')
+
+    def ensure_migrations(self):
+        """Compare on-disk leaf migrations with the applied set (one query); migrate only if behind"""
+        loader = MigrationLoader(None, ignore_no_migrations=True)
+        try:
+            applied = set(MigrationRecorder.Migration.objects.values_list('app', 'name'))
+        except DatabaseError:
+            # Fresh database without the django_migrations table yet
+            applied = set()
+        pending = [node for node in loader.graph.leaf_nodes() if node not in applied]
+        if pending:
+            self.stdout.write(f'[serve] applying migrations for: {", ".join(app for app, _ in pending)}')
+            call_command('migrate', interactive=False, verbosity=0)
+
+    def ensure_static(self):
+        """Static files are collected at image build time; only collect if the manifest is missing"""
+        manifest = os.path.join(settings.STATIC_ROOT, 'staticfiles.json')
+        if not os.path.exists(manifest):
+            self.stdout.write('[serve] static manifest missing, collecting static files')
+            call_command('collectstatic', interactive=False, verbosity=0)
+
+    def ensure_admin(self):
+        """Skip the (password-hashing) admin setup when the superuser already exists"""
+        User = get_user_model()
+        if not User.objects.filter(username=ADMIN_USERNAME, is_staff=True, is_superuser=True).exists():
+            call_command('create_admin')
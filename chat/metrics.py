@@ -0,0 +1,50 @@
+import bisect
+import math
+
+# Upper bounds (seconds) of latency histogram buckets; the last bucket is open-ended
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, math.inf)
+
+
+class LatencyHistogram:
+    """Fixed-bucket latency histogram, cheap enough to update from the event loop"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def snapshot(self):
+        return {
+            'buckets': {
+                ('+Inf' if bound == math.inf else f'{bound * 1000:g}ms'): n
+                for bound, n in zip(self.buckets, self.counts)
+            },
+            'count': self.count,
+            'sum': round(self.total, 6),
+            'max': round(self.max, 6),
+        }
+
+
+class RateMeter:
+    """Exponentially decaying event rate (events per second, smoothed over tau seconds)"""
+
+    def __init__(self, tau=1.0):
+        self.tau = tau
+        self.rate = 0.0
+        self.last = None
+
+    def hit(self, now):
+        if self.last is not None:
+            self.rate *= math.exp(-(now - self.last) / self.tau)
+        self.rate += 1.0 / self.tau
+        self.last = now
+        return self.rate
@@ -0,0 +1,106 @@
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core import signing
+from django.core.exceptions import MiddlewareNotUsed
+from django.http import JsonResponse
+
+from .admission import admission
+from .loopmonitor import loop_monitor
+from .routers import REPLICA_DATABASE, routing_state
+from .workers import metrics_publisher
+
+
+class AdmissionMiddleware:
+    """Answer heavy REST endpoints with a fast 503 while the process is overloaded"""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        return self.get_response(request)
+
+    async def __acall__(self, request):
+        # Under ASGI we are on the event loop, so lag sampling can start here
+        loop_monitor.start()
+        metrics_publisher.start()
+        return await self.get_response(request)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if request.resolver_match.url_name not in settings.ADMISSION_HEAVY_ROUTES:
+            return None
+        reason = admission.overload_reason(include_sockets=False)
+        if not reason:
+            return None
+        response = JsonResponse({'detail': 'Server is busy, please retry shortly'}, status=503)
+        response['Retry-After'] = str(settings.ADMISSION_RETRY_AFTER)
+        return response
+
+
+# The read-your-writes pin travels with the client (signed), not in a per-process cache
+PIN_COOKIE = 'db_pin'
+PIN_HEADER = 'X-DB-Pin'
+PIN_SALT = 'chat.db-pin'
+
+
+class ReplicaPinningMiddleware:
+    """Keep a client on the primary database for a short window after it writes"""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if REPLICA_DATABASE not in settings.DATABASES:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        token, state, pinned_until = self.start(request)
+        try:
+            response = self.get_response(request)
+        finally:
+            routing_state.reset(token)
+        self.finish(request, response, state, pinned_until)
+        return response
+
+    async def __acall__(self, request):
+        token, state, pinned_until = self.start(request)
+        try:
+            response = await self.get_response(request)
+        finally:
+            routing_state.reset(token)
+        self.finish(request, response, state, pinned_until)
+        return response
+
+    def read_pin(self, request):
+        """The client's pin, from the signed cookie or (for clients without cookies) the header"""
+        token = request.COOKIES.get(PIN_COOKIE) or request.META.get('HTTP_X_DB_PIN')
+        if not token:
+            return 0.0
+        try:
+            return float(signing.loads(token, salt=PIN_SALT, max_age=settings.REPLICA_PIN_SECONDS))
+        except (signing.BadSignature, TypeError, ValueError):
+            return 0.0
+
+    def start(self, request):
+        pinned_until = self.read_pin(request)
+        state = {'pinned_until': pinned_until}
+        return routing_state.set(state), state, pinned_until
+
+    def finish(self, request, response, state, pinned_until):
+        # The router moved the pin forward, so this request wrote: the client carries the pin
+        # to its next requests, whichever worker serves them
+        if state['pinned_until'] > pinned_until:
+            token = signing.dumps(state['pinned_until'], salt=PIN_SALT)
+            response.set_cookie(PIN_COOKIE, token, max_age=settings.REPLICA_PIN_SECONDS, httponly=True, samesite='Lax')
+            response[PIN_HEADER] = token
@@ -0,0 +1,27 @@
+# Generated by Django 4.2.30 on 2026-10-18 23:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0005_loginlog'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='loginlog',
+            name='logged_at',
+            field=models.DateTimeField(auto_now_add=True, db_index=True),
+        ),
+        migrations.AlterField(
+            model_name='message',
+            name='created_at',
+            field=models.DateTimeField(auto_now_add=True, db_index=True),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['room', 'created_at'], name='chat_msg_room_created_idx'),
+        ),
+    ]
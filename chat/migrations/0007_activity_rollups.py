@@ -0,0 +1,45 @@
+# Generated by Django 4.2.30 on 2026-10-18 23:42
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0006_admin_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RoomHourlyActivity',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hour', models.DateTimeField()),
+                ('message_count', models.PositiveIntegerField(default=0)),
+                ('room', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='hourly_activity', to='chat.room')),
+            ],
+            options={
+                'verbose_name_plural': 'Room hourly activity',
+                'ordering': ['-hour'],
+            },
+        ),
+        migrations.CreateModel(
+            name='RoomDailySender',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('sender', models.CharField(max_length=160)),
+                ('message_count', models.PositiveIntegerField(default=0)),
+                ('room', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_senders', to='chat.room')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='roomhourlyactivity',
+            constraint=models.UniqueConstraint(fields=('room', 'hour'), name='chat_activity_room_hour_uniq'),
+        ),
+        migrations.AddConstraint(
+            model_name='roomdailysender',
+            constraint=models.UniqueConstraint(fields=('room', 'day', 'sender'), name='chat_sender_room_day_uniq'),
+        ),
+    ]
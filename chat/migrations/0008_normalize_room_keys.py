@@ -0,0 +1,39 @@
+import string
+
+from django.db import migrations
+from django.utils.crypto import get_random_string
+
+
+def new_key(taken):
+    key = get_random_string(8, allowed_chars=string.ascii_uppercase + string.digits)
+    while key in taken:
+        key = get_random_string(8, allowed_chars=string.ascii_uppercase + string.digits)
+    return key
+
+
+def normalize_keys(apps, schema_editor):
+    """Store keys upper-case; a key that only differed by case from another gets a new one"""
+    Room = apps.get_model('chat', 'Room')
+    rooms = list(Room.objects.exclude(key__isnull=True).exclude(key='').order_by('id'))
+    # Keys already in normal form keep their value
+    taken = {room.key for room in rooms if room.key == room.key.strip().upper()}
+    for room in rooms:
+        key = room.key.strip().upper()
+        if key == room.key:
+            continue
+        if key in taken:
+            key = new_key(taken)
+        taken.add(key)
+        room.key = key
+        room.save(update_fields=['key'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0007_activity_rollups'),
+    ]
+
+    operations = [
+        migrations.RunPython(normalize_keys, migrations.RunPython.noop),
+    ]
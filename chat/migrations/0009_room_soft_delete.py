@@ -0,0 +1,33 @@
+# Generated by Django 4.2.30 on 2026-10-18 23:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0008_normalize_room_keys'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RoomDeletion',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('room_id', models.BigIntegerField(unique=True)),
+                ('room_name', models.CharField(max_length=200)),
+                ('total_messages', models.PositiveBigIntegerField(blank=True, null=True)),
+                ('deleted_messages', models.PositiveBigIntegerField(default=0)),
+                ('requested_at', models.DateTimeField(auto_now_add=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'ordering': ['-requested_at'],
+            },
+        ),
+        migrations.AddField(
+            model_name='room',
+            name='deleted_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 4.2.30 on 2026-10-18 23:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0011_room_updated_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='client_msg_id',
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+        migrations.AddConstraint(
+            model_name='message',
+            constraint=models.UniqueConstraint(condition=models.Q(('client_msg_id__isnull', False), ('user__isnull', False)), fields=('room', 'user', 'client_msg_id'), name='chat_msg_client_id_uniq'),
+        ),
+        migrations.AddConstraint(
+            model_name='message',
+            constraint=models.UniqueConstraint(condition=models.Q(('client_msg_id__isnull', False), ('user__isnull', True)), fields=('room', 'user_name', 'client_msg_id'), name='chat_msg_anon_client_id_uniq'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def count_members(apps, schema_editor):
+    Room = apps.get_model('chat', 'Room')
+    Membership = Room.members.through
+    counts = (
+        Membership.objects.filter(room_id=OuterRef('pk'))
+        .order_by().values('room_id').annotate(n=Count('id')).values('n')
+    )
+    Room.objects.update(member_count=Coalesce(Subquery(counts), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0012_message_client_msg_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='room',
+            name='member_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(count_members, migrations.RunPython.noop),
+    ]
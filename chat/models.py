@@ -1,6 +1,17 @@
-from django.db import models
+from functools import partial
+
+from django.db import models, transaction, IntegrityError
 from django.conf import settings
-from django.utils.crypto import get_random_string
+from .roomkeys import generate_room_key, missing_room_keys, normalize_room_key
+
+# Attempts at a fresh random key before giving up on a collision
+ROOM_KEY_ATTEMPTS = 5
+
+
+class LiveRoomManager(models.Manager):
+    """Rooms that have not been deleted (deleted rooms wait for their messages to be purged)"""
+    def get_queryset(self):
+        return super().get_queryset().filter(deleted_at__isnull=True)
 
 
 class Room(models.Model):
@@ -9,11 +20,44 @@ class Room(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     creator = models.ForeignKey(settings.AUTH_USER_MODEL, null=True, blank=True, on_delete=models.SET_NULL, related_name='created_rooms')
     members = models.ManyToManyField(settings.AUTH_USER_MODEL, related_name='rooms', blank=True)
+    deleted_at = models.DateTimeField(null=True, blank=True)
+    # Bumped on every change that shows in the room document, members included (see signals)
+    updated_at = models.DateTimeField(auto_now=True)
+    # Kept in step with members by signals so payloads never count the join table
+    member_count = models.PositiveIntegerField(default=0)
+
+    objects = LiveRoomManager()
+    all_objects = models.Manager()
 
     def save(self, *args, **kwargs):
-        if not self.key:
-            self.key = get_random_string(8).upper()
-        super().save(*args, **kwargs)
+        created = self._state.adding
+        if self.key:
+            self.key = normalize_room_key(self.key)
+            super().save(*args, **kwargs)
+        else:
+            self._save_with_new_key(*args, **kwargs)
+        # A key that was just taken may have been a cached miss; a worker that looks
+        # before a new room commits can cache it again, so clear it at commit too
+        missing_keys = missing_room_keys()
+        missing_keys.discard(self.key)
+        if created:
+            transaction.on_commit(partial(missing_keys.discard, self.key))
+
+    def _save_with_new_key(self, *args, **kwargs):
+        """Assign a random key, retrying if it collides with an existing room"""
+        for attempt in range(ROOM_KEY_ATTEMPTS):
+            self.key = generate_room_key()
+            if Room.all_objects.filter(key=self.key).exists():
+                continue
+            try:
+                # Savepoint so a lost race doesn't break an outer transaction
+                with transaction.atomic():
+                    super().save(*args, **kwargs)
+                return
+            except IntegrityError:
+                if not Room.all_objects.filter(key=self.key).exists():
+                    raise
+        raise IntegrityError(f'Could not generate a unique room key after {ROOM_KEY_ATTEMPTS} attempts')
 
     def __str__(self):
         return self.name
@@ -25,12 +69,98 @@ class Message(models.Model):
     user_name = models.CharField(max_length=150)
     user = models.ForeignKey(settings.AUTH_USER_MODEL, null=True, blank=True, on_delete=models.SET_NULL)
     content = models.TextField()
-    created_at = models.DateTimeField(auto_now_add=True)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+    # Optional id chosen by the client so resends of the same message are not stored twice
+    client_msg_id = models.CharField(max_length=64, null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # Room history and "latest message" lookups
+            models.Index(fields=['room', 'created_at'], name='chat_msg_room_created_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(
+                fields=['room', 'user', 'client_msg_id'], name='chat_msg_client_id_uniq',
+                condition=models.Q(client_msg_id__isnull=False, user__isnull=False),
+            ),
+            # Anonymous senders are told apart by name
+            models.UniqueConstraint(
+                fields=['room', 'user_name', 'client_msg_id'], name='chat_msg_anon_client_id_uniq',
+                condition=models.Q(client_msg_id__isnull=False, user__isnull=True),
+            ),
+        ]
 
     def __str__(self):
         return f"{self.user_name}: {self.content[:30]}"
 
 
+class RoomHourlyActivity(models.Model):
+    """Messages per room per hour, maintained as messages are inserted (see chat.rollups)"""
+    room = models.ForeignKey(Room, related_name='hourly_activity', on_delete=models.CASCADE)
+    hour = models.DateTimeField()  # truncated to the hour, UTC
+    message_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        ordering = ['-hour']
+        constraints = [
+            models.UniqueConstraint(fields=['room', 'hour'], name='chat_activity_room_hour_uniq'),
+        ]
+        verbose_name_plural = 'Room hourly activity'
+
+    def __str__(self):
+        return f"{self.room_id} @ {self.hour:%Y-%m-%d %H}:00: {self.message_count}"
+
+
+class RoomDailySender(models.Model):
+    """One row per room, day and sender: row count per day is the number of distinct active users"""
+    room = models.ForeignKey(Room, related_name='daily_senders', on_delete=models.CASCADE)
+    day = models.DateField()
+    # 'user:<id>' for known users, 'name:<user_name>' for anonymous senders
+    sender = models.CharField(max_length=160)
+    message_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['room', 'day', 'sender'], name='chat_sender_room_day_uniq'),
+        ]
+
+    def __str__(self):
+        return f"{self.sender} in {self.room_id} on {self.day}: {self.message_count}"
+
+
+class RoomDeletion(models.Model):
+    """Progress of purging a deleted room's messages in the background (see chat.purge)"""
+    # Plain id rather than a foreign key: this row outlives the room
+    room_id = models.BigIntegerField(unique=True)
+    room_name = models.CharField(max_length=200)
+    total_messages = models.PositiveBigIntegerField(null=True, blank=True)
+    deleted_messages = models.PositiveBigIntegerField(default=0)
+    requested_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['-requested_at']
+
+    def __str__(self):
+        return f"Deletion of {self.room_name} ({self.deleted_messages}/{self.total_messages})"
+
+
+class RoomBan(models.Model):
+    """A user banned from a room; enforced through the per-room cache in chat.bans"""
+    room = models.ForeignKey(Room, related_name='bans', on_delete=models.CASCADE)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, related_name='room_bans', on_delete=models.CASCADE)
+    banned_by = models.ForeignKey(settings.AUTH_USER_MODEL, null=True, blank=True, on_delete=models.SET_NULL, related_name='+')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['room', 'user'], name='chat_roomban_room_user_uniq'),
+        ]
+
+    def __str__(self):
+        return f"{self.user_id} banned from {self.room_id}"
+
+
 class Feedback(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='feedbacks')
     user_name = models.CharField(max_length=150, blank=True)  # Name at time of feedback
@@ -51,7 +181,7 @@ class LoginLog(models.Model):
     ip_address = models.GenericIPAddressField(null=True, blank=True, db_column='IPaddr')
     user_agent = models.TextField(blank=True)
     device_id = models.CharField(max_length=255, blank=True, db_column='MAC')  # Device fingerprint
-    logged_at = models.DateTimeField(auto_now_add=True)
+    logged_at = models.DateTimeField(auto_now_add=True, db_index=True)
 
     class Meta:
         ordering = ['-logged_at']
@@ -0,0 +1,271 @@
+import asyncio
+import json
+import logging
+import time
+import weakref
+from collections import deque
+from functools import partial
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+logger = logging.getLogger('chat')
+
+# Close code for a socket dropped because it could not keep up (policy 'disconnect')
+SLOW_CONSUMER_CLOSE_CODE = 4408
+
+POLICIES = ('drop_oldest', 'coalesce', 'disconnect')
+
+
+class WriteGate:
+    """Push producer registered on the client's Twisted transport (IPushProducer).
+
+    daphne hands each frame to Twisted, whose transport buffers without limit and
+    never makes send() wait. Twisted does tell a registered producer to pause once
+    its outgoing buffer passes the transport's bufferSize (64 KiB), and to resume
+    when the buffer has drained; the socket's writer waits on `open` meanwhile.
+    After the WebSocket upgrade, twisted.web's HTTPChannel is still the
+    transport's producer, so the gate is registered with the channel, which
+    passes pause and resume on.
+    """
+
+    def __init__(self):
+        self.open = asyncio.Event()
+        self.open.set()
+
+    def pauseProducing(self):
+        self.open.clear()
+
+    def resumeProducing(self):
+        self.open.set()
+
+    def stopProducing(self):
+        # Connection lost: never leave the writer waiting
+        self.open.set()
+
+
+def daphne_protocol(send):
+    """The protocol behind a consumer's base_send, or None when not served by daphne.
+
+    daphne passes partial(server.handle_reply, protocol); the session middleware
+    wraps that as its real_send.
+    """
+    while send is not None and not isinstance(send, partial):
+        send = getattr(getattr(send, '__self__', None), 'real_send', None)
+    args = getattr(send, 'args', ())
+    return args[0] if args else None
+
+
+def register_write_gate(send):
+    """A WriteGate registered with the client's transport, or None where there is no such transport"""
+    protocol = daphne_protocol(send)
+    if not hasattr(protocol, 'registerProducer'):
+        # Other servers (and test communicators) make send() itself wait
+        return None
+    gate = WriteGate()
+    try:
+        protocol.registerProducer(gate, True)
+        return gate
+    except RuntimeError:
+        # Already taken: chain onto the producer that holds it (the upgraded HTTPChannel)
+        channel = getattr(protocol.transport, 'producer', None)
+    try:
+        channel.registerProducer(gate, True)
+    except (AttributeError, RuntimeError) as e:
+        logger.warning(f"Outbound backpressure unavailable: {e!r}")
+        return None
+    return gate
+
+
+class OutboundStats:
+    """Slow-consumer counters of this worker, for the metrics snapshot"""
+
+    def __init__(self):
+        self.queues = weakref.WeakSet()
+        self.overflows = 0
+        self.blocked_writes = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.disconnects = 0
+
+    def snapshot(self):
+        depths = [len(queue) for queue in list(self.queues)]
+        return {
+            'queued_frames': sum(depths),
+            'max_queue_depth': max(depths, default=0),
+            # Connections at least half way to their limit
+            'slow_consumers': sum(1 for depth in depths if depth * 2 >= settings.OUTBOUND_QUEUE_SIZE),
+            'overflows': self.overflows,
+            # Times a writer waited for a client to read what it had already been sent
+            'blocked_writes': self.blocked_writes,
+            'dropped_frames': self.dropped,
+            'coalesced_frames': self.coalesced,
+            'disconnects': self.disconnects,
+        }
+
+
+outbound_stats = OutboundStats()
+
+
+class OutboundQueue:
+    """Bounded frame queue of one connection, written to the socket by its own task.
+
+    Channel-layer handlers only enqueue, so a slow client never holds up the
+    consumer's channel. The writer stops while `gate` (see WriteGate) is closed,
+    so frames wait here rather than in the server's unbounded buffer. When `size` frames are waiting the policy
+    decides: 'drop_oldest' discards the oldest frame; 'coalesce' keeps only the
+    latest of each keyed state frame (presence, typing) and replaces queued
+    messages with one {type: 'resync'} frame; 'disconnect' gives up on the
+    connection.
+
+    Traces queued with a frame get their 'send' span once it is written.
+    """
+
+    def __init__(self, write, size, policy, gate=None):
+        if policy not in POLICIES:
+            raise ImproperlyConfigured(f'OUTBOUND_QUEUE_POLICY must be one of {", ".join(POLICIES)}, not {policy!r}')
+        self.write = write
+        self.size = size
+        self.policy = policy
+        self.gate = gate
+        self._frames = deque()  # [coalesce key or None, text, traces, span attributes, queued at]
+        self._keyed = {}
+        self._ready = asyncio.Event()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._task = None
+        self.closed = False
+        outbound_stats.queues.add(self)
+
+    def __len__(self):
+        return len(self._frames)
+
+    def put(self, text, key=None, traces=(), **attributes):
+        """Queue a frame; False means the policy is 'disconnect' and the queue is full"""
+        if self.closed:
+            finish_traces(traces, dropped=True)
+            return True
+        if self.policy != 'coalesce':
+            key = None
+        if key is not None and key in self._keyed:
+            self._keyed[key][1] = text
+            outbound_stats.coalesced += 1
+            return True
+        if len(self._frames) >= self.size:
+            outbound_stats.overflows += 1
+            if self.policy == 'disconnect':
+                outbound_stats.dropped += len(self._frames)
+                outbound_stats.disconnects += 1
+                finish_traces(traces, dropped=True)
+                self.stop()
+                self.closed = True
+                return False
+            if self.policy == 'coalesce':
+                self._collapse()
+            if len(self._frames) >= self.size:
+                self._drop_oldest()
+        entry = [key, text, traces, attributes, time.time_ns()]
+        self._frames.append(entry)
+        if key is not None:
+            self._keyed[key] = entry
+        self._idle.clear()
+        self._ready.set()
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+        return True
+
+    def _drop_oldest(self):
+        key, _, traces, _, _ = self._frames.popleft()
+        self._keyed.pop(key, None)
+        finish_traces(traces, dropped=True)
+        outbound_stats.dropped += 1
+
+    def _collapse(self):
+        """Replace queued messages with one resync frame; the client refetches what it missed"""
+        kept = deque(entry for entry in self._frames if entry[0] is not None)
+        dropped = [entry for entry in self._frames if entry[0] is None]
+        if not dropped:
+            return
+        for entry in dropped:
+            finish_traces(entry[2], dropped=True)
+        outbound_stats.dropped += len(dropped)
+        kept.append([None, json.dumps({'type': 'resync', 'dropped': len(dropped)}), (), {}, time.time_ns()])
+        self._frames = kept
+
+    async def _run(self):
+        while True:
+            await self._ready.wait()
+            while self._frames:
+                key, text, traces, attributes, queued_at = self._frames.popleft()
+                self._keyed.pop(key, None)
+                started = time.time_ns()
+                try:
+                    await self.write(text)
+                    await self._wait_for_client()
+                except Exception as e:
+                    logger.debug(f"Dropping outbound frame: {e!r}")
+                for trace in traces:
+                    trace.record('outbound_queue', queued_at, started)
+                    trace.record('send', started, **attributes)
+                    trace.finish()
+            self._ready.clear()
+            self._idle.set()
+
+    async def _wait_for_client(self):
+        """Hold further writes while the client has not read what it was sent"""
+        if self.gate is None or self.gate.open.is_set():
+            return
+        outbound_stats.blocked_writes += 1
+        await self.gate.open.wait()
+
+    async def flush(self, timeout=None):
+        """Wait until every queued frame has been written"""
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        for entry in self._frames:
+            finish_traces(entry[2], dropped=True)
+        self._frames.clear()
+        self._keyed.clear()
+        self._idle.set()
+
+
+def finish_traces(traces, **attributes):
+    for trace in traces:
+        trace.finish(**attributes)
+
+
+class QueuedSendMixin:
+    """Routes a consumer's send() through an OutboundQueue and flushes it before close()"""
+
+    def start_outbound(self):
+        self.outbound = OutboundQueue(
+            self._write_frame, settings.OUTBOUND_QUEUE_SIZE, settings.OUTBOUND_QUEUE_POLICY,
+            gate=register_write_gate(self.base_send),
+        )
+
+    async def _write_frame(self, text):
+        await super().send(text_data=text)
+
+    async def send(self, text_data=None, bytes_data=None, close=False, coalesce_key=None, traces=(), span_attributes=None):
+        """Queue a text frame; `traces` are finished with a 'send' span (plus span_attributes) once it is written"""
+        if bytes_data is not None or close:
+            await self.outbound.flush(settings.OUTBOUND_FLUSH_TIMEOUT)
+            await super().send(text_data=text_data, bytes_data=bytes_data, close=close)
+            return
+        if not self.outbound.put(text_data, coalesce_key, traces, **(span_attributes or {})):
+            logger.warning('Slow consumer disconnected', extra={'event': 'ws.slow_consumer', 'channel': self.channel_name})
+            await super().close(code=SLOW_CONSUMER_CLOSE_CODE)
+
+    async def close(self, code=None, reason=None):
+        await self.outbound.flush(settings.OUTBOUND_FLUSH_TIMEOUT)
+        await super().close(code=code, reason=reason)
+
+    def stop_outbound(self):
+        self.outbound.stop()
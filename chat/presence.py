@@ -0,0 +1,221 @@
+import asyncio
+import json
+import time
+from datetime import datetime
+
+from django.conf import settings
+
+
+class LocalPresenceStore:
+    """Online/typing state kept in this process; correct only with a single worker"""
+
+    def __init__(self):
+        # room_id -> {user_id: {'user_name', 'last_seen'}}
+        self.online = {}
+        # room_id -> {user_id: {'user_name', 'expires'}}
+        self.typing = {}
+
+    async def join(self, room_id, user_id, user_name):
+        """Mark a user online and return the room's online user ids"""
+        self.online.setdefault(room_id, {})[user_id] = {
+            'user_name': user_name,
+            'last_seen': datetime.now().isoformat()
+        }
+        return list(self.online[room_id].keys())
+
+    async def leave(self, room_id, user_id):
+        """Mark a user offline and return the remaining online user ids"""
+        users = self.online.get(room_id)
+        if users is None:
+            return []
+        users.pop(user_id, None)
+        if not users:
+            del self.online[room_id]
+        return list(users.keys())
+
+    async def heartbeat(self, room_id, user_id):
+        users = self.online.get(room_id, {})
+        if user_id in users:
+            users[user_id]['last_seen'] = datetime.now().isoformat()
+
+    async def online_users(self, room_id):
+        return dict(self.online.get(room_id, {}))
+
+    def online_user_ids(self, room_ids):
+        """Online user ids of several rooms, for sync callers"""
+        return {room_id: list(self.online.get(str(room_id), {})) for room_id in room_ids}
+
+    async def set_typing(self, room_id, user_id, user_name, timeout):
+        self.typing.setdefault(room_id, {})[user_id] = {
+            'user_name': user_name,
+            'expires': time.time() + timeout
+        }
+
+    async def clear_typing(self, room_id, user_id):
+        """Remove a user's typing entry; returns True if they were typing"""
+        typing = self.typing.get(room_id)
+        if not typing or user_id not in typing:
+            return False
+        del typing[user_id]
+        if not typing:
+            del self.typing[room_id]
+        return True
+
+    async def typing_users(self, room_id):
+        """Drop expired typing entries and return the users still typing in a room"""
+        typing = self.typing.get(room_id)
+        if not typing:
+            return []
+        now = time.time()
+        for user_id in [uid for uid, info in typing.items() if info['expires'] <= now]:
+            del typing[user_id]
+        if not typing:
+            del self.typing[room_id]
+        return [{'user_id': uid, 'user_name': info['user_name']} for uid, info in typing.items()]
+
+    async def claim_typing_flush(self, room_id, interval):
+        """Only one flusher per room exists in a single process"""
+        return True
+
+
+class RedisPresenceStore:
+    """Online/typing state in Redis hashes, shared by every worker and node.
+
+    Each user's last join/heartbeat is also kept in a sorted set; users not seen
+    for PRESENCE_TTL seconds are pruned, so a worker that dies without running
+    disconnect handlers doesn't leave ghosts in a room that stays busy.
+    """
+
+    def __init__(self, url):
+        self.url = url
+        self._clients = {}
+        self._sync_client = None
+
+    @property
+    def redis(self):
+        # redis.asyncio clients are bound to the loop they were created on;
+        # async_to_sync makes a loop per call, so forget clients of closed loops
+        loop = asyncio.get_running_loop()
+        for old_loop in [old for old in self._clients if old.is_closed()]:
+            del self._clients[old_loop]
+        client = self._clients.get(loop)
+        if client is None:
+            from redis import asyncio as aioredis
+            client = self._clients[loop] = aioredis.from_url(self.url)
+        return client
+
+    @property
+    def sync_redis(self):
+        """A thread-safe client for sync code (views), so it needs no event loop"""
+        if self._sync_client is None:
+            import redis
+            self._sync_client = redis.Redis.from_url(self.url)
+        return self._sync_client
+
+    async def _prune(self, room_id):
+        seen = f'presence-seen:{room_id}'
+        stale = await self.redis.zrangebyscore(seen, '-inf', time.time() - settings.PRESENCE_TTL)
+        if stale:
+            async with self.redis.pipeline(transaction=True) as pipe:
+                pipe.zrem(seen, *stale)
+                pipe.hdel(f'presence:{room_id}', *stale)
+                await pipe.execute()
+
+    async def join(self, room_id, user_id, user_name):
+        key, seen = f'presence:{room_id}', f'presence-seen:{room_id}'
+        await self._prune(room_id)
+        entry = json.dumps({'user_name': user_name, 'last_seen': datetime.now().isoformat()})
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.hset(key, user_id, entry)
+            pipe.zadd(seen, {user_id: time.time()})
+            pipe.expire(key, settings.PRESENCE_TTL)
+            pipe.expire(seen, settings.PRESENCE_TTL)
+            pipe.hkeys(key)
+            *_, user_ids = await pipe.execute()
+        return [uid.decode() for uid in user_ids]
+
+    async def leave(self, room_id, user_id):
+        key = f'presence:{room_id}'
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.hdel(key, user_id)
+            pipe.zrem(f'presence-seen:{room_id}', user_id)
+            pipe.hkeys(key)
+            *_, user_ids = await pipe.execute()
+        return [uid.decode() for uid in user_ids]
+
+    async def heartbeat(self, room_id, user_id):
+        key, seen = f'presence:{room_id}', f'presence-seen:{room_id}'
+        entry = await self.redis.hget(key, user_id)
+        if entry is None:
+            return
+        info = json.loads(entry)
+        info['last_seen'] = datetime.now().isoformat()
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.hset(key, user_id, json.dumps(info))
+            pipe.zadd(seen, {user_id: time.time()})
+            pipe.expire(key, settings.PRESENCE_TTL)
+            pipe.expire(seen, settings.PRESENCE_TTL)
+            await pipe.execute()
+
+    async def online_users(self, room_id):
+        await self._prune(room_id)
+        entries = await self.redis.hgetall(f'presence:{room_id}')
+        return {uid.decode(): json.loads(info) for uid, info in entries.items()}
+
+    def online_user_ids(self, room_ids):
+        """Online user ids of several rooms, for sync callers; users past PRESENCE_TTL are left out"""
+        cutoff = time.time() - settings.PRESENCE_TTL
+        with self.sync_redis.pipeline(transaction=False) as pipe:
+            for room_id in room_ids:
+                pipe.zrangebyscore(f'presence-seen:{room_id}', '-inf', cutoff)
+                pipe.hkeys(f'presence:{room_id}')
+            results = pipe.execute()
+        online = {}
+        for room_id, stale, user_ids in zip(room_ids, results[::2], results[1::2]):
+            stale = set(stale)
+            online[room_id] = [uid.decode() for uid in user_ids if uid not in stale]
+        return online
+
+    async def set_typing(self, room_id, user_id, user_name, timeout):
+        key = f'typing:{room_id}'
+        entry = json.dumps({'user_name': user_name, 'expires': time.time() + timeout})
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.hset(key, user_id, entry)
+            pipe.expire(key, max(1, int(timeout) * 2))
+            await pipe.execute()
+
+    async def clear_typing(self, room_id, user_id):
+        return bool(await self.redis.hdel(f'typing:{room_id}', user_id))
+
+    async def typing_users(self, room_id):
+        key = f'typing:{room_id}'
+        entries = await self.redis.hgetall(key)
+        now = time.time()
+        users, expired = [], []
+        for uid, info in entries.items():
+            info = json.loads(info)
+            if info['expires'] <= now:
+                expired.append(uid)
+            else:
+                users.append({'user_id': uid.decode(), 'user_name': info['user_name']})
+        if expired:
+            await self.redis.hdel(key, *expired)
+        return sorted(users, key=lambda user: user['user_id'])
+
+    async def claim_typing_flush(self, room_id, interval):
+        """Let one worker per room broadcast each typing interval"""
+        return bool(await self.redis.set(f'typing-flush:{room_id}', 1, nx=True, px=max(1, int(interval * 1000))))
+
+
+_store = None
+
+
+def get_presence_store():
+    """Return the configured presence store (Redis when PRESENCE_BACKEND='redis')"""
+    global _store
+    if _store is None:
+        if settings.PRESENCE_BACKEND == 'redis':
+            _store = RedisPresenceStore(settings.REDIS_URLS[0])
+        else:
+            _store = LocalPresenceStore()
+    return _store
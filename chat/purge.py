@@ -0,0 +1,60 @@
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import Message, Room, RoomDeletion
+
+logger = logging.getLogger('chat')
+
+
+def purge_room(room_id):
+    """Delete a deleted room's messages in bounded batches, then the room itself.
+
+    Safe to re-run: progress lives in RoomDeletion and each batch only looks at
+    what is still there, so an interrupted purge resumes where it stopped.
+    """
+    deletion = RoomDeletion.objects.get(room_id=room_id)
+    if deletion.finished_at:
+        return deletion
+    if deletion.total_messages is None:
+        deletion.total_messages = deletion.deleted_messages + Message.objects.filter(room_id=room_id).count()
+        deletion.save(update_fields=['total_messages'])
+
+    batch_size = settings.ROOM_PURGE_BATCH_SIZE
+    while True:
+        ids = list(Message.objects.filter(room_id=room_id).values_list('id', flat=True)[:batch_size])
+        if not ids:
+            break
+        # Message has no dependents, so this is a single DELETE ... WHERE id IN (...)
+        deleted, _ = Message.objects.filter(id__in=ids).delete()
+        RoomDeletion.objects.filter(pk=deletion.pk).update(deleted_messages=F('deleted_messages') + deleted)
+        # Leave room for foreground queries between batches
+        time.sleep(settings.ROOM_PURGE_PAUSE)
+
+    # Only a bounded amount of rows (rollups, memberships) is left to cascade
+    Room.all_objects.filter(id=room_id).delete()
+    RoomDeletion.objects.filter(pk=deletion.pk).update(finished_at=timezone.now())
+    deletion.refresh_from_db()
+    logger.info(f"Purged room {room_id} ({deletion.deleted_messages} messages)")
+    return deletion
+
+
+def _purge_in_background(room_id):
+    try:
+        purge_room(room_id)
+    except Exception:
+        logger.exception(f"Purge of room {room_id} failed; rerun with manage.py purge_deleted_rooms")
+    finally:
+        close_old_connections()
+
+
+def schedule_room_purge(room_id):
+    """Purge a room on a background thread once the current transaction commits"""
+    transaction.on_commit(
+        lambda: threading.Thread(target=_purge_in_background, args=(room_id,), name=f'purge-room-{room_id}', daemon=True).start()
+    )
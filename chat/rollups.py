@@ -0,0 +1,104 @@
+from datetime import timedelta, timezone
+
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Sum
+from django.db.models.functions import ExtractHour, TruncDate, TruncHour
+from django.utils import timezone as dj_timezone
+
+from .models import Message, RoomDailySender, RoomHourlyActivity
+
+# Longest range the stats endpoint will aggregate
+MAX_STATS_DAYS = 365
+
+
+def sender_key(user_id, user_name):
+    if user_id:
+        return f'user:{user_id}'
+    return f'name:{user_name}'[:160]
+
+
+def _increment(model, **key):
+    """Add one to a rollup row, creating it on first use"""
+    if model.objects.filter(**key).update(message_count=F('message_count') + 1):
+        return
+    try:
+        with transaction.atomic():
+            model.objects.create(message_count=1, **key)
+    except IntegrityError:
+        # Another writer created the row between our update and insert
+        model.objects.filter(**key).update(message_count=F('message_count') + 1)
+
+
+def record_message(message):
+    """Count a newly inserted message into the hourly and per-sender rollups"""
+    hour = message.created_at.astimezone(timezone.utc).replace(minute=0, second=0, microsecond=0)
+    _increment(RoomHourlyActivity, room_id=message.room_id, hour=hour)
+    _increment(RoomDailySender, room_id=message.room_id, day=hour.date(), sender=sender_key(message.user_id, message.user_name))
+
+
+def _whole_days(since, until):
+    """[since, until) widened to UTC day boundaries, so no rollup bucket is cut in two"""
+    start = since.astimezone(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+    until = until.astimezone(timezone.utc)
+    end = until.replace(hour=0, minute=0, second=0, microsecond=0)
+    if end < until:
+        end += timedelta(days=1)
+    return start, end
+
+
+def rebuild_rollups(since, until, room_id=None):
+    """Recompute rollups for the UTC days overlapping [since, until) from raw messages (catch-up / repair job)"""
+    since, until = _whole_days(since, until)
+    messages = Message.objects.filter(created_at__gte=since, created_at__lt=until)
+    hourly = RoomHourlyActivity.objects.filter(hour__gte=since, hour__lt=until)
+    senders = RoomDailySender.objects.filter(day__gte=since.date(), day__lt=until.date())
+    if room_id is not None:
+        messages = messages.filter(room_id=room_id)
+        hourly = hourly.filter(room_id=room_id)
+        senders = senders.filter(room_id=room_id)
+
+    with transaction.atomic():
+        hourly.delete()
+        senders.delete()
+        RoomHourlyActivity.objects.bulk_create(
+            RoomHourlyActivity(room_id=row['room_id'], hour=row['bucket'], message_count=row['n'])
+            for row in messages.annotate(bucket=TruncHour('created_at', tzinfo=timezone.utc))
+            .values('room_id', 'bucket').annotate(n=Count('id')).order_by()
+        )
+        rows = {}
+        for row in (
+            messages.annotate(bucket=TruncDate('created_at', tzinfo=timezone.utc))
+            .values('room_id', 'bucket', 'user_id', 'user_name').annotate(n=Count('id')).order_by()
+        ):
+            key = (row['room_id'], row['bucket'], sender_key(row['user_id'], row['user_name']))
+            rows[key] = rows.get(key, 0) + row['n']
+        RoomDailySender.objects.bulk_create(
+            RoomDailySender(room_id=room, day=day, sender=sender, message_count=n)
+            for (room, day, sender), n in rows.items()
+        )
+    return len(rows)
+
+
+def room_activity_stats(room_id, days):
+    """Daily message counts, active users and peak hours of a room, read from rollups only"""
+    since = dj_timezone.now().astimezone(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=days - 1)
+    senders = RoomDailySender.objects.filter(room_id=room_id, day__gte=since.date())
+    daily = [
+        {'day': row['day'].isoformat(), 'messages': row['messages'], 'active_users': row['active_users']}
+        for row in senders.values('day').annotate(messages=Sum('message_count'), active_users=Count('id')).order_by('day')
+    ]
+    peak_hours = [
+        {'hour': row['hour_of_day'], 'messages': row['messages']}
+        for row in RoomHourlyActivity.objects.filter(room_id=room_id, hour__gte=since)
+        .annotate(hour_of_day=ExtractHour('hour', tzinfo=timezone.utc))
+        .values('hour_of_day').annotate(messages=Sum('message_count')).order_by('-messages', 'hour_of_day')[:3]
+    ]
+    return {
+        'room_id': room_id,
+        'days': daily,
+        'totals': {
+            'messages': sum(day['messages'] for day in daily),
+            'active_users': senders.values('sender').distinct().count(),
+        },
+        'peak_hours': peak_hours,
+    }
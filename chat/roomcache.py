@@ -0,0 +1,92 @@
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from .models import Room
+from .serializers import RoomSerializer, member_preview
+
+# How often a request that lost the rebuild race looks for the winner's result
+LOCK_POLL_INTERVAL = 0.05
+
+# Cached in place of the document of a room that does not exist (for ROOM_DOC_MISSING_TTL)
+MISSING = 'missing'
+
+
+def _generation_key(room_id):
+    return f'room-doc-gen:{room_id}'
+
+
+def _document_key(room_id, generation):
+    return f'room-doc:{room_id}:{generation}'
+
+
+def _generation(room_id):
+    """The room's current generation token, starting a new one if the cache lost it"""
+    key = _generation_key(room_id)
+    generation = cache.get(key)
+    if generation is None:
+        cache.add(key, uuid.uuid4().hex, timeout=None)
+        generation = cache.get(key)
+    return generation
+
+
+def build_room_document(room_id):
+    room = Room.objects.filter(pk=room_id).prefetch_related(member_preview()).first()
+    return None if room is None else RoomSerializer(room).data
+
+
+def room_document(room_id):
+    """The serialized room from the cache, built at most once per change; None if there is no such room.
+
+    On a miss one request takes a short lock (cache.add) and rebuilds; concurrent
+    misses wait for its result instead of all querying and serializing. Unknown
+    rooms are remembered as MISSING for ROOM_DOC_MISSING_TTL seconds.
+    """
+    key = _document_key(room_id, _generation(room_id))
+    document = cache.get(key)
+    if document is not None:
+        return None if document == MISSING else document
+
+    lock = f'{key}:lock'
+    if not cache.add(lock, 1, timeout=settings.ROOM_DOC_LOCK_TIMEOUT):
+        deadline = time.monotonic() + settings.ROOM_DOC_LOCK_TIMEOUT
+        while time.monotonic() < deadline:
+            time.sleep(LOCK_POLL_INTERVAL)
+            document = cache.get(key)
+            if document is not None:
+                return None if document == MISSING else document
+            if cache.get(lock) is None:
+                # The holder gave up without storing anything
+                break
+        # The rebuilding request failed or is stuck; serve this one uncached
+        return build_room_document(room_id)
+    try:
+        document = build_room_document(room_id)
+        if document is None:
+            cache.set(key, MISSING, timeout=settings.ROOM_DOC_MISSING_TTL)
+        else:
+            cache.set(key, dict(document), timeout=settings.ROOM_DOC_CACHE_TTL)
+    finally:
+        cache.delete(lock)
+    return document
+
+
+def _bump(room_ids):
+    # A fresh token rather than a counter: a lost or expired generation can never
+    # come back to a number whose documents are still cached
+    for room_id in room_ids:
+        cache.set(_generation_key(room_id), uuid.uuid4().hex, timeout=None)
+
+
+def invalidate_room_documents(room_ids):
+    """Retire the cached documents of these rooms.
+
+    Also done again at commit: a rebuild that read the rows before the write
+    committed would otherwise stay cached.
+    """
+    room_ids = list(room_ids)
+    _bump(room_ids)
+    transaction.on_commit(lambda: _bump(room_ids))
@@ -0,0 +1,51 @@
+import string
+
+from django.core.cache import cache
+from django.utils.crypto import get_random_string
+
+ROOM_KEY_LENGTH = 8
+ROOM_KEY_CHARS = string.ascii_uppercase + string.digits
+
+
+def normalize_room_key(key):
+    """Keys are stored upper-case so joins can use the unique index with an exact match"""
+    return (key or '').strip().upper()
+
+
+def generate_room_key():
+    return get_random_string(ROOM_KEY_LENGTH, allowed_chars=ROOM_KEY_CHARS)
+
+
+class MissingKeyCache:
+    """Recently tried keys that matched no room, so repeated wrong guesses skip the database.
+
+    Kept in the shared Django cache, so a room created through one worker clears
+    the miss for every other worker at once.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+
+    @staticmethod
+    def _cache_key(key):
+        return f'room-key-miss:{key}'
+
+    def __contains__(self, key):
+        return cache.get(self._cache_key(key)) is not None
+
+    def add(self, key):
+        cache.set(self._cache_key(key), 1, timeout=self.ttl)
+
+    def discard(self, key):
+        cache.delete(self._cache_key(key))
+
+
+_missing_keys = None
+
+
+def missing_room_keys():
+    global _missing_keys
+    if _missing_keys is None:
+        from django.conf import settings
+        _missing_keys = MissingKeyCache(settings.ROOM_KEY_MISS_CACHE_TTL)
+    return _missing_keys
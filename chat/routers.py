@@ -0,0 +1,50 @@
+import time
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import connections
+
+REPLICA_DATABASE = 'replica'
+
+# Routing state of the current request or WebSocket connection. It is a mutable
+# dict so writes made inside sync_to_async threads (which run in a copy of the
+# context) are still seen by the code that created it.
+routing_state = ContextVar('db_routing_state', default=None)
+
+
+def new_routing_state(pinned_until=0.0):
+    """Create and activate routing state; reads stay on the primary until pinned_until (epoch seconds)"""
+    state = {'pinned_until': pinned_until}
+    routing_state.set(state)
+    return state
+
+
+class PrimaryReplicaRouter:
+    """Send reads to the replica, except for a caller that wrote within REPLICA_PIN_SECONDS.
+
+    Every write pins the current request/connection to the primary so it always
+    reads its own writes; the middleware carries that pin over to the writer's
+    next requests.
+    """
+
+    def db_for_read(self, model, **hints):
+        state = routing_state.get()
+        if state is not None and state['pinned_until'] > time.time():
+            return 'default'
+        if connections['default'].in_atomic_block:
+            return 'default'
+        return REPLICA_DATABASE
+
+    def db_for_write(self, model, **hints):
+        state = routing_state.get()
+        if state is not None:
+            state['pinned_until'] = time.time() + settings.REPLICA_PIN_SECONDS
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Both aliases hold the same data
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # The replica receives schema changes through replication
+        return db == 'default'
@@ -1,15 +1,31 @@
 from rest_framework import serializers
+from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.db.models import Prefetch
 from .models import Room, Message, Feedback
 
 User = get_user_model()
 
 
 class MessageSerializer(serializers.ModelSerializer):
-    user_id = serializers.IntegerField(source='user.id', read_only=True)
+    # The raw column: 'user.id' would load the whole user row for every message
+    user_id = serializers.IntegerField(read_only=True)
     class Meta:
         model = Message
-        fields = ('id', 'user_name', 'user_id', 'content', 'created_at')
+        fields = ('id', 'user_name', 'user_id', 'content', 'created_at', 'client_msg_id')
+        read_only_fields = ('client_msg_id',)
+
+
+def member_preview():
+    """Prefetch the first few members of every room in one query"""
+    users = User.objects.order_by('id')[:settings.ROOM_MEMBER_PREVIEW_SIZE]
+    return Prefetch('members', queryset=users, to_attr='member_preview')
+
+
+class MemberSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = User
+        fields = ('id', 'username', 'first_name', 'last_name')
 
 
 class RoomSerializer(serializers.ModelSerializer):
@@ -19,14 +35,18 @@ class RoomSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Room
-        fields = ('id', 'name', 'created_at', 'key', 'creator_id', 'members', 'last_messages')
+        fields = ('id', 'name', 'created_at', 'key', 'creator_id', 'member_count', 'members', 'last_messages')
 
     def get_last_messages(self, obj):
         msgs = obj.messages.order_by('-created_at')[:10]
         return MessageSerializer(msgs, many=True).data
 
     def get_members(self, obj):
-        return [{'id': u.id, 'username': u.username, 'first_name': getattr(u, 'first_name', ''), 'last_name': getattr(u, 'last_name', '')} for u in obj.members.all()]
+        # A preview only; the full list is paginated at /api/rooms/<id>/members/
+        preview = getattr(obj, 'member_preview', None)
+        if preview is None:
+            preview = obj.members.order_by('id')[:settings.ROOM_MEMBER_PREVIEW_SIZE]
+        return MemberSerializer(preview, many=True).data
 
 
 class FeedbackSerializer(serializers.ModelSerializer):
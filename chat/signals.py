@@ -0,0 +1,109 @@
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db.models import Count, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .bans import room_bans
+from .models import Message, Room, RoomBan
+from .roomcache import invalidate_room_documents
+from .rollups import record_message
+
+
+@receiver(post_save, sender=Message)
+def count_message_in_rollups(sender, instance, created, raw=False, **kwargs):
+    """Keep activity rollups current as messages are inserted"""
+    if created and not raw and settings.ROLLUPS_ON_INSERT:
+        record_message(instance)
+
+
+@receiver(post_save, sender=Message)
+def drop_document_on_message(sender, instance, created, raw=False, **kwargs):
+    # Room documents embed the latest messages
+    if created and not raw:
+        invalidate_room_documents([instance.room_id])
+
+
+@receiver(post_save, sender=Room)
+@receiver(post_delete, sender=Room)
+def drop_room_document(sender, instance, raw=False, **kwargs):
+    """Renames, soft deletes and purges"""
+    if not raw:
+        invalidate_room_documents([instance.pk])
+
+
+@receiver(post_save, sender=RoomBan)
+@receiver(post_delete, sender=RoomBan)
+def drop_cached_bans(sender, instance, **kwargs):
+    room_bans().invalidate(instance.room_id)
+
+
+def refresh_members(room_ids):
+    """Recount member_count and bump updated_at (membership is part of the room document and its ETag)"""
+    counts = (
+        Room.members.through.objects.filter(room_id=OuterRef('pk'))
+        .order_by().values('room_id').annotate(n=Count('id')).values('n')
+    )
+    Room.all_objects.filter(pk__in=room_ids).update(
+        member_count=Coalesce(Subquery(counts), 0), updated_at=timezone.now(),
+    )
+    invalidate_room_documents(room_ids)
+
+
+def adjust_members(room_ids, delta):
+    """Add delta to member_count without recounting the room's members"""
+    Room.all_objects.filter(pk__in=room_ids).update(
+        member_count=F('member_count') + delta, updated_at=timezone.now(),
+    )
+    invalidate_room_documents(room_ids)
+
+
+@receiver(m2m_changed, sender=Room.members.through)
+def membership_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    memberships = Room.members.through.objects
+    if reverse and action == 'pre_clear':
+        # user.rooms.clear() doesn't say which rooms it left, so remember them first
+        instance._cleared_room_ids = list(instance.rooms.values_list('id', flat=True))
+        return
+    if action == 'pre_remove':
+        # pk_set also holds ids that were never members; note the rows that really go
+        if reverse:
+            instance._removed_rooms = list(memberships.filter(user_id=instance.pk, room_id__in=pk_set).values_list('room_id', flat=True))
+        else:
+            instance._removed_members = memberships.filter(room_id=instance.pk, user_id__in=pk_set).count()
+        return
+    if action == 'post_clear':
+        # Rare; recounting is simpler than tracking what went
+        room_ids = instance.__dict__.pop('_cleared_room_ids', []) if reverse else [instance.pk]
+        if room_ids:
+            refresh_members(room_ids)
+    elif action == 'post_add' and pk_set:
+        # pk_set only holds the rows actually inserted
+        if reverse:
+            adjust_members(pk_set, 1)
+        else:
+            adjust_members([instance.pk], len(pk_set))
+    elif action == 'post_remove':
+        if reverse:
+            room_ids = instance.__dict__.pop('_removed_rooms', [])
+            if room_ids:
+                adjust_members(room_ids, -1)
+        else:
+            removed = instance.__dict__.pop('_removed_members', 0)
+            if removed:
+                adjust_members([instance.pk], -removed)
+
+
+@receiver(pre_delete, sender=get_user_model())
+def leave_rooms_on_delete(sender, instance, **kwargs):
+    # The cascade removes membership rows without m2m_changed
+    instance._deleted_room_ids = list(instance.rooms.values_list('id', flat=True))
+
+
+@receiver(post_delete, sender=get_user_model())
+def recount_rooms_after_delete(sender, instance, **kwargs):
+    room_ids = instance.__dict__.pop('_deleted_room_ids', [])
+    if room_ids:
+        refresh_members(room_ids)
@@ -1,5 +1,48 @@
-from django.test import TestCase
-from .models import Room, Message
+from channels.testing import WebsocketCommunicator
+from channels_redis.pubsub import RedisPubSubChannelLayer, RedisSingleShardConnection
+import asyncio
+from asgiref.sync import async_to_sync
+import io
+import json
+import logging
+import os
+import signal
+import tempfile
+import time
+from datetime import timedelta
+from unittest import mock
+from channels.generic.websocket import AsyncWebsocketConsumer
+from channels.layers import get_channel_layer
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.core.cache import cache
+from django.db.models import Sum
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.db import connection
+from django.urls import reverse
+from chatbackend_out.asgi import application
+from .admission import admission, OVERLOADED_CLOSE_CODE
+from .bans import MEMBER_REMOVED_CLOSE_CODE, room_bans
+from .benchmark import benchmark_context, chat_route_names, compare_to_baseline, run_routes, seed
+from .consumers import INVALID_ROOM_CLOSE_CODE, ROOM_DELETED_CLOSE_CODE
+from .logs import JsonFormatter, QueueingStreamHandler, SamplingFilter
+from .outbound import OutboundQueue, WriteGate, outbound_stats, register_write_gate
+from .loopmonitor import loop_monitor
+from .admin import ApproximateCountPaginator
+from .dbpool import db_pool, db_sync_to_async
+from .drain import RECONNECT_CLOSE_CODE, Drainer, drainer
+from .idempotency import recent_messages
+from .middleware import PIN_COOKIE, PIN_HEADER, ReplicaPinningMiddleware
+from .models import Room, RoomBan, Message, RoomDailySender, RoomHourlyActivity
+from .presence import RedisPresenceStore, get_presence_store
+from .roomkeys import MissingKeyCache
+from .purge import purge_room
+from .tracing import SpanExporter
+from .routers import PrimaryReplicaRouter, routing_state
+from .workers import collect_worker_metrics
 
 
 class ChatModelTests(TestCase):
@@ -8,3 +51,995 @@ class ChatModelTests(TestCase):
         message = Message.objects.create(room=room, user_name='tester', content='Hello')
         self.assertEqual(Message.objects.count(), 1)
         self.assertEqual(room.messages.count(), 1)
+
+
+class TypingIndicatorTests(TestCase):
+    @override_settings(TYPING_BROADCAST_INTERVAL=0.05, TYPING_TIMEOUT=0.2)
+    async def test_typing_is_aggregated_per_room(self):
+        typist = WebsocketCommunicator(application, '/ws/chat/1/')
+        watcher = WebsocketCommunicator(application, '/ws/chat/1/')
+        await typist.connect()
+        await watcher.connect()
+        await typist.send_json_to({'type': 'user_connected', 'user_id': 7, 'user_name': 'ann'})
+        await typist.receive_json_from()
+        await watcher.receive_json_from()
+
+        for _ in range(5):
+            await typist.send_json_to({'type': 'typing'})
+        frame = await watcher.receive_json_from(timeout=1)
+        self.assertEqual(frame['type'], 'typing')
+        self.assertEqual(frame['users'], [{'user_id': '7', 'user_name': 'ann'}])
+        # Repeated keystrokes collapse into the single frame above
+        await typist.send_json_to({'type': 'typing', 'is_typing': False})
+        frame = await watcher.receive_json_from(timeout=1)
+        self.assertEqual(frame['users'], [])
+
+        await typist.disconnect()
+        await watcher.disconnect()
+
+
+class FakeRedisShard(RedisSingleShardConnection):
+    """Local Redis stand-in: routes PUBLISH to every shard subscribed on the same host"""
+    def __init__(self, host, channel_layer, broker):
+        super().__init__(host, channel_layer)
+        self.broker = broker
+
+    async def publish(self, channel, message):
+        self.broker['published'].append((self.host, channel))
+        for shard in list(self.broker['subscribers'].get((self.host, channel), ())):
+            shard._receive_message({'channel': channel, 'data': message})
+
+    async def subscribe(self, channel):
+        self.broker['subscribers'].setdefault((self.host, channel), set()).add(self)
+
+    async def unsubscribe(self, channel):
+        self.broker['subscribers'].get((self.host, channel), set()).discard(self)
+
+    async def flush(self):
+        for subscribers in self.broker['subscribers'].values():
+            subscribers.discard(self)
+
+
+class PubSubChannelLayerTests(TestCase):
+    async def test_group_send_publishes_once_per_message(self):
+        hosts = ['redis://shard-a:6379', 'redis://shard-b:6379']
+        broker = {'published': [], 'subscribers': {}}
+        nodes = []
+        for _ in range(2):
+            layer = RedisPubSubChannelLayer(hosts=hosts)
+            loop_layer = layer._get_layer()
+            loop_layer._shards = [FakeRedisShard(host, loop_layer, broker) for host in hosts]
+            nodes.append(layer)
+
+        channels = []
+        for layer in nodes:
+            for _ in range(3):
+                channel = await layer.new_channel()
+                await layer.group_add('room_1', channel)
+                channels.append((layer, channel))
+
+        await nodes[0].group_send('room_1', {'type': 'chat.message', 'message': {'id': 1}})
+        self.assertEqual(len(broker['published']), 1)
+        for layer, channel in channels:
+            received = await layer.receive(channel)
+            self.assertEqual(received['message'], {'id': 1})
+
+
+class FakeAsyncRedis:
+    """In-memory stand-in for the redis.asyncio commands the presence store uses"""
+    def __init__(self):
+        self.hashes, self.zsets = {}, {}
+
+    @staticmethod
+    def _b(value):
+        return value if isinstance(value, bytes) else str(value).encode()
+
+    async def hset(self, key, field, value):
+        self.hashes.setdefault(key, {})[self._b(field)] = self._b(value)
+
+    async def hget(self, key, field):
+        return self.hashes.get(key, {}).get(self._b(field))
+
+    async def hdel(self, key, *fields):
+        return sum(self.hashes.get(key, {}).pop(self._b(f), None) is not None for f in fields)
+
+    async def hkeys(self, key):
+        return list(self.hashes.get(key, {}))
+
+    async def hgetall(self, key):
+        return dict(self.hashes.get(key, {}))
+
+    async def zadd(self, key, mapping):
+        self.zsets.setdefault(key, {}).update({self._b(m): score for m, score in mapping.items()})
+
+    async def zrem(self, key, *members):
+        for member in members:
+            self.zsets.get(key, {}).pop(self._b(member), None)
+
+    async def zrangebyscore(self, key, low, high):
+        return [m for m, score in self.zsets.get(key, {}).items() if score <= high]
+
+    async def expire(self, key, seconds):
+        pass
+
+    def pipeline(self, transaction=True):
+        redis, calls = self, []
+
+        class Pipeline:
+            def __getattr__(self, name):
+                return lambda *args, **kwargs: calls.append(getattr(redis, name)(*args, **kwargs))
+
+            async def execute(self):
+                return [await call for call in calls]
+
+            async def __aenter__(self):
+                return self
+
+            async def __aexit__(self, *exc):
+                return False
+
+        return Pipeline()
+
+
+@override_settings(PRESENCE_TTL=60)
+class RedisPresenceStoreTests(SimpleTestCase):
+    async def test_users_not_seen_within_ttl_are_pruned(self):
+        store = RedisPresenceStore('redis://presence')
+        fake = FakeAsyncRedis()
+        with mock.patch.object(RedisPresenceStore, 'redis', fake):
+            # A worker died without running disconnect: 'ghost' stays in the hash
+            with mock.patch('chat.presence.time.time', return_value=1000.0):
+                await store.join('1', 'ghost', 'Ghost')
+            with mock.patch('chat.presence.time.time', return_value=1050.0):
+                await store.join('1', 'alive', 'Alive')
+            # Other users keep the room busy; only the ghost's own timestamp is old
+            with mock.patch('chat.presence.time.time', return_value=1100.0):
+                await store.heartbeat('1', 'alive')
+                self.assertEqual(list(await store.online_users('1')), ['alive'])
+                self.assertEqual(await store.join('1', 'late', 'Late'), ['alive', 'late'])
+
+
+class AdmissionControlTests(TestCase):
+    @override_settings(ADMISSION_MAX_SOCKETS=1)
+    async def test_connect_refused_with_retry_after_when_full(self):
+        first = WebsocketCommunicator(application, '/ws/chat/1/')
+        await first.connect()
+        second = WebsocketCommunicator(application, '/ws/chat/1/')
+        await second.connect()
+        frame = await second.receive_json_from()
+        self.assertEqual(frame['type'], 'overloaded')
+        closed = await second.receive_output()
+        self.assertEqual(closed, {'type': 'websocket.close', 'code': OVERLOADED_CLOSE_CODE})
+        await first.disconnect()
+        self.assertEqual(admission.open_sockets, 0)
+
+    def test_heavy_routes_shed_while_loop_lags(self):
+        with mock.patch.object(loop_monitor, 'loop_lag', 10.0):
+            response = self.client.get(reverse('rooms-list'))
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(response['Retry-After'], '5')
+            response = self.client.get(reverse('rooms-stats'), {'user_id': 1})
+            self.assertEqual(response.status_code, 200)
+
+
+class SlowConsumer(AsyncWebsocketConsumer):
+    async def blocking_handler(self):
+        time.sleep(0.3)
+
+
+class LoopMonitorTests(TestCase):
+    @override_settings(LOOP_MONITOR_INTERVAL=0.01, LOOP_MONITOR_SLOW_THRESHOLD=0.05)
+    async def test_slow_callback_is_sampled_with_consumer_method(self):
+        loop_monitor.slow_callbacks.clear()
+        loop_monitor.start()
+        await asyncio.sleep(0.05)
+        await SlowConsumer().blocking_handler()
+        await asyncio.sleep(0.05)
+
+        record = loop_monitor.slow_callbacks[-1]
+        self.assertGreaterEqual(record['duration_ms'], 200)
+        self.assertEqual(record['consumer_method'], 'SlowConsumer.blocking_handler')
+        self.assertTrue(any('time.sleep' in line for line in record['stack']))
+
+    def test_debug_endpoint_requires_staff(self):
+        response = self.client.get(reverse('debug-loop'))
+        self.assertEqual(response.status_code, 403)
+
+
+class ServeCommandTests(TestCase):
+    def test_startup_phases_skip_work_already_done(self):
+        get_user_model().objects.create_superuser('admin', 'admin@yapper.com', 'secret-pass')
+        with tempfile.TemporaryDirectory() as static_root:
+            open(os.path.join(static_root, 'staticfiles.json'), 'w').close()
+            out = io.StringIO()
+            with override_settings(STATIC_ROOT=static_root), mock.patch('chat.management.commands.serve.call_command') as nested:
+                call_command('serve', '--no-serve', stdout=out)
+        nested.assert_not_called()
+        for phase in ('setup', 'migrations', 'static', 'admin', 'asgi import'):
+            self.assertIn(f'[serve] {phase}:', out.getvalue())
+
+    @override_settings(REDIS_URLS=['redis://cache:6379'])
+    def test_workers_refuse_a_process_local_cache(self):
+        with self.assertRaisesMessage(CommandError, 'shared cache'):
+            call_command('serve', '--workers', '2', '--no-serve')
+
+
+class WorkerMetricsTests(TestCase):
+    def test_snapshots_of_all_workers_are_combined(self):
+        with tempfile.TemporaryDirectory() as metrics_dir:
+            for pid, sockets in ((101, 3), (102, 4)):
+                with open(os.path.join(metrics_dir, f'{pid}.json'), 'w') as f:
+                    json.dump({
+                        'pid': pid,
+                        'open_sockets': sockets,
+                        'threadpool_queue_depth': 1,
+                        'loop_lag_ms': float(pid - 100),
+                        'lag_histogram': {'buckets': {'1ms': 2}, 'count': 2, 'sum': 0.001, 'max': 0.001},
+                        'slow_callbacks': 0,
+                    }, f)
+            with override_settings(METRICS_DIR=metrics_dir):
+                metrics = collect_worker_metrics()
+        # Two published workers plus the test process itself
+        self.assertEqual(metrics['workers'], 3)
+        self.assertEqual(metrics['open_sockets'], 7)
+        self.assertGreaterEqual(metrics['max_loop_lag_ms'], 2.0)
+        self.assertGreaterEqual(metrics['lag_histogram']['buckets']['1ms'], 4)
+
+
+@override_settings(
+    DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3'}, 'replica': {'ENGINE': 'django.db.backends.sqlite3'}},
+    REPLICA_PIN_SECONDS=5,
+)
+class ReplicaRoutingTests(SimpleTestCase):
+    def test_writer_reads_from_primary_on_following_requests(self):
+        router = PrimaryReplicaRouter()
+        seen = []
+
+        def view(request):
+            seen.append(router.db_for_read(Message))
+            if request.method == 'POST':
+                router.db_for_write(Message)
+                seen.append(router.db_for_read(Message))
+            return HttpResponse()
+
+        # Each request gets its own middleware, as if served by a different worker
+        factory = RequestFactory()
+        ReplicaPinningMiddleware(view)(factory.get('/api/rooms/1/messages/'))
+        response = ReplicaPinningMiddleware(view)(factory.post('/api/rooms/1/messages/'))
+        cookie = response.cookies[PIN_COOKIE].value
+        request = factory.get('/api/rooms/1/messages/')
+        request.COOKIES[PIN_COOKIE] = cookie
+        ReplicaPinningMiddleware(view)(request)
+        ReplicaPinningMiddleware(view)(factory.get('/api/rooms/1/messages/', HTTP_X_DB_PIN=response[PIN_HEADER]))
+        # Another client, and a forged pin, read from the replica
+        ReplicaPinningMiddleware(view)(factory.get('/api/rooms/1/messages/'))
+        ReplicaPinningMiddleware(view)(factory.get('/api/rooms/1/messages/', HTTP_X_DB_PIN='9999999999.0'))
+        self.assertEqual(seen, ['replica', 'replica', 'default', 'default', 'default', 'replica', 'replica'])
+        self.assertIsNone(routing_state.get())
+
+
+class DatabasePoolTests(TestCase):
+    async def test_socket_message_is_saved_and_broadcast(self):
+        communicator = WebsocketCommunicator(application, '/ws/chat/5/')
+        await communicator.connect()
+        await communicator.send_json_to({'user': 'ann', 'content': 'hi'})
+        frame = await communicator.receive_json_from()
+        self.assertEqual(frame['content'], 'hi')
+        self.assertTrue(await Message.objects.filter(id=frame['id'], room_id=5).aexists())
+        await communicator.disconnect()
+
+    @override_settings(DB_POOL_SIZE=4)
+    async def test_pool_runs_blocking_calls_in_parallel(self):
+        started = time.monotonic()
+        await asyncio.gather(*(db_sync_to_async(time.sleep)(0.2) for _ in range(4)))
+        self.assertLess(time.monotonic() - started, 0.6)
+        self.assertEqual(db_pool.in_flight, 0)
+        self.assertGreaterEqual(db_pool.snapshot()['wait_histogram']['count'], 4)
+
+
+@override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+class AdminTests(TestCase):
+    def setUp(self):
+        self.admin_user = get_user_model().objects.create_superuser('boss', 'boss@example.com', 'secret-pass')
+        self.client.force_login(self.admin_user)
+        room = Room.objects.create(name='Big')
+        for i in range(3):
+            Message.objects.create(room=room, user=self.admin_user, user_name='boss', content=str(i))
+
+    def test_changelists_render(self):
+        for url in ('/admin/chat/message/', '/admin/chat/loginlog/', '/admin/chat/room/', '/admin/chat/roomhourlyactivity/', '/admin/chat/message/?created_at__year=2026'):
+            self.assertEqual(self.client.get(url).status_code, 200, url)
+
+    def test_message_rows_are_joined(self):
+        response = self.client.get('/admin/chat/message/')
+        # Each row would otherwise query its room and user
+        self.assertIn('JOIN', str(response.context['cl'].result_list.query))
+
+    def test_count_is_capped(self):
+        with mock.patch('chat.admin.APPROX_COUNT_LIMIT', 2):
+            self.assertEqual(ApproximateCountPaginator(Message.objects.order_by('-id'), 1).count, 2)
+
+
+class ActivityRollupTests(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('ann', 'ann@example.com', 'secret-pass')
+        self.room = Room.objects.create(name='Busy')
+        Message.objects.create(room=self.room, user=self.user, user_name='ann', content='one')
+        Message.objects.create(room=self.room, user=self.user, user_name='ann', content='two')
+        Message.objects.create(room=self.room, user_name='guest', content='three')
+
+    def test_inserts_update_rollups(self):
+        self.assertEqual(RoomHourlyActivity.objects.get(room=self.room).message_count, 3)
+        self.assertEqual(RoomDailySender.objects.filter(room=self.room).count(), 2)
+
+    def test_stats_endpoint_reads_rollups_only(self):
+        with self.assertNumQueries(4):
+            response = self.client.get(reverse('room-stats', args=[self.room.id]))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['totals'], {'messages': 3, 'active_users': 2})
+        self.assertEqual(response.data['days'][0]['active_users'], 2)
+        self.assertEqual(response.data['peak_hours'][0]['messages'], 3)
+
+    def test_catch_up_job_rebuilds_from_messages(self):
+        RoomHourlyActivity.objects.all().delete()
+        RoomDailySender.objects.all().delete()
+        call_command('rollup_activity', '--days', '1', stdout=io.StringIO())
+        self.assertEqual(RoomHourlyActivity.objects.get(room=self.room).message_count, 3)
+        self.assertEqual(
+            dict(RoomDailySender.objects.values_list('sender', 'message_count')),
+            {f'user:{self.user.id}': 2, 'name:guest': 1},
+        )
+
+    def test_rebuild_from_the_middle_of_an_hour_replaces_whole_buckets(self):
+        from .rollups import rebuild_rollups
+        now = Message.objects.latest('created_at').created_at
+        rebuild_rollups(now.replace(minute=0, second=0, microsecond=0) + timedelta(microseconds=1), now + timedelta(seconds=1))
+        self.assertEqual(RoomHourlyActivity.objects.get(room=self.room).message_count, 3)
+        self.assertEqual(RoomDailySender.objects.filter(room=self.room).count(), 2)
+
+
+class RoomKeyTests(TestCase):
+    def setUp(self):
+        self.addCleanup(cache.clear)
+
+    def test_keys_are_normalized_and_joined_by_exact_match(self):
+        room = Room.objects.create(name='Keyed', key=' ab12cd34 ')
+        self.assertEqual(room.key, 'AB12CD34')
+        response = self.client.post(reverse('rooms-join'), {'room_key': 'ab12CD34'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['id'], room.id)
+
+    def test_generated_key_retries_on_collision(self):
+        Room.objects.create(name='First', key='TAKEN000')
+        with mock.patch('chat.models.generate_room_key', side_effect=['TAKEN000', 'FREE0000']):
+            room = Room.objects.create(name='Second')
+        self.assertEqual(room.key, 'FREE0000')
+
+    def test_repeated_wrong_key_skips_database(self):
+        self.client.post(reverse('rooms-join'), {'room_key': 'NOPE1234'})
+        with self.assertNumQueries(0):
+            response = self.client.post(reverse('rooms-join'), {'room_key': 'nope1234'})
+        self.assertEqual(response.status_code, 404)
+        # Creating a room with that key makes it joinable immediately
+        Room.objects.create(name='Late', key='NOPE1234')
+        self.assertEqual(self.client.post(reverse('rooms-join'), {'room_key': 'NOPE1234'}).status_code, 200)
+
+    def test_misses_are_shared_between_workers(self):
+        # Each worker process builds its own MissingKeyCache over the shared cache
+        this_worker, other_worker = MissingKeyCache(60), MissingKeyCache(60)
+        this_worker.add('SHARED00')
+        self.assertIn('SHARED00', other_worker)
+        with self.captureOnCommitCallbacks(execute=True):
+            Room.objects.create(name='Shared', key='SHARED00')
+        self.assertNotIn('SHARED00', other_worker)
+        self.assertNotIn('SHARED00', this_worker)
+
+
+class RoomDeletionTests(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(username='owner', password='x')
+        self.room = Room.objects.create(name='Big', creator=self.user)
+        for i in range(5):
+            Message.objects.create(room=self.room, user_name='owner', content=str(i))
+
+    @override_settings(ROOM_PURGE_BATCH_SIZE=2)
+    def test_delete_returns_at_once_and_purges_in_batches(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            response = self.client.delete(f"{reverse('room-delete', args=[self.room.id])}?user_id={self.user.id}")
+        self.assertEqual(response.status_code, 200)
+        # The purge, and the room document's invalidation repeated at commit
+        self.assertEqual(len(callbacks), 2)
+        self.assertFalse(Room.objects.filter(id=self.room.id).exists())
+        self.assertEqual(self.client.get(reverse('room-messages', args=[self.room.id])).data, [])
+
+        with mock.patch('chat.purge.time') as purge_time:
+            purge_room(self.room.id)
+        self.assertEqual(purge_time.sleep.call_count, 3)
+        self.assertFalse(Room.all_objects.filter(id=self.room.id).exists())
+        status = self.client.get(response.data['status_url']).data
+        self.assertEqual((status['total_messages'], status['deleted_messages'], status['done']), (5, 5, True))
+
+    async def test_open_sockets_are_told_and_closed(self):
+        communicator = WebsocketCommunicator(application, f'/ws/chat/{self.room.id}/')
+        await communicator.connect()
+        await get_channel_layer().group_send(f'room_{self.room.id}', {'type': 'room.deleted', 'room_id': self.room.id})
+        self.assertEqual(await communicator.receive_json_from(), {'type': 'room_deleted', 'room_id': self.room.id})
+        self.assertEqual((await communicator.receive_output())['code'], ROOM_DELETED_CLOSE_CODE)
+        await communicator.disconnect()
+
+    async def test_non_numeric_room_is_refused(self):
+        communicator = WebsocketCommunicator(application, '/ws/chat/lobby/')
+        self.assertTrue((await communicator.connect())[0])
+        self.assertEqual((await communicator.receive_json_from())['detail'], 'Invalid room_id')
+        self.assertEqual((await communicator.receive_output())['code'], INVALID_ROOM_CLOSE_CODE)
+        await communicator.disconnect()
+
+
+class RoomBanTests(TestCase):
+    def setUp(self):
+        User = get_user_model()
+        self.owner = User.objects.create_user(username='owner', password='x')
+        self.member = User.objects.create_user(username='member', password='x')
+        self.room = Room.objects.create(name='Guarded', creator=self.owner)
+        self.room.members.add(self.member)
+        # The rollback after each test doesn't fire post_delete, so drop the cached set by hand
+        self.addCleanup(room_bans().invalidate, self.room.id)
+
+    async def test_ban_evicts_socket_and_blocks_rejoin(self):
+        communicator = WebsocketCommunicator(application, f'/ws/chat/{self.room.id}/')
+        await communicator.connect()
+        await communicator.send_json_to({'type': 'user_connected', 'user_id': self.member.id, 'user_name': 'member'})
+        await communicator.receive_json_from()
+
+        response = await self.async_client.post(
+            reverse('room-ban', args=[self.room.id]),
+            {'target_user_id': self.member.id, 'performer_id': self.owner.id},
+            content_type='application/json',
+        )
+        self.assertEqual(response.status_code, 200)
+        frame = await communicator.receive_json_from()
+        self.assertEqual((frame['type'], frame['reason']), ('removed', 'banned'))
+        self.assertEqual((await communicator.receive_output())['code'], MEMBER_REMOVED_CLOSE_CODE)
+        await communicator.disconnect()
+
+        response = await self.async_client.post(
+            reverse('rooms-join'), {'room_key': self.room.key, 'user_id': self.member.id}, content_type='application/json',
+        )
+        self.assertEqual(response.status_code, 403)
+        # Identifying on a fresh socket is refused from the cached ban set
+        communicator = WebsocketCommunicator(application, f'/ws/chat/{self.room.id}/')
+        await communicator.connect()
+        await communicator.send_json_to({'type': 'user_connected', 'user_id': self.member.id})
+        self.assertEqual((await communicator.receive_json_from())['type'], 'removed')
+        await communicator.disconnect()
+
+
+class MessageBatchingTests(TestCase):
+    @override_settings(BATCH_RATE_THRESHOLD=1.5, BATCH_WINDOW=0.05)
+    async def test_hot_room_messages_are_batched_for_opted_in_clients(self):
+        batched = WebsocketCommunicator(application, '/ws/chat/3/?capabilities=batch')
+        plain = WebsocketCommunicator(application, '/ws/chat/3/')
+        await batched.connect()
+        await plain.connect()
+        layer = get_channel_layer()
+        for i in range(5):
+            await layer.group_send('room_3', {'type': 'chat.message', 'message': {'type': 'message', 'id': i}})
+
+        # Below the threshold the first message goes out alone; the rest share a frame
+        self.assertEqual((await batched.receive_json_from())['id'], 0)
+        frame = await batched.receive_json_from(timeout=1)
+        self.assertEqual(frame['type'], 'batch')
+        self.assertEqual([m['id'] for m in frame['messages']], [1, 2, 3, 4])
+        self.assertEqual([(await plain.receive_json_from())['id'] for _ in range(5)], [0, 1, 2, 3, 4])
+        await batched.disconnect()
+        await plain.disconnect()
+
+
+class ConditionalGetTests(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(username='poller', password='x')
+        self.room = Room.objects.create(name='Polled')
+        Message.objects.create(room=self.room, user_name='a', content='hello ' * 200)
+
+    def test_unchanged_room_and_history_answer_304(self):
+        for url in (reverse('room-detail', args=[self.room.id]), reverse('room-messages', args=[self.room.id])):
+            first = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip')
+            self.assertEqual(first.status_code, 200)
+            self.assertEqual(first['Content-Encoding'], 'gzip')
+            self.assertIn('Last-Modified', first)
+            with self.assertNumQueries(1):
+                again = self.client.get(url, HTTP_IF_NONE_MATCH=first['ETag'])
+            self.assertEqual(again.status_code, 304)
+
+    def test_new_message_or_member_changes_etag(self):
+        url = reverse('room-detail', args=[self.room.id])
+        etag = self.client.get(url)['ETag']
+        self.room.members.add(self.user)
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+        url = reverse('room-messages', args=[self.room.id])
+        etag = self.client.get(url)['ETag']
+        Message.objects.create(room=self.room, user_name='b', content='new')
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+
+class BootstrapTests(TestCase):
+    @override_settings(BOOTSTRAP_TOP_ROOMS=2, BOOTSTRAP_RECENT_MESSAGES=2)
+    def test_snapshot_is_built_with_fixed_queries(self):
+        user = get_user_model().objects.create_user(username='starter', password='x')
+        other = get_user_model().objects.create_user(username='other', password='x')
+        rooms = [Room.objects.create(name=f'R{i}', creator=user if i < 2 else other) for i in range(4)]
+        for room in rooms[:3]:
+            room.members.add(user, other)
+        for i in range(3):
+            Message.objects.create(room=rooms[2], user_name='other', user=other, content=f'm{i}')
+        Message.objects.create(room=rooms[0], user_name='starter', user=user, content='only')
+        async_to_sync(get_presence_store().join)(str(rooms[2].id), str(other.id), 'other')
+        self.addCleanup(async_to_sync(get_presence_store().leave), str(rooms[2].id), str(other.id))
+
+        with CaptureQueriesContext(connection) as queries:
+            data = self.client.get(reverse('bootstrap'), {'user_id': user.id}).data
+        self.assertEqual(len(queries), 2)
+        # The window only numbers rows at or after each room's per-room cutoff
+        self.assertIn('"created_at" >=', queries[1]['sql'])
+        self.assertEqual([room['id'] for room in data['rooms']], [rooms[0].id, rooms[2].id, rooms[1].id])
+        self.assertEqual(data['rooms'][0]['member_count'], 2)
+        self.assertEqual([m['content'] for m in data['recent_messages'][rooms[2].id]], ['m1', 'm2'])
+        self.assertEqual(data['presence'][rooms[2].id], [str(other.id)])
+        self.assertEqual(data['limits'], {'created_rooms_count': 2, 'max_rooms': 3, 'can_create': True})
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class BenchmarkHarnessTests(TestCase):
+    def test_every_route_is_timed_and_regressions_fail(self):
+        seed(users=30, rooms=5, messages=300, logins=30)
+        self.assertEqual(Message.objects.count(), 300)
+        self.assertEqual(RoomHourlyActivity.objects.aggregate(n=Sum('message_count'))['n'], 300)
+
+        results = run_routes(benchmark_context(), repeat=1)
+        self.assertEqual(set(results), set(chat_route_names()))
+        self.assertTrue(all(result['status'] < 400 for result in results.values()), results)
+        # Every request was rolled back
+        self.assertEqual(Message.objects.count(), 300)
+
+        baseline = {name: dict(result, queries=result['queries'] - 1) for name, result in results.items()}
+        failures = compare_to_baseline({'room-detail': results['room-detail']}, baseline)
+        self.assertEqual(len(failures), 1)
+        self.assertIn('queries', failures[0])
+        self.assertEqual(compare_to_baseline(results, results), [])
+
+
+class TracingTests(TestCase):
+    @override_settings(TRACE_SAMPLE_RATE=1.0)
+    async def test_message_spans_share_one_trace_up_to_delivery(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            exporter = SpanExporter('file', os.path.join(tmp, 'traces.jsonl'))
+            with mock.patch('chat.tracing._exporter', exporter):
+                sender = WebsocketCommunicator(application, '/ws/chat/8/')
+                receiver = WebsocketCommunicator(application, '/ws/chat/8/')
+                await sender.connect()
+                await receiver.connect()
+                await sender.send_json_to({'content': 'traced', 'user_name': 'ann'})
+                await receiver.receive_json_from()
+                await sender.receive_json_from()
+                await sender.disconnect()
+                await receiver.disconnect()
+                exporter.flush()
+            with open(exporter.target) as f:
+                spans = [json.loads(line) for line in f]
+
+        self.assertEqual(len({s['trace_id'] for s in spans}), 1)
+        names = [s['name'] for s in spans]
+        for name in ('chat.receive', 'parse', 'room_lookup', 'insert', 'group_send', 'channel_layer', 'send'):
+            self.assertIn(name, names)
+        self.assertEqual(names.count('chat.deliver'), 2)
+        root = next(s for s in spans if s['name'] == 'chat.receive')
+        self.assertTrue(all(s['parent_id'] == root['span_id'] for s in spans if s['name'] == 'chat.deliver'))
+
+
+class LoggingPipelineTests(SimpleTestCase):
+    def test_event_records_are_sampled_capped_and_written_as_json(self):
+        stream = io.StringIO()
+        handler = QueueingStreamHandler(stream)
+        handler.setFormatter(JsonFormatter())
+        handler.addFilter(SamplingFilter(sample_rates={'presence.join': 0.5}, rate_cap=3))
+        log = logging.getLogger('chat.tests.pipeline')
+        log.propagate = False
+        log.addHandler(handler)
+        self.addCleanup(log.removeHandler, handler)
+
+        for i in range(20):
+            log.info('User joined room', extra={'event': 'presence.join', 'online': i})
+        log.info('Unsampled line')
+        handler.listener.stop()
+
+        records = [json.loads(line) for line in stream.getvalue().splitlines()]
+        joins = [r for r in records if r.get('event') == 'presence.join']
+        # Half are sampled out, then the per-second cap keeps three
+        self.assertEqual([r['online'] for r in joins], [1, 3, 5])
+        self.assertEqual(records[-1]['message'], 'Unsampled line')
+
+
+class IdempotentSendTests(TestCase):
+    def setUp(self):
+        self.room = Room.objects.create(name='Retry')
+        self.addCleanup(recent_messages()._entries.clear)
+
+    async def test_socket_resend_is_acked_without_second_insert_or_broadcast(self):
+        sender = WebsocketCommunicator(application, f'/ws/chat/{self.room.id}/')
+        watcher = WebsocketCommunicator(application, f'/ws/chat/{self.room.id}/')
+        await sender.connect()
+        await watcher.connect()
+        frame = {'content': 'once', 'user_name': 'ann', 'client_msg_id': 'c-1'}
+        await sender.send_json_to(frame)
+        await sender.send_json_to(frame)
+
+        received = [await sender.receive_json_from() for _ in range(3)]
+        acks = [f for f in received if f['type'] == 'ack']
+        self.assertEqual([a['duplicate'] for a in acks], [False, True])
+        self.assertEqual(acks[0]['id'], acks[1]['id'])
+        self.assertEqual((await watcher.receive_json_from())['client_msg_id'], 'c-1')
+        self.assertTrue(await watcher.receive_nothing())
+        self.assertEqual(await Message.objects.filter(room=self.room).acount(), 1)
+        await sender.disconnect()
+        await watcher.disconnect()
+
+    def test_rest_resend_returns_the_stored_message(self):
+        url = reverse('room-messages', args=[self.room.id])
+        data = {'content': 'once', 'user_name': 'bob', 'client_msg_id': 'c-2'}
+        first = self.client.post(url, data)
+        self.assertEqual(first.status_code, 201)
+        self.assertEqual(self.client.post(url, data).status_code, 200)
+        # Forgotten by the cache, the resend is still caught by the unique constraint
+        recent_messages()._entries.clear()
+        again = self.client.post(url, data)
+        self.assertEqual((again.status_code, again.data['id']), (200, first.data['id']))
+        self.assertEqual(Message.objects.filter(room=self.room).count(), 1)
+
+    def test_resend_with_unknown_user_id_is_answered_from_memory(self):
+        url = reverse('room-messages', args=[self.room.id])
+        data = {'content': 'once', 'user_name': 'ghost', 'user_id': 999, 'client_msg_id': 'c-3'}
+        first = self.client.post(url, data)
+        with CaptureQueriesContext(connection) as queries:
+            again = self.client.post(url, data)
+        self.assertEqual((again.status_code, again.data['id']), (200, first.data['id']))
+        self.assertFalse([q for q in queries if q['sql'].startswith('INSERT')])
+
+    def test_other_integrity_errors_are_not_swallowed(self):
+        from django.db import IntegrityError
+        from .idempotency import create_message_once
+        with mock.patch.object(Message.objects, 'create', side_effect=IntegrityError('FOREIGN KEY constraint failed')):
+            with self.assertRaises(IntegrityError):
+                create_message_once(self.room, None, 'ann', 'hi', 'c-4')
+
+
+class UserSocketTests(TestCase):
+    def setUp(self):
+        self.rooms = [Room.objects.create(name='A'), Room.objects.create(name='B')]
+        self.user = get_user_model().objects.create_user(username='multi', password='pw')
+
+    async def test_one_socket_follows_several_rooms(self):
+        socket = WebsocketCommunicator(application, '/ws/user/')
+        peer = WebsocketCommunicator(application, f'/ws/chat/{self.rooms[1].id}/')
+        self.assertTrue((await socket.connect())[0])
+        await peer.connect()
+        await socket.send_json_to({'type': 'user_connected', 'user_id': self.user.id, 'user_name': 'multi'})
+        for room in self.rooms:
+            await socket.send_json_to({'type': 'subscribe', 'room_id': room.id})
+            frames = [await socket.receive_json_from() for _ in range(2)]
+            self.assertIn({'type': 'subscribed', 'room_id': str(room.id)}, frames)
+
+        await peer.send_json_to({'content': 'hi B', 'user_name': 'peer'})
+        frame = await socket.receive_json_from()
+        self.assertEqual((frame['room_id'], frame['content']), (str(self.rooms[1].id), 'hi B'))
+
+        await socket.send_json_to({'room_id': self.rooms[0].id, 'content': 'hi A'})
+        frame = await socket.receive_json_from()
+        self.assertEqual((frame['room_id'], frame['user_id']), (str(self.rooms[0].id), self.user.id))
+
+        await socket.send_json_to({'type': 'unsubscribe', 'room_id': self.rooms[1].id})
+        self.assertEqual((await socket.receive_json_from())['type'], 'unsubscribed')
+        await peer.receive_json_from()
+        await peer.receive_json_from()
+        await peer.send_json_to({'content': 'unheard', 'user_name': 'peer'})
+        self.assertTrue(await socket.receive_nothing())
+        await socket.disconnect()
+        await peer.disconnect()
+
+    async def test_ban_ends_only_that_subscription(self):
+        await RoomBan.objects.acreate(room=self.rooms[0], user=self.user)
+        self.addCleanup(room_bans().invalidate, self.rooms[0].id)
+        socket = WebsocketCommunicator(application, '/ws/user/')
+        await socket.connect()
+        await socket.send_json_to({'type': 'user_connected', 'user_id': self.user.id, 'user_name': 'multi'})
+        await socket.send_json_to({'type': 'subscribe', 'room_id': self.rooms[0].id})
+        self.assertEqual(await socket.receive_json_from(), {'type': 'removed', 'room_id': str(self.rooms[0].id), 'reason': 'banned'})
+        await socket.send_json_to({'type': 'subscribe', 'room_id': self.rooms[1].id})
+        frames = [await socket.receive_json_from() for _ in range(2)]
+        self.assertIn({'type': 'subscribed', 'room_id': str(self.rooms[1].id)}, frames)
+        await socket.disconnect()
+
+    async def test_late_identity_applies_to_rooms_already_followed(self):
+        await RoomBan.objects.acreate(room=self.rooms[0], user=self.user)
+        self.addCleanup(room_bans().invalidate, self.rooms[0].id)
+        socket = WebsocketCommunicator(application, '/ws/user/')
+        await socket.connect()
+        for room in self.rooms:
+            await socket.send_json_to({'type': 'subscribe', 'room_id': room.id})
+            self.assertEqual((await socket.receive_json_from())['type'], 'subscribed')
+        await socket.send_json_to({'type': 'user_connected', 'user_id': self.user.id, 'user_name': 'multi'})
+        frames = [await socket.receive_json_from() for _ in range(2)]
+        self.assertIn({'type': 'removed', 'room_id': str(self.rooms[0].id), 'reason': 'banned'}, frames)
+        joined = next(frame for frame in frames if frame['type'] == 'presence_update')
+        self.assertEqual((joined['room_id'], joined['user_id']), (str(self.rooms[1].id), str(self.user.id)))
+        await socket.disconnect()
+
+    @override_settings(BATCH_RATE_THRESHOLD=1.5, BATCH_WINDOW=0.05)
+    async def test_batch_capability_batches_each_room(self):
+        socket = WebsocketCommunicator(application, '/ws/user/?capabilities=batch')
+        await socket.connect()
+        await socket.send_json_to({'type': 'subscribe', 'room_id': self.rooms[0].id})
+        await socket.receive_json_from()
+        room_id = str(self.rooms[0].id)
+        layer = get_channel_layer()
+        for i in range(4):
+            await layer.group_send(f'room_{room_id}', {'type': 'chat.message', 'room_id': room_id, 'message': {'type': 'message', 'id': i}})
+        self.assertEqual((await socket.receive_json_from())['id'], 0)
+        frame = await socket.receive_json_from(timeout=1)
+        self.assertEqual((frame['type'], frame['room_id']), ('batch', room_id))
+        self.assertEqual([m['id'] for m in frame['messages']], [1, 2, 3])
+        await socket.disconnect()
+
+
+@override_settings(ROOM_MEMBER_PREVIEW_SIZE=2, ROOM_MEMBERS_PAGE_SIZE=2)
+class RoomMembersTests(TestCase):
+    def setUp(self):
+        User = get_user_model()
+        self.room = Room.objects.create(name='Big')
+        self.users = [User.objects.create_user(f'm{n}', password='x') for n in range(5)]
+        self.room.members.add(*self.users)
+
+    def test_member_count_follows_membership(self):
+        self.room.refresh_from_db()
+        self.assertEqual(self.room.member_count, 5)
+        self.room.members.remove(self.users[0])
+        self.users[1].rooms.clear()
+        self.users[2].delete()
+        self.room.refresh_from_db()
+        self.assertEqual(self.room.member_count, 2)
+        # Joins and leaves adjust the count instead of recounting every member
+        outsider = get_user_model().objects.create_user('outsider', password='x')
+        with CaptureQueriesContext(connection) as queries:
+            self.room.members.add(outsider)
+            self.room.members.remove(outsider, self.users[0])
+            outsider.rooms.add(self.room)
+        self.assertFalse([q for q in queries if 'COUNT(' in q['sql'] and 'UPDATE' in q['sql']])
+        self.room.refresh_from_db()
+        self.assertEqual(self.room.member_count, 3)
+
+    def test_created_room_counts_its_creator(self):
+        response = self.client.post(reverse('rooms-list'), {'name': 'Fresh', 'creator_id': self.users[0].id})
+        self.assertEqual((response.status_code, response.data['member_count']), (201, 1))
+
+    def test_payload_has_preview_and_members_are_paginated(self):
+        room = self.client.get(reverse('room-detail', args=[self.room.id])).data
+        self.assertEqual((room['member_count'], len(room['members'])), (5, 2))
+
+        url = reverse('room-members', args=[self.room.id])
+        first = self.client.get(url).data
+        self.assertEqual([m['username'] for m in first['results']], ['m0', 'm1'])
+        second = self.client.get(first['next']).data
+        self.assertEqual([m['username'] for m in second['results']], ['m2', 'm3'])
+        found = self.client.get(url, {'search': 'M4'}).data
+        self.assertEqual([m['username'] for m in found['results']], ['m4'])
+        self.assertEqual(self.client.get(reverse('room-members', args=[999])).status_code, 404)
+
+
+class RoomDocumentCacheTests(TestCase):
+    def setUp(self):
+        self.room = Room.objects.create(name='Cached')
+        self.addCleanup(cache.clear)
+        self.url = reverse('room-detail', args=[self.room.id])
+
+    def test_served_from_cache_until_the_room_changes(self):
+        self.assertEqual(self.client.get(self.url).data['name'], 'Cached')
+        # Only the conditional-GET state query runs on a hit
+        with self.assertNumQueries(1):
+            self.client.get(self.url)
+        self.room.name = 'Renamed'
+        self.room.save()
+        self.assertEqual(self.client.get(self.url).data['name'], 'Renamed')
+        Message.objects.create(room=self.room, user_name='ann', content='new')
+        self.assertEqual(self.client.get(self.url).data['last_messages'][0]['content'], 'new')
+        self.room.members.add(get_user_model().objects.create_user('joined', password='x'))
+        self.assertEqual(self.client.get(self.url).data['member_count'], 1)
+
+    def test_concurrent_misses_wait_for_one_rebuild(self):
+        from .roomcache import _document_key, _generation, room_document
+        key = _document_key(self.room.id, _generation(self.room.id))
+        # Another request holds the lock and stores its result while this one waits
+        cache.add(f'{key}:lock', 1)
+        finish_rebuild = lambda _: cache.set(key, {'id': self.room.id, 'name': 'built by the lock holder'})
+        clock = mock.Mock(wraps=time, sleep=mock.Mock(side_effect=finish_rebuild))
+        with mock.patch('chat.roomcache.time', clock), mock.patch('chat.roomcache.build_room_document') as build:
+            self.assertEqual(room_document(self.room.id)['name'], 'built by the lock holder')
+        build.assert_not_called()
+        self.assertEqual(clock.sleep.call_count, 1)
+
+    def test_waiters_stop_when_the_lock_holder_gives_up(self):
+        from .roomcache import _document_key, _generation, room_document
+        key = _document_key(self.room.id, _generation(self.room.id))
+        cache.add(f'{key}:lock', 1)
+        give_up = lambda _: cache.delete(f'{key}:lock')
+        clock = mock.Mock(wraps=time, sleep=mock.Mock(side_effect=give_up))
+        with mock.patch('chat.roomcache.time', clock):
+            self.assertEqual(room_document(self.room.id)['name'], 'Cached')
+        self.assertEqual(clock.sleep.call_count, 1)
+
+    def test_unknown_rooms_are_remembered_until_one_is_created(self):
+        from .roomcache import room_document
+        missing = Room.objects.order_by('-id').first().id + 1
+        self.assertIsNone(room_document(missing))
+        with self.assertNumQueries(0):
+            self.assertIsNone(room_document(missing))
+        Room.objects.create(id=missing, name='Late')
+        self.assertEqual(room_document(missing)['name'], 'Late')
+
+
+@override_settings(DRAIN_RECONNECT_WINDOW=3, DRAIN_TIMEOUT=0.1)
+class DrainTests(TestCase):
+    def setUp(self):
+        self.room = Room.objects.create(name='Restarting')
+
+    def tearDown(self):
+        drainer.draining = False
+
+    async def test_drain_sends_clients_away_with_spread_delays(self):
+        sockets = [WebsocketCommunicator(application, f'/ws/chat/{self.room.id}/') for _ in range(3)]
+        for socket in sockets:
+            await socket.connect()
+        await drainer.drain()
+        for socket in sockets:
+            frame = await socket.receive_json_from()
+            self.assertEqual(frame['type'], 'reconnect')
+            self.assertTrue(0 <= frame['delay'] <= 3)
+            self.assertEqual((await socket.receive_output())['code'], RECONNECT_CLOSE_CODE)
+            await socket.disconnect()
+
+        late = WebsocketCommunicator(application, '/ws/user/')
+        await late.connect()
+        self.assertEqual((await late.receive_json_from())['type'], 'reconnect')
+        self.assertEqual((await late.receive_output())['code'], RECONNECT_CLOSE_CODE)
+        await late.disconnect()
+
+    @override_settings(DRAIN_TIMEOUT=5, DB_POOL_SIZE=0)
+    async def test_sigterm_is_handed_back_once_queries_finish(self):
+        worker = Drainer()
+        worker._loop = mock.Mock()
+        worker._previous_handler = previous = mock.Mock()
+        # Without a pool, calls run through channels' database_sync_to_async and still count
+        query = asyncio.ensure_future(db_sync_to_async(time.sleep)(0.3))
+        await asyncio.sleep(0.05)
+        with mock.patch('chat.drain.os.kill') as kill, mock.patch('chat.drain.signal.signal') as restore:
+            worker._on_sigterm()
+            worker._on_sigterm()
+            await asyncio.sleep(0.1)
+            kill.assert_not_called()
+            await query
+            await worker._task
+        worker._loop.remove_signal_handler.assert_called_once_with(signal.SIGTERM)
+        restore.assert_called_once_with(signal.SIGTERM, previous)
+        kill.assert_called_once_with(os.getpid(), signal.SIGTERM)
+
+
+class OutboundQueueTests(SimpleTestCase):
+    def slow_queue(self, policy):
+        written, gate = [], asyncio.Event()
+
+        async def write(text):
+            await gate.wait()
+            written.append(text)
+
+        # The writer takes the first frame and blocks on it, so the rest pile up
+        queue = OutboundQueue(write, 3, policy)
+        self.addCleanup(queue.stop)
+        return queue, written, gate
+
+    async def test_drop_oldest_and_coalesce(self):
+        queue, written, gate = self.slow_queue('drop_oldest')
+        for frame in 'abcde':
+            queue.put(frame)
+            await asyncio.sleep(0)
+        gate.set()
+        await queue.flush(1)
+        self.assertEqual(written, ['a', 'c', 'd', 'e'])
+
+        dropped = outbound_stats.dropped
+        queue, written, gate = self.slow_queue('coalesce')
+        queue.put('m1')
+        await asyncio.sleep(0)
+        for frame, key in [('p1', 'presence'), ('m2', None), ('m3', None), ('p2', 'presence'), ('m4', None)]:
+            queue.put(frame, key)
+        gate.set()
+        await queue.flush(1)
+        self.assertEqual(written, ['m1', 'p2', json.dumps({'type': 'resync', 'dropped': 2}), 'm4'])
+        self.assertEqual(outbound_stats.dropped - dropped, 2)
+
+    async def test_disconnect_policy_gives_up_on_the_socket(self):
+        disconnects = outbound_stats.disconnects
+        queue, written, gate = self.slow_queue('disconnect')
+        results = []
+        for frame in 'abcde':
+            results.append(queue.put(frame))
+            await asyncio.sleep(0)
+        self.assertEqual(results, [True, True, True, True, False])
+        self.assertEqual((len(queue), outbound_stats.disconnects - disconnects), (0, 1))
+        self.assertEqual(collect_worker_metrics()['slow_consumer_disconnects'], outbound_stats.disconnects)
+
+    async def test_writer_waits_for_a_slow_reader(self):
+        # daphne's transport accepts every write at once; only the paused producer shows the client is behind
+        gate, written = WriteGate(), []
+
+        async def write(text):
+            written.append(text)
+            if len(text) > 1:
+                gate.pauseProducing()
+
+        blocked = outbound_stats.blocked_writes
+        queue = OutboundQueue(write, 3, 'drop_oldest', gate=gate)
+        self.addCleanup(queue.stop)
+        for frame in ('aaaaa', 'b', 'c', 'd', 'e'):
+            queue.put(frame)
+            await asyncio.sleep(0)
+        self.assertEqual((written, len(queue)), (['aaaaa'], 3))
+        gate.resumeProducing()
+        await queue.flush(1)
+        self.assertEqual(written, ['aaaaa', 'c', 'd', 'e'])
+        self.assertEqual(outbound_stats.blocked_writes - blocked, 1)
+
+    async def test_gate_follows_daphnes_transport_buffer(self):
+        # Real daphne, autobahn and Twisted code, so an upgrade that moves any of it fails here
+        from channels.sessions import InstanceSessionWrapper
+        from daphne.server import Server
+        from daphne.ws_protocol import WebSocketProtocol
+        from twisted.internet.abstract import FileDescriptor
+        from twisted.web.http import HTTPChannel
+
+        class Transport(FileDescriptor):
+            connected = 1
+            accepted = 0
+
+            def writeSomeData(self, data):
+                return min(len(data), self.accepted)
+
+            def startWriting(self):
+                pass
+
+            def stopWriting(self):
+                pass
+
+        transport = Transport(reactor=mock.Mock())
+        # The HTTP channel the socket was upgraded from stays the transport's producer
+        channel = HTTPChannel()
+        channel.timeOut = None
+        channel.makeConnection(transport)
+        protocol = WebSocketProtocol.__new__(WebSocketProtocol)
+        protocol.transport = transport
+        sends = []
+
+        async def app(scope, receive, send):
+            sends.append(send)
+
+        server = Server(app, endpoints=['tcp:port=0'], signal_handlers=False)
+        server.connections = {protocol: {}}
+        server.create_application(protocol, {'type': 'websocket'})
+        await server.connections[protocol]['application_instance']
+
+        gate = register_write_gate(InstanceSessionWrapper({'cookies': {}}, sends[0]).send)
+        self.assertIsNotNone(gate)
+        transport.write(b'x' * (transport.bufferSize + 1))
+        self.assertFalse(gate.open.is_set())
+        transport.accepted = transport.bufferSize * 2
+        transport.doWrite()
+        self.assertTrue(gate.open.is_set())
+        self.assertIsNone(register_write_gate(mock.AsyncMock()))
@@ -0,0 +1,180 @@
+import contextlib
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+import urllib.request
+
+from django.conf import settings
+
+logger = logging.getLogger('chat')
+
+
+class Trace:
+    """Timed spans of one message on one process, exported together by finish().
+
+    A sender's trace travels inside the channel-layer event as context(); each
+    receiver continues it with continue_trace(), so its spans share the trace id.
+    """
+
+    def __init__(self, name, trace_id=None, parent_id=None, attributes=None):
+        self.trace_id = trace_id or os.urandom(16).hex()
+        self.spans = []
+        self.root = self._new_span(name, parent_id, attributes)
+
+    def _new_span(self, name, parent_id, attributes=None, start_ns=None):
+        span = {
+            'trace_id': self.trace_id,
+            'span_id': os.urandom(8).hex(),
+            'parent_id': parent_id,
+            'name': name,
+            'start_ns': start_ns or time.time_ns(),
+            'end_ns': None,
+            'attributes': dict(attributes or {}),
+        }
+        self.spans.append(span)
+        return span
+
+    @contextlib.contextmanager
+    def span(self, name, **attributes):
+        span = self._new_span(name, self.root['span_id'], attributes)
+        try:
+            yield span
+        finally:
+            span['end_ns'] = time.time_ns()
+
+    def record(self, name, start_ns, end_ns=None, **attributes):
+        """Add a span whose start was measured elsewhere (e.g. by the sender)"""
+        span = self._new_span(name, self.root['span_id'], attributes, start_ns=start_ns)
+        span['end_ns'] = end_ns or time.time_ns()
+
+    def context(self):
+        """What a receiver needs to continue this trace"""
+        return {'trace_id': self.trace_id, 'span_id': self.root['span_id'], 'sent_at': time.time_ns()}
+
+    def finish(self, **attributes):
+        self.root['end_ns'] = time.time_ns()
+        self.root['attributes'].update(attributes)
+        get_exporter().export(self.spans)
+
+
+def start_trace(name, **attributes):
+    """A new trace for this message if it is sampled, else None"""
+    rate = settings.TRACE_SAMPLE_RATE
+    if rate <= 0 or random.random() >= rate:
+        return None
+    return Trace(name, attributes=attributes)
+
+
+def continue_trace(context, name, **attributes):
+    """Continue a sender's trace on a receiver; None if the message wasn't sampled"""
+    if not context:
+        return None
+    trace = Trace(name, trace_id=context['trace_id'], parent_id=context['span_id'], attributes=attributes)
+    trace.record('channel_layer', context['sent_at'])
+    return trace
+
+
+def span(trace, name, **attributes):
+    """trace.span(), or a no-op for unsampled messages"""
+    if trace is None:
+        return contextlib.nullcontext()
+    return trace.span(name, **attributes)
+
+
+def otlp_payload(spans):
+    """Spans in the OTLP/HTTP JSON encoding"""
+    def attributes(values):
+        return [{'key': key, 'value': {'stringValue': str(value)}} for key, value in values.items()]
+
+    return {'resourceSpans': [{
+        'resource': {'attributes': attributes({'service.name': settings.TRACE_SERVICE_NAME, 'process.pid': os.getpid()})},
+        'scopeSpans': [{
+            'scope': {'name': 'chat.tracing'},
+            'spans': [{
+                'traceId': span['trace_id'],
+                'spanId': span['span_id'],
+                **({'parentSpanId': span['parent_id']} if span['parent_id'] else {}),
+                'name': span['name'],
+                'kind': 1,
+                'startTimeUnixNano': str(span['start_ns']),
+                'endTimeUnixNano': str(span['end_ns'] or span['start_ns']),
+                'attributes': attributes(span['attributes']),
+            } for span in spans],
+        }],
+    }]}
+
+
+class SpanExporter:
+    """Writes finished spans from a background thread so the event loop never does I/O for tracing.
+
+    Spans are dropped (and counted) when the queue is full rather than slowing messages down.
+    """
+
+    def __init__(self, kind, target, max_queue=10000, batch_size=512):
+        self.kind = kind
+        self.target = target
+        self.batch_size = batch_size
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def export(self, spans):
+        for span in spans:
+            try:
+                self._queue.put_nowait(span)
+            except queue.Full:
+                self.dropped += 1
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name='chat-trace-export', daemon=True)
+                    self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self.write(batch)
+            except Exception as e:
+                logger.warning(f"Exporting {len(batch)} spans to {self.target} failed: {e}")
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def write(self, batch):
+        if self.kind == 'otlp':
+            request = urllib.request.Request(
+                self.target, data=json.dumps(otlp_payload(batch)).encode(),
+                headers={'Content-Type': 'application/json'}, method='POST',
+            )
+            urllib.request.urlopen(request, timeout=5).close()
+        else:
+            with open(self.target, 'a') as f:
+                f.writelines(json.dumps(span) + '\n' for span in batch)
+
+    def flush(self):
+        """Wait until every queued span has been written"""
+        self._queue.join()
+
+
+_exporter = None
+
+
+def get_exporter():
+    global _exporter
+    if _exporter is None:
+        if settings.TRACE_EXPORTER == 'otlp':
+            _exporter = SpanExporter('otlp', settings.TRACE_OTLP_ENDPOINT)
+        else:
+            _exporter = SpanExporter('file', settings.TRACE_FILE)
+    return _exporter
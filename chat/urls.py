@@ -2,13 +2,18 @@ from django.urls import path
 from .views import RoomListCreateView, RoomRetrieveView, MessageListCreateView, JoinRoomView
 from .views import RegisterView, LoginView, LeaveRoomView, DeleteRoomView, UserRoomStatsView
 from .views import RenameRoomView, KickMemberView, BanMemberView, FeedbackCreateView, UpdateProfileView
+from .views import LoopMonitorView, WorkerMetricsView, RoomActivityStatsView, BootstrapView
+from .views import RoomMembersView
 
 urlpatterns = [
+    path('bootstrap/', BootstrapView.as_view(), name='bootstrap'),
     path('rooms/', RoomListCreateView.as_view(), name='rooms-list'),
     path('rooms/join/', JoinRoomView.as_view(), name='rooms-join'),
     path('rooms/stats/', UserRoomStatsView.as_view(), name='rooms-stats'),
     path('rooms/<int:room_id>/', RoomRetrieveView.as_view(), name='room-detail'),
+    path('rooms/<int:room_id>/members/', RoomMembersView.as_view(), name='room-members'),
     path('rooms/<int:room_id>/messages/', MessageListCreateView.as_view(), name='room-messages'),
+    path('rooms/<int:room_id>/stats/', RoomActivityStatsView.as_view(), name='room-stats'),
     path('rooms/<int:room_id>/leave/', LeaveRoomView.as_view(), name='room-leave'),
     path('rooms/<int:room_id>/delete/', DeleteRoomView.as_view(), name='room-delete'),
     path('rooms/<int:room_id>/rename/', RenameRoomView.as_view(), name='room-rename'),
@@ -18,6 +23,8 @@ urlpatterns = [
     path('auth/login/', LoginView.as_view(), name='auth-login'),
     path('auth/profile/', UpdateProfileView.as_view(), name='auth-profile'),
     path('feedback/', FeedbackCreateView.as_view(), name='feedback-create'),
+    path('debug/loop/', LoopMonitorView.as_view(), name='debug-loop'),
+    path('debug/metrics/', WorkerMetricsView.as_view(), name='debug-metrics'),
 ]
 
 
@@ -1,12 +1,28 @@
 from rest_framework import generics
+from rest_framework.pagination import CursorPagination
 from rest_framework.response import Response
 from rest_framework import status
-from .models import Room, Message, Feedback
-from .serializers import RoomSerializer, MessageSerializer, FeedbackSerializer
+from .models import Room, RoomBan, RoomDeletion, Message, Feedback
+from .serializers import MemberSerializer, RoomSerializer, MessageSerializer, FeedbackSerializer, member_preview
+from .roomcache import invalidate_room_documents, room_document
+from .loopmonitor import loop_monitor
+from .workers import collect_worker_metrics
+from .rollups import MAX_STATS_DAYS, room_activity_stats
+from .roomkeys import missing_room_keys, normalize_room_key
+from .purge import schedule_room_purge
+from .bans import evict_member, is_banned
+from .conditional import conditional_messages, conditional_room
+from .bootstrap import build_bootstrap
+from .tracing import span, start_trace
+from .idempotency import clean_client_msg_id, create_message_once, find_resent
 from rest_framework.views import APIView
 from asgiref.sync import async_to_sync
 from channels.layers import get_channel_layer
-from django.db import models as dj_models
+from django.conf import settings
+from django.db import models as dj_models, transaction
+from django.shortcuts import get_object_or_404
+from django.urls import reverse
+from django.utils import timezone
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import User as DjangoUser
 import random
@@ -32,8 +48,10 @@ class RoomListCreateView(generics.ListCreateAPIView):
             user_id = self.request.query_params.get('user_id')
         if user_id:
             # Return rooms where user is creator or a member
-            return Room.objects.filter(dj_models.Q(creator_id=user_id) | dj_models.Q(members__id=user_id)).distinct().order_by('-created_at')
-        return super().get_queryset()
+            rooms = Room.objects.filter(dj_models.Q(creator_id=user_id) | dj_models.Q(members__id=user_id)).distinct().order_by('-created_at')
+        else:
+            rooms = super().get_queryset()
+        return rooms.prefetch_related(member_preview())
 
     def create(self, request, *args, **kwargs):
         # Check room creation limit before creating
@@ -72,30 +90,78 @@ class RoomListCreateView(generics.ListCreateAPIView):
         # ensure creator is a member
         if creator:
             room.members.add(creator)
+            # The signal updated member_count in the database; the response serializes this instance
+            room.refresh_from_db(fields=['member_count'])
+
+
+class MemberCursorPagination(CursorPagination):
+    ordering = 'username'
+    page_size_query_param = 'page_size'
+    max_page_size = 200
 
+    def __init__(self):
+        self.page_size = settings.ROOM_MEMBERS_PAGE_SIZE
 
+
+class RoomMembersView(generics.ListAPIView):
+    """Members of a room, ordered by username; ?search= matches the start of the username"""
+    serializer_class = MemberSerializer
+    pagination_class = MemberCursorPagination
+
+    def get_queryset(self):
+        room = get_object_or_404(Room, pk=self.kwargs['room_id'])
+        members = room.members.all()
+        search = self.request.query_params.get('search', '').strip()
+        if search:
+            members = members.filter(username__istartswith=search)
+        return members
+
+
+@conditional_room
 class RoomRetrieveView(generics.RetrieveAPIView):
     queryset = Room.objects.all()
     serializer_class = RoomSerializer
+    lookup_url_kwarg = 'room_id'
 
+    def retrieve(self, request, *args, **kwargs):
+        document = room_document(self.kwargs['room_id'])
+        if document is None:
+            return Response({'detail': 'Room not found'}, status=status.HTTP_404_NOT_FOUND)
+        return Response(document)
 
+
+@conditional_messages
 class MessageListCreateView(generics.ListCreateAPIView):
     serializer_class = MessageSerializer
 
     def get_queryset(self):
         room_id = self.kwargs['room_id']
-        return Message.objects.filter(room_id=room_id).order_by('created_at')
+        return Message.objects.filter(room_id=room_id, room__deleted_at__isnull=True).order_by('created_at')
 
     def create(self, request, *args, **kwargs):
         room_id = self.kwargs['room_id']
-        user_name = request.data.get('user') or request.data.get('user_name') or 'anonymous'
-        user_id = request.data.get('user_id') or request.data.get('user_id') or request.data.get('userId')
-        content = request.data.get('content') or request.data.get('text') or request.data.get('message')
+        trace = start_trace('chat.create', room=room_id)
+        with span(trace, 'parse'):
+            data = request.data
+        user_name = data.get('user') or data.get('user_name') or 'anonymous'
+        user_id = data.get('user_id') or data.get('userId')
+        content = data.get('content') or data.get('text') or data.get('message')
 
         if content is None:
             return Response({'detail': 'Message content required'}, status=status.HTTP_400_BAD_REQUEST)
 
-        room, _ = Room.objects.get_or_create(id=room_id, defaults={'name': f'Room {room_id}'})
+        # Resends of a stored message get it back (200) without a second insert or broadcast
+        client_msg_id = clean_client_msg_id(data.get('client_msg_id'))
+        sender_id = request.user.id if getattr(request, 'user', None) and request.user.is_authenticated else user_id
+        resent = find_resent(room_id, sender_id, user_name, client_msg_id)
+        if resent is not None:
+            return Response(self.get_serializer(resent).data, status=status.HTTP_200_OK)
+
+        # A deleted room is still in the table until its purge finishes; don't resurrect it
+        with span(trace, 'room_lookup'):
+            if Room.all_objects.filter(id=room_id, deleted_at__isnull=False).exists():
+                return Response({'detail': 'Room not found'}, status=status.HTTP_404_NOT_FOUND)
+            room, _ = Room.objects.get_or_create(id=room_id, defaults={'name': f'Room {room_id}'})
         # Prefer authenticated user for message ownership
         user = None
         if getattr(request, 'user', None) and request.user.is_authenticated:
@@ -106,14 +172,18 @@ class MessageListCreateView(generics.ListCreateAPIView):
             from django.contrib.auth import get_user_model
             User = get_user_model()
             try:
-                user = User.objects.get(id=user_id)
+                with span(trace, 'user_lookup'):
+                    user = User.objects.get(id=user_id)
                 # override user_name if not provided
                 if not user_name:
                     user_name = f"{user.first_name} {user.last_name}".strip() or user.username
             except Exception:
                 user = None
-        message = Message.objects.create(room=room, user_name=user_name, user=user, content=content)
+        with span(trace, 'insert'):
+            message, created = create_message_once(room, user, user_name, content, client_msg_id, sender_id)
         serializer = self.get_serializer(message)
+        if not created:
+            return Response(serializer.data, status=status.HTTP_200_OK)
 
         # Broadcast via WebSocket
         try:
@@ -124,14 +194,18 @@ class MessageListCreateView(generics.ListCreateAPIView):
                 'user_id': message.user.id if message.user else None,
                 'content': message.content,
                 'created_at': message.created_at.isoformat(),
+                'client_msg_id': message.client_msg_id,
             }
-            async_to_sync(channel_layer.group_send)(
-                f'room_{room_id}',
-                {'type': 'chat.message', 'message': broadcast_data},
-            )
+            event = {'type': 'chat.message', 'room_id': str(room_id), 'message': broadcast_data}
+            if trace:
+                event['trace'] = trace.context()
+            with span(trace, 'group_send'):
+                async_to_sync(channel_layer.group_send)(f'room_{room_id}', event)
             logger.info(f"Broadcast message {message.id} to room_{room_id}")
         except Exception as e:
             logger.error(f"Broadcast failed for message {message.id}: {e}")
+        if trace:
+            trace.finish(message_id=message.id)
 
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
@@ -141,14 +215,24 @@ class JoinRoomView(APIView):
         room_key = request.data.get('room_key') or request.data.get('key')
         if not room_key:
             return Response({'detail': 'room_key required'}, status=status.HTTP_400_BAD_REQUEST)
-        room = Room.objects.filter(key__iexact=room_key).first()
+        # Keys are stored normalized, so an exact match can use the unique index
+        room_key = normalize_room_key(room_key)
+        missing_keys = missing_room_keys()
+        if room_key in missing_keys:
+            return Response({'detail': 'Room not found'}, status=status.HTTP_404_NOT_FOUND)
+        room = Room.objects.filter(key=room_key).first()
         if not room:
+            missing_keys.add(room_key)
             return Response({'detail': 'Room not found'}, status=status.HTTP_404_NOT_FOUND)
         # Add authenticated user to members if present, otherwise use provided user_id
         if getattr(request, 'user', None) and request.user.is_authenticated:
+            if is_banned(room.id, request.user.id):
+                return Response({'detail': 'You are banned from this room'}, status=status.HTTP_403_FORBIDDEN)
             room.members.add(request.user)
         else:
             user_id = request.data.get('user_id') or request.data.get('user') or request.data.get('userId')
+            if user_id and is_banned(room.id, user_id):
+                return Response({'detail': 'You are banned from this room'}, status=status.HTTP_403_FORBIDDEN)
             if user_id:
                 from django.contrib.auth import get_user_model
                 User = get_user_model()
@@ -157,8 +241,7 @@ class JoinRoomView(APIView):
                     room.members.add(u)
                 except Exception:
                     pass
-        serializer = RoomSerializer(room)
-        return Response(serializer.data, status=status.HTTP_200_OK)
+        return Response(room_document(room.id), status=status.HTTP_200_OK)
 
 
 import re
@@ -327,6 +410,11 @@ class UpdateProfileView(APIView):
             user.set_password(new_password)
         
         user.save()
+        if first_name is not None or last_name is not None:
+            # Member names are part of each room document; refresh those rooms' ETags
+            rooms = Room.all_objects.filter(members=user)
+            invalidate_room_documents(rooms.values_list('id', flat=True))
+            rooms.update(updated_at=timezone.now())
         
         return Response({
             'id': user.id,
@@ -410,11 +498,42 @@ class DeleteRoomView(APIView):
         if not room.creator or room.creator.id != user.id:
             return Response({'detail': 'Only the room creator can delete this room'}, status=status.HTTP_403_FORBIDDEN)
         
-        # Delete the room (this will cascade delete messages too)
-        room_name = room.name
-        room.delete()
-        
-        return Response({'detail': f'Room "{room_name}" deleted successfully'}, status=status.HTTP_200_OK)
+        # Hide the room now and purge its messages in the background; a cascading
+        # delete of a large room would hold locks for the whole request
+        with transaction.atomic():
+            room.deleted_at = timezone.now()
+            room.save(update_fields=['deleted_at'])
+            RoomDeletion.objects.get_or_create(room_id=room.id, defaults={'room_name': room.name})
+            schedule_room_purge(room.id)
+
+        try:
+            async_to_sync(get_channel_layer().group_send)(
+                f'room_{room.id}',
+                {'type': 'room.deleted', 'room_id': room.id},
+            )
+        except Exception as e:
+            logger.error(f"Room deleted broadcast failed for room_{room.id}: {e}")
+
+        return Response({
+            'detail': f'Room "{room.name}" deleted successfully',
+            'status_url': reverse('room-delete', args=[room.id]),
+        }, status=status.HTTP_200_OK)
+
+    def get(self, request, room_id, *args, **kwargs):
+        """Progress of a room's background purge"""
+        try:
+            deletion = RoomDeletion.objects.get(room_id=room_id)
+        except RoomDeletion.DoesNotExist:
+            return Response({'detail': 'No deletion for this room'}, status=status.HTTP_404_NOT_FOUND)
+        return Response({
+            'room_id': deletion.room_id,
+            'room_name': deletion.room_name,
+            'total_messages': deletion.total_messages,
+            'deleted_messages': deletion.deleted_messages,
+            'requested_at': deletion.requested_at,
+            'finished_at': deletion.finished_at,
+            'done': deletion.finished_at is not None,
+        })
 
 
 class UserRoomStatsView(APIView):
@@ -433,6 +552,34 @@ class UserRoomStatsView(APIView):
         })
 
 
+class BootstrapView(APIView):
+    """Rooms, recent messages of the most active rooms, presence and limits for app start"""
+    def get(self, request, *args, **kwargs):
+        if getattr(request, 'user', None) and request.user.is_authenticated:
+            user_id = request.user.id
+        else:
+            try:
+                user_id = int(request.query_params.get('user_id', ''))
+            except ValueError:
+                return Response({'detail': 'user_id required'}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(build_bootstrap(user_id, MAX_ROOMS_PER_USER))
+
+
+class RoomActivityStatsView(APIView):
+    """Per-room activity (messages per day, active users, peak hours) served from rollups"""
+    def get(self, request, room_id, *args, **kwargs):
+        try:
+            days = int(request.query_params.get('days', 30))
+        except ValueError:
+            return Response({'detail': 'days must be a number'}, status=status.HTTP_400_BAD_REQUEST)
+        days = max(1, min(days, MAX_STATS_DAYS))
+
+        if not Room.objects.filter(id=room_id).exists():
+            return Response({'detail': 'Room not found'}, status=status.HTTP_404_NOT_FOUND)
+
+        return Response(room_activity_stats(room_id, days))
+
+
 class RenameRoomView(APIView):
     """Allow room creator to rename the room"""
     def post(self, request, room_id, *args, **kwargs):
@@ -510,6 +657,7 @@ class KickMemberView(APIView):
             target = User.objects.get(id=target_user_id)
             if room.members.filter(id=target.id).exists():
                 room.members.remove(target)
+                evict_member(room.id, target.id, 'kicked')
                 return Response({'detail': 'Member kicked successfully'}, status=status.HTTP_200_OK)
             else:
                 return Response({'detail': 'Target is not a member'}, status=status.HTTP_400_BAD_REQUEST)
@@ -552,13 +700,29 @@ class BanMemberView(APIView):
         if str(target_user_id) == str(user.id):
             return Response({'detail': 'Cannot ban the room creator'}, status=status.HTTP_400_BAD_REQUEST)
         
-        # For now, just kick them (ban tracking requires model change + migration on Railway)
-        # We'll just remove them from members
         User = get_user_model()
         try:
             target = User.objects.get(id=target_user_id)
-            if room.members.filter(id=target.id).exists():
-                room.members.remove(target)
-            return Response({'detail': 'Member banned successfully'}, status=status.HTTP_200_OK)
         except Exception:
             return Response({'detail': 'Target user not found'}, status=status.HTTP_404_NOT_FOUND)
+        # Record the ban so the key no longer lets them back in, then drop them
+        RoomBan.objects.get_or_create(room=room, user=target, defaults={'banned_by': user})
+        room.members.remove(target)
+        evict_member(room.id, target.id, 'banned')
+        return Response({'detail': 'Member banned successfully'}, status=status.HTTP_200_OK)
+
+
+class LoopMonitorView(APIView):
+    """Expose event-loop lag histogram and recent slow callbacks (staff or DEBUG only)"""
+    def get(self, request, *args, **kwargs):
+        if not (settings.DEBUG or request.user.is_staff):
+            return Response({'detail': 'Not allowed'}, status=status.HTTP_403_FORBIDDEN)
+        return Response(loop_monitor.snapshot())
+
+
+class WorkerMetricsView(APIView):
+    """Combined metrics of every serving worker (staff or DEBUG only)"""
+    def get(self, request, *args, **kwargs):
+        if not (settings.DEBUG or request.user.is_staff):
+            return Response({'detail': 'Not allowed'}, status=status.HTTP_403_FORBIDDEN)
+        return Response(collect_worker_metrics())
@@ -0,0 +1,241 @@
+import asyncio
+import glob
+import json
+import logging
+import os
+import random
+import signal
+import socket
+import time
+from datetime import datetime
+
+from django.conf import settings
+from django.db import connections
+
+from .admission import admission
+from .dbpool import db_pool
+from .drain import drainer
+from .loopmonitor import loop_monitor
+from .outbound import outbound_stats
+
+logger = logging.getLogger('chat')
+
+
+def local_snapshot():
+    """Metrics of this worker process"""
+    return {
+        'pid': os.getpid(),
+        'open_sockets': admission.open_sockets,
+        'draining': drainer.draining,
+        'threadpool_queue_depth': admission.threadpool_queue_depth(),
+        'loop_lag_ms': round(loop_monitor.loop_lag * 1000, 1),
+        'lag_histogram': loop_monitor.lag_histogram.snapshot(),
+        'slow_callbacks': len(loop_monitor.slow_callbacks),
+        'db_pool': db_pool.snapshot(),
+        'outbound': outbound_stats.snapshot(),
+        'updated_at': datetime.now().isoformat(),
+    }
+
+
+def merge_histograms(histograms):
+    merged = {'buckets': {}, 'count': 0, 'sum': 0.0, 'max': 0.0}
+    for histogram in histograms:
+        for bucket, count in histogram['buckets'].items():
+            merged['buckets'][bucket] = merged['buckets'].get(bucket, 0) + count
+        merged['count'] += histogram['count']
+        merged['sum'] = round(merged['sum'] + histogram['sum'], 6)
+        merged['max'] = max(merged['max'], histogram['max'])
+    return merged
+
+
+def collect_worker_metrics():
+    """Combine the snapshots published by every worker into one view"""
+    workers = []
+    if settings.METRICS_DIR:
+        for path in sorted(glob.glob(os.path.join(settings.METRICS_DIR, '*.json'))):
+            try:
+                with open(path) as f:
+                    workers.append(json.load(f))
+            except (OSError, ValueError):
+                # Worker exited or is mid-write; it will be picked up next time
+                continue
+    if not any(worker['pid'] == os.getpid() for worker in workers):
+        workers.append(local_snapshot())
+    return {
+        'workers': len(workers),
+        'open_sockets': sum(worker['open_sockets'] for worker in workers),
+        'threadpool_queue_depth': sum(worker['threadpool_queue_depth'] for worker in workers),
+        'max_loop_lag_ms': max(worker['loop_lag_ms'] for worker in workers),
+        'lag_histogram': merge_histograms(worker['lag_histogram'] for worker in workers),
+        'slow_callbacks': sum(worker['slow_callbacks'] for worker in workers),
+        'db_pool_queue_depth': sum(worker.get('db_pool', {}).get('queue_depth', 0) for worker in workers),
+        'slow_consumers': sum(worker.get('outbound', {}).get('slow_consumers', 0) for worker in workers),
+        'outbound_dropped_frames': sum(worker.get('outbound', {}).get('dropped_frames', 0) for worker in workers),
+        'slow_consumer_disconnects': sum(worker.get('outbound', {}).get('disconnects', 0) for worker in workers),
+        'outbound_blocked_writes': sum(worker.get('outbound', {}).get('blocked_writes', 0) for worker in workers),
+        'per_worker': workers,
+    }
+
+
+class MetricsPublisher:
+    """Periodically writes this worker's snapshot to METRICS_DIR/<pid>.json"""
+
+    def __init__(self):
+        self._task = None
+
+    def start(self):
+        """Start publishing on the running loop (no-op without METRICS_DIR)"""
+        if not settings.METRICS_DIR:
+            return
+        task = self._task
+        if task is None or task.done() or task.get_loop() is not asyncio.get_running_loop():
+            self._task = asyncio.ensure_future(self._publish())
+
+    async def _publish(self):
+        path = os.path.join(settings.METRICS_DIR, f'{os.getpid()}.json')
+        while True:
+            # Write then rename so readers never see a half-written file
+            tmp_path = f'{path}.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(local_snapshot(), f)
+            os.replace(tmp_path, path)
+            await asyncio.sleep(settings.METRICS_PUBLISH_INTERVAL)
+
+
+metrics_publisher = MetricsPublisher()
+
+
+class PreforkSupervisor:
+    """Binds the listening socket once and keeps N forked daphne workers accepting on it.
+
+    Workers are forked after Django is set up, so they start without repeating
+    imports. Each worker is recycled after max_age seconds (with jitter, so they
+    do not all restart together): a replacement is forked first, then the old
+    worker gets SIGTERM, drains its sockets (see chat.drain) and finishes its
+    in-flight work. SIGHUP recycles all workers; SIGTERM/SIGINT stop the
+    supervisor. graceful_timeout should leave room for DRAIN_TIMEOUT.
+    """
+
+    def __init__(self, bind, port, workers, max_age=0, graceful_timeout=30, stdout=None):
+        self.bind = bind
+        self.port = port
+        self.worker_count = workers
+        self.max_age = max_age
+        self.graceful_timeout = graceful_timeout
+        self.stdout = stdout
+        self.workers = {}  # pid -> recycle deadline (monotonic) or None
+        self.retiring = {}  # pid -> SIGKILL deadline
+        self.stopping = False
+        self.recycle_all = False
+        self.sock = None
+
+    def log(self, message):
+        if self.stdout:
+            self.stdout.write(f'[serve] {message}')
+
+    def run(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((self.bind, self.port))
+        self.sock.listen(2048)
+        self.sock.set_inheritable(True)
+        # Children must not inherit open database connections
+        connections.close_all()
+
+        signal.signal(signal.SIGTERM, self._handle_stop)
+        signal.signal(signal.SIGINT, self._handle_stop)
+        signal.signal(signal.SIGHUP, self._handle_recycle)
+
+        self.log(f'listening on {self.bind}:{self.port} with {self.worker_count} workers')
+        for _ in range(self.worker_count):
+            self.spawn()
+        while not self.stopping:
+            self.reap()
+            self.recycle()
+            while len(self.workers) < self.worker_count and not self.stopping:
+                self.spawn()
+            time.sleep(0.5)
+        self.shutdown()
+
+    def _handle_stop(self, signum, frame):
+        self.stopping = True
+
+    def _handle_recycle(self, signum, frame):
+        self.recycle_all = True
+
+    def spawn(self):
+        pid = os.fork()
+        if pid == 0:
+            self.serve_worker()
+            os._exit(0)
+        deadline = None
+        if self.max_age:
+            deadline = time.monotonic() + self.max_age * random.uniform(0.9, 1.1)
+        self.workers[pid] = deadline
+        self.log(f'worker {pid} started')
+        return pid
+
+    def serve_worker(self):
+        for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+            signal.signal(signum, signal.SIG_DFL)
+        from daphne.cli import CommandLineInterface
+        try:
+            CommandLineInterface().run(['--fd', str(self.sock.fileno()), 'chatbackend_out.asgi:application'])
+        except BaseException:
+            logger.exception(f'Worker {os.getpid()} crashed')
+            os._exit(1)
+
+    def reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            if pid in self.workers and not self.stopping:
+                self.log(f'worker {pid} exited unexpectedly (status {status}), replacing')
+            self.workers.pop(pid, None)
+            self.retiring.pop(pid, None)
+            if settings.METRICS_DIR:
+                try:
+                    os.remove(os.path.join(settings.METRICS_DIR, f'{pid}.json'))
+                except OSError:
+                    pass
+
+    def recycle(self):
+        now = time.monotonic()
+        for pid, deadline in list(self.workers.items()):
+            if self.recycle_all or (deadline is not None and now >= deadline):
+                # Start the replacement before retiring the old worker so capacity never dips
+                del self.workers[pid]
+                self.spawn()
+                self.retire(pid)
+        self.recycle_all = False
+        for pid, kill_at in list(self.retiring.items()):
+            if now >= kill_at:
+                self.log(f'worker {pid} did not exit in {self.graceful_timeout}s, killing')
+                self._signal(pid, signal.SIGKILL)
+                del self.retiring[pid]
+
+    def retire(self, pid):
+        self.log(f'recycling worker {pid}')
+        self.retiring[pid] = time.monotonic() + self.graceful_timeout
+        self._signal(pid, signal.SIGTERM)
+
+    def shutdown(self):
+        self.log('stopping workers')
+        for pid in list(self.workers):
+            self.retire(pid)
+        self.workers.clear()
+        while self.retiring:
+            self.reap()
+            self.recycle()
+            time.sleep(0.2)
+        self.sock.close()
+
+    def _signal(self, pid, signum):
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            pass
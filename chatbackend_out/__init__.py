@@ -1 +1,5 @@
 # Django project package
+import time
+
+# Imported first by django.setup() (via settings); `serve` reports setup time from here
+STARTED_AT = time.monotonic()
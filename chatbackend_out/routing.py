@@ -1,6 +1,7 @@
 from django.urls import re_path
-from chat.consumers import ChatConsumer
+from chat.consumers import ChatConsumer, UserConsumer
 
 websocket_urlpatterns = [
     re_path(r'ws/chat/(?P<room_id>[^/]+)/$', ChatConsumer.as_asgi()),
+    re_path(r'ws/user/$', UserConsumer.as_asgi()),
 ]
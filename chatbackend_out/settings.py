@@ -25,11 +25,15 @@ INSTALLED_APPS = [
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
+    # Compresses API responses (message history can be large); static files are precompressed
+    'django.middleware.gzip.GZipMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
+    'chat.middleware.AdmissionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'chat.middleware.ReplicaPinningMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -61,6 +65,27 @@ DATABASES = {
     )
 }
 
+# Optional read replica: reads go there unless the caller wrote within
+# REPLICA_PIN_SECONDS, in which case they stay on the primary (read-your-writes)
+DATABASE_REPLICA_URL = os.environ.get('DATABASE_REPLICA_URL')
+if DATABASE_REPLICA_URL:
+    DATABASES['replica'] = dj_database_url.parse(
+        DATABASE_REPLICA_URL,
+        conn_max_age=600,
+        conn_health_checks=True,
+    )
+    DATABASES['replica']['TEST'] = {'MIRROR': 'default'}
+    DATABASE_ROUTERS = ['chat.routers.PrimaryReplicaRouter']
+REPLICA_PIN_SECONDS = int(os.environ.get('REPLICA_PIN_SECONDS', '5'))
+
+# Threads (each with its own persistent connection) running consumer queries in
+# parallel. 0 keeps channels' single thread-sensitive executor; SQLite serializes
+# writes anyway, so it defaults to 0 there.
+DB_POOL_SIZE = int(os.environ.get(
+    'DB_POOL_SIZE',
+    '0' if DATABASES['default']['ENGINE'] == 'django.db.backends.sqlite3' else '8',
+))
+
 # Password validation
 AUTH_PASSWORD_VALIDATORS = [
     {'NAME': 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator'},
@@ -81,12 +106,22 @@ STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')
 STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
 
 REDIS_URL = os.environ.get('REDIS_URL')
-if REDIS_URL:
+# Optional comma-separated list of Redis hosts; channels and groups are hashed across them
+REDIS_URLS = [url.strip() for url in os.environ.get('REDIS_URLS', REDIS_URL or '').split(',') if url.strip()]
+# 'core' keeps one Redis message per channel, so group_send to N members costs N writes.
+# 'pubsub' publishes each group message once; every node subscribed to the group
+# fans it out in memory to its own consumers.
+CHANNEL_LAYER_MODE = os.environ.get('CHANNEL_LAYER_MODE', 'core')
+if REDIS_URLS:
     CHANNEL_LAYERS = {
         'default': {
-            'BACKEND': 'channels_redis.core.RedisChannelLayer',
+            'BACKEND': (
+                'channels_redis.pubsub.RedisPubSubChannelLayer'
+                if CHANNEL_LAYER_MODE == 'pubsub'
+                else 'channels_redis.core.RedisChannelLayer'
+            ),
             'CONFIG': {
-                'hosts': [REDIS_URL],
+                'hosts': REDIS_URLS,
             },
         }
     }
@@ -97,6 +132,123 @@ else:
         }
     }
 
+# Shared cache (room documents): the first Redis host when one is set, else
+# per-process memory (only correct with a single worker)
+if REDIS_URLS:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': REDIS_URLS[0],
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+# Serialized room documents live ROOM_DOC_CACHE_TTL seconds unless a change retires them
+# first; one request rebuilds a missing document while others wait up to ROOM_DOC_LOCK_TIMEOUT.
+# Lookups of rooms that do not exist are answered from the cache for ROOM_DOC_MISSING_TTL
+ROOM_DOC_CACHE_TTL = int(os.environ.get('ROOM_DOC_CACHE_TTL', '300'))
+ROOM_DOC_LOCK_TIMEOUT = float(os.environ.get('ROOM_DOC_LOCK_TIMEOUT', '5'))
+ROOM_DOC_MISSING_TTL = int(os.environ.get('ROOM_DOC_MISSING_TTL', '10'))
+
+# Online/typing state: 'redis' shares it across workers and nodes, 'local' keeps it
+# in-process (only correct with a single worker)
+PRESENCE_BACKEND = os.environ.get('PRESENCE_BACKEND', 'redis' if REDIS_URLS else 'local')
+PRESENCE_TTL = int(os.environ.get('PRESENCE_TTL', '3600'))
+
+# Per-worker metrics snapshots are written here by multi-worker `serve` so that
+# /api/debug/metrics/ can combine them (set automatically by the launcher)
+METRICS_DIR = os.environ.get('METRICS_DIR')
+METRICS_PUBLISH_INTERVAL = float(os.environ.get('METRICS_PUBLISH_INTERVAL', '5'))
+
+# Activity rollups are updated on every message insert; set ROLLUPS_ON_INSERT=0
+# to rely on the `rollup_activity` catch-up job instead
+ROLLUPS_ON_INSERT = os.environ.get('ROLLUPS_ON_INSERT', '1') == '1'
+
+# Recently tried room keys that matched nothing are answered from the shared cache
+ROOM_KEY_MISS_CACHE_TTL = float(os.environ.get('ROOM_KEY_MISS_CACHE_TTL', '60'))
+
+# Messages sent with a client_msg_id are remembered this long (seconds), so resends are
+# acknowledged from memory; older resends are caught by the unique constraint
+RECENT_CLIENT_IDS_SIZE = int(os.environ.get('RECENT_CLIENT_IDS_SIZE', '50000'))
+RECENT_CLIENT_IDS_TTL = float(os.environ.get('RECENT_CLIENT_IDS_TTL', '300'))
+
+# GET /api/bootstrap/ includes recent messages and presence for this many of the user's rooms
+BOOTSTRAP_TOP_ROOMS = int(os.environ.get('BOOTSTRAP_TOP_ROOMS', '5'))
+BOOTSTRAP_RECENT_MESSAGES = int(os.environ.get('BOOTSTRAP_RECENT_MESSAGES', '20'))
+
+# Banned user ids are cached per room; other workers pick up ban changes within the TTL (seconds)
+ROOM_BAN_CACHE_SIZE = int(os.environ.get('ROOM_BAN_CACHE_SIZE', '10000'))
+ROOM_BAN_CACHE_TTL = float(os.environ.get('ROOM_BAN_CACHE_TTL', '30'))
+
+# Deleted rooms are purged in the background: this many messages per DELETE,
+# with a pause (seconds) between batches so foreground queries keep flowing
+ROOM_PURGE_BATCH_SIZE = int(os.environ.get('ROOM_PURGE_BATCH_SIZE', '1000'))
+ROOM_PURGE_PAUSE = float(os.environ.get('ROOM_PURGE_PAUSE', '0.05'))
+
+# Typing indicators: at most one aggregated frame per room per interval (seconds);
+# a user is shown as typing until TYPING_TIMEOUT passes without a new typing frame
+TYPING_BROADCAST_INTERVAL = float(os.environ.get('TYPING_BROADCAST_INTERVAL', '1.0'))
+TYPING_TIMEOUT = float(os.environ.get('TYPING_TIMEOUT', '5.0'))
+
+# Micro-batching for clients connecting with ?capabilities=batch: once a room's message
+# rate passes BATCH_RATE_THRESHOLD (messages/second), messages are held for up to
+# BATCH_WINDOW seconds or BATCH_MAX_MESSAGES and sent as one {type: 'batch'} frame
+BATCH_RATE_THRESHOLD = float(os.environ.get('BATCH_RATE_THRESHOLD', '20'))
+BATCH_WINDOW = float(os.environ.get('BATCH_WINDOW', '0.025'))
+BATCH_MAX_MESSAGES = int(os.environ.get('BATCH_MAX_MESSAGES', '50'))
+
+# Room payloads embed only the first ROOM_MEMBER_PREVIEW_SIZE members; the full list is
+# cursor-paginated at /api/rooms/<id>/members/, ROOM_MEMBERS_PAGE_SIZE per page
+ROOM_MEMBER_PREVIEW_SIZE = int(os.environ.get('ROOM_MEMBER_PREVIEW_SIZE', '5'))
+ROOM_MEMBERS_PAGE_SIZE = int(os.environ.get('ROOM_MEMBERS_PAGE_SIZE', '50'))
+
+# SIGTERM drain: open sockets get {type: 'reconnect', delay} with delays spread over
+# DRAIN_RECONNECT_WINDOW seconds; the worker exits once they closed or DRAIN_TIMEOUT passed
+DRAIN_RECONNECT_WINDOW = float(os.environ.get('DRAIN_RECONNECT_WINDOW', '10'))
+DRAIN_TIMEOUT = float(os.environ.get('DRAIN_TIMEOUT', '5'))
+
+# Each socket buffers at most OUTBOUND_QUEUE_SIZE frames for its client. When full,
+# OUTBOUND_QUEUE_POLICY applies: 'drop_oldest', 'coalesce' (latest presence/typing only,
+# queued messages replaced by one {type: 'resync'}) or 'disconnect' (close with 4408).
+# A closing socket waits up to OUTBOUND_FLUSH_TIMEOUT seconds for its queue to empty.
+# Under daphne a socket's writer pauses while Twisted's buffer for the client is full,
+# so the queue is what fills up
+OUTBOUND_QUEUE_SIZE = int(os.environ.get('OUTBOUND_QUEUE_SIZE', '500'))
+OUTBOUND_QUEUE_POLICY = os.environ.get('OUTBOUND_QUEUE_POLICY', 'drop_oldest')
+OUTBOUND_FLUSH_TIMEOUT = float(os.environ.get('OUTBOUND_FLUSH_TIMEOUT', '2'))
+
+# Rooms a single ws/user/ socket may subscribe to at once
+USER_SOCKET_MAX_ROOMS = int(os.environ.get('USER_SOCKET_MAX_ROOMS', '100'))
+
+# Per-message tracing: this fraction of messages (0 = off) records timed spans from
+# receive/create to each receiver's send. Spans go to TRACE_FILE as JSON lines, or with
+# TRACE_EXPORTER=otlp to an OTLP/HTTP collector (JSON encoding) at TRACE_OTLP_ENDPOINT
+TRACE_SAMPLE_RATE = float(os.environ.get('TRACE_SAMPLE_RATE', '0'))
+TRACE_EXPORTER = os.environ.get('TRACE_EXPORTER', 'file')
+TRACE_FILE = os.environ.get('TRACE_FILE', str(BASE_DIR / 'traces.jsonl'))
+TRACE_OTLP_ENDPOINT = os.environ.get('TRACE_OTLP_ENDPOINT', 'http://localhost:4318/v1/traces')
+TRACE_SERVICE_NAME = os.environ.get('TRACE_SERVICE_NAME', 'out-app')
+
+# Event-loop monitor: lag is sampled every LOOP_MONITOR_INTERVAL seconds; callbacks
+# blocking the loop longer than LOOP_MONITOR_SLOW_THRESHOLD get a stack sample
+# (0 disables). A lag summary is logged every LOOP_MONITOR_LOG_INTERVAL seconds (0 disables).
+LOOP_MONITOR_INTERVAL = float(os.environ.get('LOOP_MONITOR_INTERVAL', '0.5'))
+LOOP_MONITOR_SLOW_THRESHOLD = float(os.environ.get('LOOP_MONITOR_SLOW_THRESHOLD', '0.1'))
+LOOP_MONITOR_LOG_INTERVAL = float(os.environ.get('LOOP_MONITOR_LOG_INTERVAL', '60'))
+
+# Admission control: refuse new sockets (close code 4503) and answer heavy REST
+# routes with 503 + Retry-After while this process is saturated
+ADMISSION_ENABLED = os.environ.get('ADMISSION_ENABLED', '1') == '1'
+ADMISSION_MAX_SOCKETS = int(os.environ.get('ADMISSION_MAX_SOCKETS', '5000'))
+ADMISSION_MAX_LOOP_LAG = float(os.environ.get('ADMISSION_MAX_LOOP_LAG', '0.5'))
+ADMISSION_MAX_THREADPOOL_QUEUE = int(os.environ.get('ADMISSION_MAX_THREADPOOL_QUEUE', '200'))
+ADMISSION_RETRY_AFTER = int(os.environ.get('ADMISSION_RETRY_AFTER', '5'))
+ADMISSION_HEAVY_ROUTES = ['rooms-list', 'room-detail', 'room-messages', 'rooms-join', 'bootstrap']
+
 FRONTEND_ORIGINS = os.environ.get('FRONTEND_ORIGINS', 'http://localhost:3000,http://localhost:5173')
 CORS_ALLOWED_ORIGINS = [origin.strip() for origin in FRONTEND_ORIGINS.split(',') if origin.strip()]
 CORS_ALLOW_CREDENTIALS = True
@@ -109,12 +261,37 @@ CSRF_TRUSTED_ORIGINS = [
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
+# Logging: records are written by a background thread (chat.logs.QueueingStreamHandler),
+# as JSON lines by default or LOG_FORMAT=text. Records with an `event` field are sampled
+# per event (LOG_SAMPLE_RATES="presence.join=0.1,ws.connect=0.1") and capped at
+# LOG_EVENT_RATE_CAP per second per event; warnings and errors are never sampled
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'json')
+LOG_SAMPLE_RATES = {
+    event.strip(): float(rate)
+    for event, _, rate in (item.partition('=') for item in os.environ.get('LOG_SAMPLE_RATES', '').split(',') if '=' in item)
+}
+LOG_EVENT_RATE_CAP = float(os.environ.get('LOG_EVENT_RATE_CAP', '50'))
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', '10000'))
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
+    'formatters': {
+        'json': {'()': 'chat.logs.JsonFormatter'},
+        'text': {'()': 'chat.logs.KeyValueFormatter', 'format': '%(message)s'},
+    },
+    'filters': {
+        'sampling': {'()': 'chat.logs.SamplingFilter'},
+    },
     'handlers': {
-        'console': {'class': 'logging.StreamHandler'},
+        'console': {
+            'class': 'chat.logs.QueueingStreamHandler',
+            'queue_size': LOG_QUEUE_SIZE,
+            'formatter': LOG_FORMAT,
+            'filters': ['sampling'],
+        },
     },
+    # django and chat propagate to the root handler (one handler, so no duplicate lines)
     'root': {'handlers': ['console'], 'level': 'INFO'},
-    'loggers': {'django': {'handlers': ['console'], 'level': 'INFO'}, 'chat': {'handlers': ['console'], 'level': 'INFO'}},
+    'loggers': {'django': {'level': 'INFO'}, 'chat': {'level': 'INFO'}},
 }